@@ -0,0 +1,370 @@
+"""
+Benchmark das conversões do service_text e do service_image.
+
+Para cada caminho de conversão (ex: docx:pdf, png:gif) e cada ficheiro do corpus sintético
+(ver corpus.py) mede o débito, os percentis de latência e o pico de memória (RSS).
+
+Modos:
+- direct: chama process_text_conversion / process_image_conversion diretamente;
+- e2e: dispatcher HTTP -> fila -> consumidor do serviço -> store de resultados, com substitutos
+  locais do Consul e do RabbitMQ (ver standins.py). A conclusão é observada em /jobs/<id>?wait=
+  (sem callback_url, por isso o delivery não entra na medição).
+
+Cada caminho corre num processo novo, para que o pico de RSS seja só desse caminho.
+
+Uso:
+    python benchmarks/conversions.py [--mode direct|e2e] [--paths docx:pdf,png:gif] [--repeat 5]
+        [--warmup 1] [--concurrency 1] [--output resultados.json] [--compare baseline.json]
+"""
+import argparse
+import concurrent.futures
+import hashlib
+import json
+import multiprocessing
+import os
+import platform
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import uuid
+
+from corpus import CORPUS_DIR, DEFAULT_PAGES, DEFAULT_RESOLUTIONS, DEFAULT_SEED, build_corpus, parse_pages, parse_resolutions
+
+ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), ".."))
+SUITE_VERSION = 1
+
+MULTI_OUTPUTS = [
+    {"format": "jpg", "max_width": 160, "max_height": 160, "profile": "small", "name": "thumb"},
+    {"format": "jpg", "max_width": 1024, "max_height": 1024, "name": "preview"},
+    {"format": "png", "name": "full"},
+]
+
+# caminho -> (serviço, extensão de origem, campos do pedido)
+PATHS = {
+    "docx:pdf": ("text", "docx", {"target_format": "pdf"}),
+    "docx:png": ("text", "docx", {"target_format": "png"}),
+    "pdf:docx": ("text", "pdf", {"target_format": "docx"}),
+    "pdf:png": ("text", "pdf", {"target_format": "png"}),
+    "docx:multi": ("text", "docx", {"target_format": "multi", "outputs": [{"format": "pdf"}, {"format": "png"}]}),
+    "jpg:png": ("image", "jpg", {"target_format": "png"}),
+    "jpg:gif": ("image", "jpg", {"target_format": "gif"}),
+    "png:jpg": ("image", "png", {"target_format": "jpg"}),
+    "png:gif": ("image", "png", {"target_format": "gif"}),
+    "gif:jpg": ("image", "gif", {"target_format": "jpg"}),
+    "gif:png": ("image", "gif", {"target_format": "png"}),
+    "jpg:multi": ("image", "jpg", {"target_format": "jpg", "outputs": MULTI_OUTPUTS}),
+}
+
+DONE_STATES = {"converted", "delivered", "delivery_failed", "failed"}
+
+
+def percentile(values, p):
+    values = sorted(values)
+    if not values:
+        return None
+    k = (len(values) - 1) * p / 100
+    low = int(k)
+    high = min(low + 1, len(values) - 1)
+    return values[low] + (values[high] - values[low]) * (k - low)
+
+
+def latency_summary(latencies):
+    if not latencies:
+        return {}
+    summary = {"mean": sum(latencies) / len(latencies), "max": max(latencies)}
+    for p in (50, 90, 95, 99):
+        summary[f"p{p}"] = percentile(latencies, p)
+    return {k: round(v, 4) for k, v in summary.items()}
+
+
+def peak_rss_mb(who):
+    # ru_maxrss vem em KB no Linux e em bytes no macOS
+    rss = resource.getrusage(who).ru_maxrss
+    return round(rss / (1024 * 1024 if sys.platform == "darwin" else 1024), 1)
+
+
+def file_sha256(path):
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def prepare_env(work_dir, extra=None):
+    """
+    Variáveis lidas pelos módulos no import: tem de correr antes de os carregar.
+    """
+    os.environ["RESULTS_DIR"] = os.path.join(work_dir, "results")
+    os.environ["BLOBS_DIR"] = os.path.join(work_dir, "blobs")
+    os.environ["WORK_DIR"] = os.path.join(work_dir, "work")
+    os.environ["TRACE_FILE"] = ""
+    os.environ.update(extra or {})
+    os.makedirs(os.environ["RESULTS_DIR"], exist_ok=True)
+    os.makedirs(os.environ["BLOBS_DIR"], exist_ok=True)
+
+
+def import_service(kind):
+    # Importado como "service" (e não por spec) para os processos "spawn" do pool de imagem o encontrarem
+    sys.path.insert(0, os.path.join(ROOT, "services", f"service_{kind}"))
+    import service
+    return service
+
+
+def import_dispatcher():
+    sys.path.insert(0, os.path.join(ROOT, "dispatcher"))
+    import dispatcher
+    return dispatcher
+
+
+def read_job(results_dir, job_id):
+    try:
+        with open(os.path.join(results_dir, job_id, "job.json"), encoding="utf-8") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def run_batch(job, inputs, count, concurrency):
+    """
+    Corre count pedidos (a rodar pelos inputs) com a concorrência pedida.
+    Devolve (latências dos pedidos bem sucedidos, erros, duração total).
+    """
+    latencies, errors = [], []
+    started = time.perf_counter()
+    with concurrent.futures.ThreadPoolExecutor(max_workers=concurrency) as pool:
+        futures = [pool.submit(job, inputs[i % len(inputs)]) for i in range(count)]
+        for future in concurrent.futures.as_completed(futures):
+            try:
+                latencies.append(future.result())
+            except Exception as e:
+                errors.append(str(e))
+    return latencies, errors, time.perf_counter() - started
+
+
+def direct_job_factory(path, work_dir):
+    kind, _, fields = PATHS[path]
+    service = import_service(kind)
+    process = service.process_text_conversion if kind == "text" else service.process_image_conversion
+    results_dir = os.environ["RESULTS_DIR"]
+
+    def job(entry):
+        job_id = uuid.uuid4().hex
+        data = dict(fields, job_id=job_id, filename=os.path.basename(entry["path"]), blob_sha256=entry["sha256"])
+        start = time.perf_counter()
+        process(data)
+        elapsed = time.perf_counter() - start
+        status = read_job(results_dir, job_id)
+        shutil.rmtree(os.path.join(results_dir, job_id), ignore_errors=True)
+        if status.get("status") != "converted":
+            raise RuntimeError(status.get("error") or f"estado final {status.get('status')}")
+        return elapsed
+
+    return job, lambda: None
+
+
+def e2e_job_factory(path, work_dir):
+    import threading
+    import requests
+    from werkzeug.serving import make_server
+    from standins import ConsulStandIn, StandInBroker
+
+    kind, _, fields = PATHS[path]
+    consul = ConsulStandIn({
+        "service-text": ("127.0.0.1", 5001, ["text"]),
+        "service-image": ("127.0.0.1", 5002, ["image"]),
+    })
+    os.environ["CONSUL_HTTP_ADDR"] = consul.address
+    broker = StandInBroker()
+    service = import_service(kind)
+    dispatcher = import_dispatcher()
+    service.pika = broker.pika
+    dispatcher.pika = broker.pika
+    # A publicação na fila de entrega é feita em shared/jobs.py
+    import shared.jobs
+    shared.jobs.pika = broker.pika
+    dispatcher.scheduler.start()
+    threading.Thread(target=service.rabbitmq_consumer, daemon=True).start()
+    server = make_server("127.0.0.1", 0, dispatcher.app, threaded=True)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    base_url = f"http://127.0.0.1:{server.server_port}"
+    auth = (dispatcher.USERNAME, dispatcher.PASSWORD)
+    form = {k: json.dumps(v) if k == "outputs" else v for k, v in fields.items()}
+    http = requests.Session()
+
+    def job(entry):
+        start = time.perf_counter()
+        with open(entry["path"], "rb") as f:
+            files = {"file": (os.path.basename(entry["path"]), f)}
+            resp = http.post(f"{base_url}/convert", data=form, files=files, auth=auth, timeout=60)
+        resp.raise_for_status()
+        job_id = resp.json()["job_id"]
+        while True:
+            status = http.get(f"{base_url}/jobs/{job_id}", params={"wait": 30}, auth=auth, timeout=60).json()
+            if status.get("status") in DONE_STATES:
+                break
+        elapsed = time.perf_counter() - start
+        shutil.rmtree(os.path.join(os.environ["RESULTS_DIR"], job_id), ignore_errors=True)
+        if status["status"] != "converted":
+            raise RuntimeError(status.get("error") or f"estado final {status['status']}")
+        return elapsed
+
+    def close():
+        server.shutdown()
+        consul.close()
+        # Espera pelos processos do pool para que entrem no RUSAGE_CHILDREN
+        if getattr(service, "worker_pool", None) is not None:
+            service.worker_pool.shutdown(wait=True)
+
+    return job, close
+
+
+def run_path(mode, path, entries, repeat, warmup, concurrency, env):
+    """
+    Corre num processo novo: mede um caminho de conversão para cada ficheiro do corpus.
+    """
+    work_dir = tempfile.mkdtemp(prefix="conv-bench-")
+    if mode == "direct":
+        # Sem broker: um documento grande seria dividido em partes publicadas no RabbitMQ real
+        env = {"SHARD_MIN_PAGES": "0", **(env or {})}
+    prepare_env(work_dir, env)
+    for entry in entries:
+        blob = os.path.join(os.environ["BLOBS_DIR"], entry["sha256"])
+        if not os.path.exists(blob):
+            shutil.copyfile(entry["path"], blob)
+    factory = direct_job_factory if mode == "direct" else e2e_job_factory
+    job, close = factory(path, work_dir)
+    results = []
+    try:
+        for entry in entries:
+            if warmup:
+                run_batch(job, [entry], warmup, 1)
+            count = repeat * concurrency
+            latencies, errors, wall = run_batch(job, [entry], count, concurrency)
+            results.append({
+                "path": path,
+                "input": entry["label"],
+                "input_bytes": entry["bytes"],
+                "runs": len(latencies),
+                "failures": len(errors),
+                "errors": sorted(set(errors))[:5],
+                "throughput_per_s": round(len(latencies) / wall, 3) if wall else None,
+                "latency_s": latency_summary(latencies),
+            })
+    finally:
+        close()
+        shutil.rmtree(work_dir, ignore_errors=True)
+    rss_self, rss_children = peak_rss_mb(resource.RUSAGE_SELF), peak_rss_mb(resource.RUSAGE_CHILDREN)
+    for result in results:
+        result["peak_rss_mb"] = rss_self
+        result["peak_rss_children_mb"] = rss_children
+    return results
+
+
+def git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "HEAD"], cwd=ROOT, capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(results, baseline):
+    """
+    Diferenças (em %) em relação a um ficheiro de resultados anterior.
+    Latência: positivo = mais lento. Débito: positivo = mais rápido.
+    """
+    def delta(new, old):
+        if new is None or not old:
+            return "-"
+        return f"{(new - old) / old * 100:+.1f}%"
+
+    previous = {(r["path"], r["input"]): r for r in baseline["results"]}
+    print(f"\nComparação com {baseline['meta'].get('git_commit') or 'baseline'} ({baseline['mode']})")
+    print(f"{'caminho':<12}{'input':>12}{'p50':>10}{'p95':>10}{'débito':>10}{'RSS':>10}")
+    for r in results:
+        old = previous.get((r["path"], r["input"]))
+        if not old:
+            continue
+        print(
+            f"{r['path']:<12}{r['input']:>12}"
+            f"{delta(r['latency_s'].get('p50'), old['latency_s'].get('p50')):>10}"
+            f"{delta(r['latency_s'].get('p95'), old['latency_s'].get('p95')):>10}"
+            f"{delta(r['throughput_per_s'], old['throughput_per_s']):>10}"
+            f"{delta(r['peak_rss_mb'], old['peak_rss_mb']):>10}"
+        )
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark das conversões de texto e imagem")
+    parser.add_argument("--mode", choices=["direct", "e2e"], default="direct")
+    parser.add_argument("--paths", default=",".join(PATHS), help="Caminhos separados por vírgulas (origem:destino)")
+    parser.add_argument("--repeat", type=int, default=5, help="Pedidos medidos por ficheiro (multiplicado pela concorrência)")
+    parser.add_argument("--warmup", type=int, default=1, help="Pedidos de aquecimento por ficheiro (não medidos)")
+    parser.add_argument("--concurrency", type=int, default=1)
+    parser.add_argument("--corpus-dir", default=CORPUS_DIR)
+    parser.add_argument("--pages", type=parse_pages, default=DEFAULT_PAGES)
+    parser.add_argument("--resolutions", type=parse_resolutions, default=DEFAULT_RESOLUTIONS)
+    parser.add_argument("--seed", type=int, default=DEFAULT_SEED)
+    parser.add_argument("--env", action="append", default=[], help="VAR=valor passado aos serviços (ex: GIF_QUANTIZE_METHOD=fastoctree)")
+    parser.add_argument("--output", help="Escreve os resultados em JSON")
+    parser.add_argument("--compare", help="Ficheiro JSON de uma execução anterior")
+    args = parser.parse_args()
+
+    paths = [p for p in args.paths.split(",") if p]
+    unknown = [p for p in paths if p not in PATHS]
+    if unknown:
+        parser.error(f"Caminhos desconhecidos: {', '.join(unknown)}. Disponíveis: {', '.join(PATHS)}")
+    env = dict(item.split("=", 1) for item in args.env)
+
+    entries = build_corpus(args.corpus_dir, args.pages, args.resolutions, args.seed)
+    for entry in entries:
+        entry["sha256"] = file_sha256(entry["path"])
+
+    results = []
+    for path in paths:
+        source = PATHS[path][1]
+        inputs = [e for e in entries if e["source"] == source]
+        # Um processo por caminho: o pico de RSS e os módulos carregados não passam de um caminho para outro
+        with concurrent.futures.ProcessPoolExecutor(max_workers=1, mp_context=multiprocessing.get_context("spawn")) as pool:
+            future = pool.submit(run_path, args.mode, path, inputs, args.repeat, args.warmup, args.concurrency, env)
+            try:
+                path_results = future.result()
+            except Exception as e:
+                print(f"{path}: falhou ({e})", file=sys.stderr)
+                continue
+        for r in path_results:
+            lat = r["latency_s"]
+            print(
+                f"{r['path']:<12}{r['input']:>12}  {r['runs']:>3} ok {r['failures']:>3} falhas  "
+                f"p50 {lat.get('p50', 0):.3f}s p95 {lat.get('p95', 0):.3f}s  "
+                f"{r['throughput_per_s'] or 0:.2f}/s  RSS {r['peak_rss_mb']} MB (+{r['peak_rss_children_mb']} MB filhos)"
+            )
+        results.extend(path_results)
+
+    report = {
+        "suite": "conv-dist-conversions",
+        "version": SUITE_VERSION,
+        "mode": args.mode,
+        "meta": {
+            "git_commit": git_commit(),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "cpus": os.cpu_count(),
+            "timestamp": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+            "args": {k: v for k, v in vars(args).items() if k not in ("output", "compare")},
+        },
+        "results": results,
+    }
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(report, f, indent=2)
+    if args.compare:
+        with open(args.compare, encoding="utf-8") as f:
+            compare(results, json.load(f))
+
+
+if __name__ == "__main__":
+    main()
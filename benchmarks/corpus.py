@@ -0,0 +1,130 @@
+"""
+Corpus sintético para os benchmarks de conversão.
+
+Gera, de forma determinística (mesma seed = mesmos ficheiros):
+- documentos DOCX e PDF com N páginas (texto, títulos e uma tabela/figura por página);
+- imagens JPEG, PNG e GIF em várias resoluções (gradiente, ruído e fractal).
+
+Uso:
+    python benchmarks/corpus.py [pasta] [--pages 1,10,50] [--resolutions 640x480,1920x1080,4000x3000]
+"""
+import argparse
+import json
+import os
+import random
+
+from PIL import Image
+
+from gif_quantize import synthetic_image
+
+DEFAULT_PAGES = [1, 10, 50]
+DEFAULT_RESOLUTIONS = [(640, 480), (1920, 1080), (4000, 3000)]
+DEFAULT_SEED = 1234
+CORPUS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), ".corpus")
+
+WORDS = (
+    "conversão documento serviço fila página imagem resultado pedido cliente entrega tempo "
+    "memória processo rede ficheiro formato tabela relatório análise sistema dados valor"
+).split()
+
+
+def sentence(rng, words=12):
+    text = " ".join(rng.choice(WORDS) for _ in range(words))
+    return text.capitalize() + "."
+
+
+def paragraph(rng, sentences=6):
+    return " ".join(sentence(rng, rng.randint(8, 16)) for _ in range(sentences))
+
+
+def generate_docx(path, pages, seed=DEFAULT_SEED):
+    from docx import Document
+
+    rng = random.Random(seed)
+    doc = Document()
+    for page in range(pages):
+        doc.add_heading(f"Secção {page + 1}", level=1)
+        for _ in range(4):
+            doc.add_paragraph(paragraph(rng))
+        table = doc.add_table(rows=4, cols=3)
+        table.style = "Table Grid"
+        for row in table.rows:
+            for cell in row.cells:
+                cell.text = f"{rng.randint(0, 99999)}"
+        if page < pages - 1:
+            doc.add_page_break()
+    doc.save(path)
+
+
+def generate_pdf(path, pages, seed=DEFAULT_SEED):
+    import fitz  # PyMuPDF
+
+    rng = random.Random(seed)
+    doc = fitz.open()
+    for page_number in range(pages):
+        page = doc.new_page(width=595, height=842)  # A4
+        page.insert_text((56, 72), f"Secção {page_number + 1}", fontsize=18)
+        body = "\n\n".join(paragraph(rng) for _ in range(4))
+        page.insert_textbox(fitz.Rect(56, 96, 539, 600), body, fontsize=10)
+        # Pequeno gráfico de barras vetorial
+        for i in range(8):
+            height = rng.randint(20, 160)
+            rect = fitz.Rect(80 + i * 55, 780 - height, 120 + i * 55, 780)
+            page.draw_rect(rect, color=(0, 0, 0), fill=(0.2, 0.4, 0.8))
+    doc.save(path)
+    doc.close()
+
+
+def generate_image(path, size, fmt):
+    img = synthetic_image(*size)
+    if fmt == "gif":
+        img = img.quantize(colors=256, method=Image.Quantize.FASTOCTREE)
+    pil_format = {"jpg": "JPEG", "png": "PNG", "gif": "GIF"}[fmt]
+    img.save(path, pil_format)
+
+
+def build_corpus(corpus_dir=CORPUS_DIR, pages=DEFAULT_PAGES, resolutions=DEFAULT_RESOLUTIONS, seed=DEFAULT_SEED):
+    """
+    Gera (ou reutiliza, se já existirem) os ficheiros do corpus e devolve a lista de entradas
+    {"path", "source", "label", "bytes"}.
+    """
+    os.makedirs(corpus_dir, exist_ok=True)
+    entries = []
+    for n in pages:
+        for ext, generate in (("docx", generate_docx), ("pdf", generate_pdf)):
+            path = os.path.join(corpus_dir, f"doc_{n}p_s{seed}.{ext}")
+            if not os.path.exists(path):
+                generate(path, n, seed)
+            entries.append({"path": path, "source": ext, "label": f"{n}p"})
+    for width, height in resolutions:
+        for ext in ("jpg", "png", "gif"):
+            path = os.path.join(corpus_dir, f"img_{width}x{height}.{ext}")
+            if not os.path.exists(path):
+                generate_image(path, (width, height), ext)
+            entries.append({"path": path, "source": ext, "label": f"{width}x{height}"})
+    for entry in entries:
+        entry["bytes"] = os.path.getsize(entry["path"])
+    return entries
+
+
+def parse_pages(value):
+    return [int(v) for v in value.split(",") if v]
+
+
+def parse_resolutions(value):
+    return [tuple(int(n) for n in v.lower().split("x")) for v in value.split(",") if v]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Gera o corpus sintético dos benchmarks")
+    parser.add_argument("corpus_dir", nargs="?", default=CORPUS_DIR)
+    parser.add_argument("--pages", type=parse_pages, default=DEFAULT_PAGES)
+    parser.add_argument("--resolutions", type=parse_resolutions, default=DEFAULT_RESOLUTIONS)
+    parser.add_argument("--seed", type=int, default=DEFAULT_SEED)
+    args = parser.parse_args()
+    entries = build_corpus(args.corpus_dir, args.pages, args.resolutions, args.seed)
+    print(json.dumps(entries, indent=2))
+
+
+if __name__ == "__main__":
+    main()
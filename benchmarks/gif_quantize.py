@@ -0,0 +1,96 @@
+"""
+Benchmark da quantização GIF do service_image.
+
+Mede, para cada combinação de método / redução da paleta / dithering, o tempo de
+quantização e a qualidade do resultado (PSNR em relação à imagem original).
+
+Uso:
+    python benchmarks/gif_quantize.py [imagem] [--colors 256] [--repeat 3] [--json]
+
+Sem imagem, é gerada uma imagem sintética de 4000x3000 com gradientes e ruído.
+"""
+import argparse
+import importlib.util
+import json
+import math
+import os
+import time
+
+from PIL import Image, ImageChops, ImageStat
+
+ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), ".."))
+
+
+def load_image_service():
+    path = os.path.join(ROOT, "services", "service_image", "service.py")
+    spec = importlib.util.spec_from_file_location("service_image", path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def synthetic_image(width=4000, height=3000):
+    gradient = Image.linear_gradient("L").resize((width, height))
+    noise = Image.effect_noise((width, height), 64)
+    mandel = Image.effect_mandelbrot((width, height), (-2.0, -1.5, 1.0, 1.5), 64)
+    return Image.merge("RGB", (gradient, noise, mandel))
+
+
+def psnr(original, quantized):
+    diff = ImageChops.difference(original, quantized.convert("RGB"))
+    mse = sum(v * v for v in ImageStat.Stat(diff).rms) / 3
+    if mse == 0:
+        return float("inf")
+    return 10 * math.log10(255 * 255 / mse)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark da quantização GIF")
+    parser.add_argument("image", nargs="?", help="Imagem de entrada (opcional)")
+    parser.add_argument("--colors", type=int, default=256)
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--json", action="store_true", help="Escreve os resultados em JSON")
+    args = parser.parse_args()
+
+    service = load_image_service()
+    if args.image:
+        with Image.open(args.image) as img:
+            original = img.convert("RGB")
+    else:
+        original = synthetic_image()
+
+    results = []
+    for method in service.GIF_QUANTIZE_METHODS:
+        if method == "libimagequant" and not service.LIBIMAGEQUANT_AVAILABLE:
+            continue
+        for palette_max_side in (0, 1024, 512, 256):
+            for dither in (False, True):
+                timings = []
+                for _ in range(args.repeat):
+                    start = time.perf_counter()
+                    quantized = service.quantize_for_gif(
+                        original, method=method, colors=args.colors,
+                        dither=dither, palette_max_side=palette_max_side,
+                    )
+                    timings.append(time.perf_counter() - start)
+                results.append({
+                    "method": method,
+                    "palette_max_side": palette_max_side,
+                    "dither": dither,
+                    "colors": args.colors,
+                    "seconds": min(timings),
+                    "psnr_db": round(psnr(original, quantized), 2),
+                })
+
+    if args.json:
+        print(json.dumps({"size": original.size, "results": results}, indent=2))
+        return
+    print(f"Imagem {original.size[0]}x{original.size[1]}, {args.colors} cores, melhor de {args.repeat}")
+    print(f"{'método':<14}{'paleta':>8}{'dither':>8}{'tempo (s)':>12}{'PSNR (dB)':>12}")
+    for r in results:
+        side = r["palette_max_side"] or "-"
+        print(f"{r['method']:<14}{side:>8}{str(r['dither']):>8}{r['seconds']:>12.3f}{r['psnr_db']:>12}")
+
+
+if __name__ == "__main__":
+    main()
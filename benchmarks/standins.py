@@ -0,0 +1,180 @@
+"""
+Substitutos locais do Consul e do RabbitMQ para o modo end-to-end dos benchmarks.
+
+- ConsulStandIn: servidor HTTP com o subconjunto da API do agente Consul usado pelo dispatcher
+  e pelos serviços (/v1/agent/services, /v1/health/service/<nome>, registo de serviços).
+- StandInBroker: broker em memória com a parte da API do pika usada no projeto
+  (BlockingConnection, canais, queue_declare, basic_publish/qos/consume/ack, add_callback_threadsafe).
+  Substitui o módulo pika dos serviços carregados no mesmo processo (module.pika = broker.pika).
+"""
+import itertools
+import json
+import queue
+import threading
+import types
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+class ConsulStandIn:
+    def __init__(self, services):
+        """
+        services: {"service-text": ("127.0.0.1", 5001, ["text"]), ...}
+        """
+        self.services = {
+            name: {"ID": name, "Service": name, "Address": address, "Port": port, "Tags": tags}
+            for name, (address, port, tags) in services.items()
+        }
+        standin = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def log_message(self, *args):
+                pass
+
+            def reply(self, body):
+                data = json.dumps(body).encode("utf-8")
+                self.send_response(200)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def do_GET(self):
+                path = self.path.split("?", 1)[0]
+                if path == "/v1/agent/services":
+                    self.reply(standin.services)
+                elif path.startswith("/v1/health/service/"):
+                    name = path.rsplit("/", 1)[-1]
+                    service = standin.services.get(name)
+                    checks = [{"Status": "passing", "ServiceName": name}]
+                    self.reply([{"Node": {"Node": "local"}, "Service": service, "Checks": checks}] if service else [])
+                else:
+                    self.send_error(404)
+
+            def do_PUT(self):
+                length = int(self.headers.get("Content-Length") or 0)
+                self.rfile.read(length)
+                self.reply(True)
+
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.address = f"127.0.0.1:{self.server.server_address[1]}"
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+    def close(self):
+        self.server.shutdown()
+
+
+class ChannelClosedByBroker(Exception):
+    pass
+
+
+class BasicProperties:
+    def __init__(self, delivery_mode=None, headers=None, **kwargs):
+        self.delivery_mode = delivery_mode
+        self.headers = headers
+
+
+class StandInBroker:
+    def __init__(self):
+        self.queues = {}
+        self.lock = threading.Lock()
+        broker = self
+        self.pika = types.SimpleNamespace(
+            BlockingConnection=lambda parameters=None: StandInConnection(broker),
+            ConnectionParameters=lambda *args, **kwargs: None,
+            BasicProperties=BasicProperties,
+            exceptions=types.SimpleNamespace(ChannelClosedByBroker=ChannelClosedByBroker),
+        )
+
+    def get_queue(self, name, create=True):
+        with self.lock:
+            if name not in self.queues:
+                if not create:
+                    raise ChannelClosedByBroker(f"NOT_FOUND - no queue '{name}'")
+                self.queues[name] = queue.Queue()
+            return self.queues[name]
+
+
+class StandInConnection:
+    def __init__(self, broker):
+        self.broker = broker
+        self.callbacks = queue.Queue()
+        self.is_open = True
+
+    def channel(self):
+        return StandInChannel(self)
+
+    def add_callback_threadsafe(self, callback):
+        self.callbacks.put(callback)
+
+    def process_callbacks(self, timeout=0):
+        try:
+            callback = self.callbacks.get(timeout=timeout) if timeout else self.callbacks.get_nowait()
+        except queue.Empty:
+            return
+        callback()
+        while True:
+            try:
+                self.callbacks.get_nowait()()
+            except queue.Empty:
+                return
+
+    def close(self):
+        self.is_open = False
+
+
+class StandInChannel:
+    def __init__(self, connection):
+        self.connection = connection
+        self.broker = connection.broker
+        self.is_open = True
+        self.prefetch = 0
+        self.consumers = []
+        self.unacked = 0
+        self.pending = {}  # delivery_tag -> (fila, corpo, propriedades) das mensagens por confirmar
+        self.tags = itertools.count(1)
+
+    def queue_declare(self, queue, durable=False, passive=False, arguments=None):
+        q = self.broker.get_queue(queue, create=not passive)
+        method = types.SimpleNamespace(queue=queue, message_count=q.qsize(), consumer_count=0)
+        return types.SimpleNamespace(method=method)
+
+    def basic_publish(self, exchange, routing_key, body, properties=None):
+        self.broker.get_queue(routing_key).put((body, properties or BasicProperties()))
+
+    def basic_qos(self, prefetch_count=0, global_qos=False):
+        # Um só limite para o canal, com ou sem global_qos (as mensagens são entregues por uma única thread)
+        self.prefetch = prefetch_count
+
+    def basic_consume(self, queue, on_message_callback, auto_ack=False):
+        self.consumers.append((queue, self.broker.get_queue(queue), on_message_callback))
+
+    def basic_ack(self, delivery_tag=None):
+        self.pending.pop(delivery_tag, None)
+        self.unacked -= 1
+
+    def basic_nack(self, delivery_tag=None, requeue=True):
+        q, body, properties = self.pending.pop(delivery_tag)
+        self.unacked -= 1
+        if requeue:
+            q.put((body, properties))
+
+    def start_consuming(self):
+        consumers = itertools.cycle(self.consumers)
+        while self.connection.is_open:
+            self.connection.process_callbacks()
+            if self.prefetch and self.unacked >= self.prefetch:
+                # À espera de acks (feitos na thread da ligação através de add_callback_threadsafe)
+                self.connection.process_callbacks(timeout=0.05)
+                continue
+            queue_name, q, on_message = next(consumers)
+            try:
+                body, properties = q.get(timeout=0.01)
+            except queue.Empty:
+                continue
+            self.unacked += 1
+            method = types.SimpleNamespace(delivery_tag=next(self.tags), routing_key=queue_name)
+            self.pending[method.delivery_tag] = (q, body, properties)
+            on_message(self, method, properties, body)
+
+    def close(self):
+        self.is_open = False
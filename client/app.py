@@ -4,13 +4,35 @@ import requests
 import os
 import logging
 import threading
-from flask import Flask, request as flask_request
+from flask import Flask, Request, request as flask_request
 import socket
 import tempfile
+import hashlib
+import shutil
+import sys
+import time
+import uuid
+import argparse
+import json
+import concurrent.futures
+import urllib3
+from requests.adapters import HTTPAdapter
+from urllib.parse import unquote
+from werkzeug.utils import secure_filename
+from werkzeug.serving import make_server
+import queue
 
 DISPATCHER_URL = "https://localhost:5000/convert"
+BLOBS_URL = "https://localhost:5000/blobs"
+JOBS_URL = "https://localhost:5000/jobs"
 USERNAME = os.getenv("BASIC_AUTH_USERNAME", "admin")
 PASSWORD = os.getenv("BASIC_AUTH_PASSWORD", "admin_password")
+# Pedidos recusados por sobrecarga (429/503) são repetidos após o Retry-After indicado pelo dispatcher
+SUBMIT_MAX_RETRIES = int(os.getenv("SUBMIT_MAX_RETRIES", "5"))
+SUBMIT_RETRY_AFTER_MAX = 60
+# Um pedido que falha num serviço não chega ao callback: o modo headless consulta /jobs/<id> com este intervalo
+JOB_POLL_INTERVAL = float(os.getenv("JOB_POLL_INTERVAL", "10"))
+JOB_FAILED_STATES = ("failed", "delivery_failed")
 
 CONVERSION_MAP = {
     "docx": ["pdf", "png"],
@@ -79,43 +101,94 @@ def update_formats(*args):
         segmented_btn.configure(state="disabled")
     logging.info(f"Ficheiro selecionado: {file_path} | Extensão: {ext} | Opções: {valid_formats}")
 
-def convert_file_thread():
-    file_path = file_var.get()
-    target_format = format_var.get().replace(".", "")
-    dest_folder = dest_folder_var.get()
-    if not file_path or not target_format:
-        messagebox.showerror("Erro", "Seleciona um ficheiro e formato de destino.")
-        hide_progress()
-        return
-
+def file_sha256(path, block_size=1024 * 1024):
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(block_size), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+def blob_exists(sha256, http=requests, **kwargs):
+    """
+    Pergunta ao dispatcher se já tem um ficheiro com este conteúdo (HEAD /blobs/<sha256>).
+    Em caso de erro assume que não, e o ficheiro é enviado normalmente.
+    """
+    try:
+        resp = http.head(f"{BLOBS_URL}/{sha256}", timeout=30, **kwargs)
+        return resp.status_code == 200
+    except requests.RequestException as e:
+        logging.warning(f"Não foi possível verificar o conteúdo {sha256} no dispatcher: {e}")
+        return False
+
+def save_inline_result(resp, folder, original_file, target_format):
+    """
+    Guarda o resultado de uma conversão feita no fast path (resposta 200 do dispatcher) na pasta indicada.
+    """
+    os.makedirs(folder, exist_ok=True)
+    stem = os.path.splitext(os.path.basename(original_file))[0]
+    save_path = os.path.join(folder, stem + get_response_extension(resp, original_file, target_format))
+    with open(save_path, "wb") as f:
+        for chunk in resp.iter_content(64 * 1024):
+            f.write(chunk)
+    return save_path
+
+def convert_file_thread(file_path, target_format, dest_folder):
+    """
+    Corre numa thread à parte: as mensagens e os widgets só são atualizados na thread do Tk (run_on_gui).
+    """
     try:
-        with open(file_path, "rb") as f:
-            files = {"file": (os.path.basename(file_path), f)}
-            # Adiciona o callback_url ao data
-            callback_url = f"http://host.docker.internal:{CALLBACK_PORT}/callback"
-            data = {"target_format": target_format, "callback_url": callback_url}
+        # Adiciona o callback_url ao data
+        callback_url = f"http://host.docker.internal:{CALLBACK_PORT}/callback"
+        # inline: conversões pequenas vêm logo na resposta (200), as restantes seguem pela fila (202)
+        data = {"target_format": target_format, "callback_url": callback_url, "inline": "true"}
+        # Se o dispatcher já tiver este conteúdo, o pedido é feito por referência (sem reenviar o ficheiro)
+        sha256 = file_sha256(file_path)
+        resp = None
+        if blob_exists(sha256, auth=(USERNAME, PASSWORD), verify=False):
             resp = requests.post(
                 DISPATCHER_URL,
-                files=files,
-                data=data,
+                data={**data, "blob_sha256": sha256, "filename": os.path.basename(file_path)},
                 auth=(USERNAME, PASSWORD),
                 verify=False,
                 timeout=120
             )
+            logging.info(f"Pedido por referência ao conteúdo {sha256}: status_code={resp.status_code}")
+        if resp is None or resp.status_code == 404:
+            with open(file_path, "rb") as f:
+                files = {"file": (os.path.basename(file_path), f)}
+                resp = requests.post(
+                    DISPATCHER_URL,
+                    files=files,
+                    data=data,
+                    auth=(USERNAME, PASSWORD),
+                    verify=False,
+                    timeout=120
+                )
         logging.info(f"Resposta recebida do servidor: status_code={resp.status_code}")
-        if resp.status_code == 202:
-            messagebox.showinfo("Info", "Pedido enviado! O ficheiro convertido será recebido automaticamente assim que estiver pronto.")
+        if resp.status_code == 200:
+            save_path = save_inline_result(resp, dest_folder or os.path.dirname(file_path), file_path, target_format)
+            logging.info(f"Conversão imediata guardada em {save_path}")
+            run_on_gui(messagebox.showinfo, "Info", f"Ficheiro convertido guardado em {save_path}")
+        elif resp.status_code == 202:
+            register_job(resp.json().get("job_id", ""), file_path, target_format)
+            run_on_gui(messagebox.showinfo, "Info", "Pedido enviado! O ficheiro convertido será recebido automaticamente assim que estiver pronto.")
         else:
-            messagebox.showerror("Erro", f"Erro na conversão: {resp.text}")
+            run_on_gui(messagebox.showerror, "Erro", f"Erro na conversão: {resp.text}")
     except Exception as e:
         logging.error(f"Erro na conversão: {e}")
-        messagebox.showerror("Erro", str(e))
+        run_on_gui(messagebox.showerror, "Erro", str(e))
     finally:
-        hide_progress()
+        run_on_gui(hide_progress)
 
 def start_conversion():
+    # Os valores da interface são lidos aqui, na thread do Tk, e passados à thread da conversão
+    file_path = file_var.get()
+    target_format = format_var.get().replace(".", "")
+    if not file_path or not target_format:
+        messagebox.showerror("Erro", "Seleciona um ficheiro e formato de destino.")
+        return
     convert_btn.configure(state="disabled")
-    threading.Thread(target=convert_file_thread, daemon=True).start()
+    threading.Thread(target=convert_file_thread, args=(file_path, target_format, dest_folder_var.get()), daemon=True).start()
 
 def browse_file():
     path = filedialog.askopenfilename(
@@ -145,6 +218,19 @@ def hide_progress():
     convert_btn.configure(state="normal")
 
 CALLBACK_PORT = 6000  # Porta onde o callback server vai correr
+CALLBACK_BACKLOG = int(os.getenv("CALLBACK_BACKLOG", "1024"))  # Ligações pendentes aceites pelo callback server
+
+# Envios em blocos (resultados grandes): ficheiros parciais e um lock por envio
+PARTIAL_UPLOAD_DIR = os.path.join(tempfile.gettempdir(), "conv-dist-uploads")
+upload_locks = {}
+upload_locks_guard = threading.Lock()
+# Envios já terminados (upload_id -> tamanho): o HEAD e o PUT de um bloco repetido (resposta final
+# perdida) devolvem o tamanho total em vez de recomeçar do zero e guardar o ficheiro duas vezes
+completed_uploads = {}
+
+def get_upload_lock(upload_id):
+    with upload_locks_guard:
+        return upload_locks.setdefault(upload_id, threading.Lock())
 
 def get_local_ip():
     """Obtém o IP local para o callback_url (usado dentro do Docker)."""
@@ -158,127 +244,644 @@ def get_local_ip():
         s.close()
     return ip
 
-def start_callback_server():
+# Pedidos submetidos pela interface gráfica: job_id -> dados do pedido
+submitted_jobs = {}
+submitted_jobs_lock = threading.Lock()
+# Eventos para a interface gráfica (só a thread do Tk mexe nos widgets)
+gui_events = queue.Queue()
+
+def register_job(job_id, file_path, target_format):
+    with submitted_jobs_lock:
+        submitted_jobs[job_id] = {"path": file_path, "target_format": target_format, "submitted_at": time.monotonic()}
+
+def notify_saved_gui(job_id, save_path):
+    """Chamado pelas threads do servidor de callback: apenas coloca um evento na fila da interface."""
+    with submitted_jobs_lock:
+        job = submitted_jobs.pop(job_id, None)
+    gui_events.put(("saved", job_id, job, save_path))
+
+def run_on_gui(fn, *args):
+    """Chamado por outras threads: fn(*args) corre na thread do Tk, no próximo process_gui_events."""
+    gui_events.put(("call", fn, args))
+
+def process_gui_events():
+    """Corre na thread do Tk: aplica os eventos recebidos por callback sem bloquear as respostas HTTP."""
+    try:
+        while True:
+            event = gui_events.get_nowait()
+            if event[0] == "call":
+                _, fn, args = event
+                try:
+                    fn(*args)
+                except Exception as e:
+                    logging.error(f"Erro ao atualizar a interface: {e}")
+                continue
+            if event[0] != "saved":
+                continue
+            _, job_id, job, save_path = event
+            with submitted_jobs_lock:
+                pending = len(submitted_jobs)
+            status_label.configure(text=f"Último recebido: {os.path.basename(save_path)} | pendentes: {pending}")
+            if job:
+                elapsed = time.monotonic() - job["submitted_at"]
+                messagebox.showinfo(
+                    "Sucesso",
+                    f"{os.path.basename(job['path'])} convertido para {job['target_format']} em {elapsed:.1f}s.\n"
+                    f"Guardado em:\n{save_path}"
+                )
+            else:
+                logging.info(f"Resultado sem pedido associado nesta sessão (job {job_id or '-'}): {save_path}")
+    except queue.Empty:
+        pass
+    root.after(100, process_gui_events)
+
+def start_callback_server(port=CALLBACK_PORT, get_dest_folder=None, on_saved=None):
+    """
+    Servidor HTTP local (multi-thread) que recebe os ficheiros convertidos.
+    Os corpos são escritos diretamente em disco, na pasta de destino, e associados ao pedido pelo
+    cabeçalho X-Job-Id. get_dest_folder(job_id) devolve a pasta onde guardar e on_saved(job_id, save_path)
+    é chamado depois de cada ficheiro guardado; por omissão usa a pasta escolhida na interface gráfica.
+    """
+    get_dest_folder = get_dest_folder or (lambda job_id: dest_folder_var.get())
+    on_saved = on_saved or notify_saved_gui
+
+    class StreamingRequest(Request):
+        # O ficheiro do multipart é escrito logo num ficheiro temporário na pasta de destino,
+        # para depois ser apenas renomeado (sem cópias nem buffers em memória)
+        def _get_file_stream(self, total_content_length, content_type, filename=None, content_length=None):
+            folder = get_dest_folder(self.headers.get("X-Job-Id", ""))
+            os.makedirs(folder, exist_ok=True)
+            stream = tempfile.NamedTemporaryFile("wb+", dir=folder, prefix=".recv-", suffix=".part", delete=False)
+            self.temp_files = getattr(self, "temp_files", []) + [stream]
+            return stream
+
     app_cb = Flask("callback_server")
+    app_cb.request_class = StreamingRequest
+
+    @app_cb.teardown_request
+    def remove_temp_files(exc):
+        # Ficheiros temporários que não chegaram a ser renomeados (erro ou ligação cortada a meio)
+        for stream in getattr(flask_request, "temp_files", []):
+            try:
+                stream.close()
+                os.remove(stream.name)
+            except OSError:
+                pass
 
     @app_cb.route("/callback", methods=["POST"])
     def callback():
         if 'file' not in flask_request.files:
             return "No file received", 400
         file = flask_request.files['file']
-        filename = file.filename or "ficheiro_convertido"
+        filename = os.path.basename(file.filename or "") or "ficheiro_convertido"
+        job_id = flask_request.headers.get("X-Job-Id", "")
         # Usa a pasta escolhida pelo utilizador
-        save_path = os.path.join(dest_folder_var.get(), filename)
-        file.save(save_path)
-        messagebox.showinfo("Sucesso", f"Ficheiro convertido recebido e guardado em:\n{save_path}")
-        logging.info(f"Ficheiro recebido por callback e guardado em: {save_path}")
+        save_path = os.path.join(get_dest_folder(job_id), filename)
+        temp_path = file.stream.name
+        file.stream.close()
+        os.replace(temp_path, save_path)
+        trace_id = flask_request.headers.get("X-Trace-Id", "-")
+        logging.info(f"Ficheiro recebido por callback (job {job_id or '-'}, trace {trace_id}) e guardado em: {save_path}")
+        on_saved(job_id, save_path)
         return "OK", 200
 
-    app_cb.run(host="0.0.0.0", port=CALLBACK_PORT, debug=False, use_reloader=False)
+    # --- Envio em blocos retomável (resultados grandes) ---
+    # HEAD devolve o offset já recebido; PUT acrescenta um bloco no offset indicado, verificando o SHA-256.
+    @app_cb.route("/callback/chunks/<upload_id>", methods=["HEAD"])
+    def chunk_status(upload_id):
+        upload_id = secure_filename(upload_id)
+        if upload_id in completed_uploads:
+            return "", 200, {"Upload-Offset": str(completed_uploads[upload_id])}
+        part_path = os.path.join(PARTIAL_UPLOAD_DIR, upload_id + ".part")
+        offset = os.path.getsize(part_path) if os.path.exists(part_path) else 0
+        return "", 200, {"Upload-Offset": str(offset)}
+
+    @app_cb.route("/callback/chunks/<upload_id>", methods=["PUT"])
+    def chunk_upload(upload_id):
+        upload_id = secure_filename(upload_id)
+        try:
+            offset = int(flask_request.headers["Upload-Offset"])
+            total = int(flask_request.headers["Upload-Length"])
+            expected_sha256 = flask_request.headers["X-Chunk-SHA256"].lower()
+        except (KeyError, ValueError):
+            return "Missing or invalid upload headers", 400
+        filename = os.path.basename(unquote(flask_request.headers.get("X-Filename", ""))) or "ficheiro_convertido"
+        os.makedirs(PARTIAL_UPLOAD_DIR, exist_ok=True)
+        part_path = os.path.join(PARTIAL_UPLOAD_DIR, upload_id + ".part")
+
+        with get_upload_lock(upload_id):
+            if upload_id in completed_uploads:
+                return "Upload already complete", 409, {"Upload-Offset": str(completed_uploads[upload_id])}
+            current = os.path.getsize(part_path) if os.path.exists(part_path) else 0
+            if offset != current:
+                return "Offset mismatch", 409, {"Upload-Offset": str(current)}
+            digest = hashlib.sha256()
+            with open(part_path, "ab") as f:
+                while True:
+                    block = flask_request.stream.read(64 * 1024)
+                    if not block:
+                        break
+                    digest.update(block)
+                    f.write(block)
+            received = os.path.getsize(part_path)
+            if digest.hexdigest() != expected_sha256 or received > total:
+                # Bloco corrompido: descarta-o e mantém o offset anterior
+                with open(part_path, "r+b") as f:
+                    f.truncate(current)
+                return "Checksum mismatch", 422, {"Upload-Offset": str(current)}
+            if received < total:
+                return "", 200, {"Upload-Offset": str(received)}
+            job_id = flask_request.headers.get("X-Job-Id", upload_id)
+            save_path = os.path.join(get_dest_folder(job_id), filename)
+            shutil.move(part_path, save_path)
+            completed_uploads[upload_id] = total
+
+        trace_id = flask_request.headers.get("X-Trace-Id", "-")
+        logging.info(f"Ficheiro recebido por callback em blocos (job {job_id}, trace {trace_id}) e guardado em: {save_path}")
+        on_saved(job_id, save_path)
+        return "", 201, {"Upload-Offset": str(total)}
+
+    # Uma thread por pedido e uma fila de ligações maior, para absorver muitas entregas em simultâneo
+    server = make_server("0.0.0.0", port, app_cb, threaded=True)
+    server.socket.listen(CALLBACK_BACKLOG)
+    logging.info(f"Servidor de callback a escutar na porta {port}")
+    server.serve_forever()
+
+# --- Modo headless (linha de comandos) para conversões em massa ---
+class MultipartUploadStream:
+    """
+    Corpo multipart/form-data (campos + ficheiro) gerado em streaming a partir do disco,
+    com Content-Length conhecido, sem carregar o ficheiro em memória.
+    """
+    def __init__(self, path, fields, field="file", block_size=64 * 1024):
+        self.boundary = uuid.uuid4().hex
+        self.path = path
+        self.block_size = block_size
+        parts = []
+        for name, value in fields.items():
+            parts.append(
+                f"--{self.boundary}\r\n"
+                f'Content-Disposition: form-data; name="{name}"\r\n\r\n'
+                f"{value}\r\n"
+            )
+        filename = os.path.basename(path).replace('"', "")
+        parts.append(
+            f"--{self.boundary}\r\n"
+            f'Content-Disposition: form-data; name="{field}"; filename="{filename}"\r\n'
+            "Content-Type: application/octet-stream\r\n\r\n"
+        )
+        self.head = "".join(parts).encode("utf-8")
+        self.tail = f"\r\n--{self.boundary}--\r\n".encode("utf-8")
+        self.file_size = os.path.getsize(path)
+        self.size = len(self.head) + self.file_size + len(self.tail)
+
+    @property
+    def content_type(self):
+        return f"multipart/form-data; boundary={self.boundary}"
+
+    def __len__(self):
+        return self.size
+
+    def __iter__(self):
+        yield self.head
+        with open(self.path, "rb") as f:
+            while True:
+                block = f.read(self.block_size)
+                if not block:
+                    break
+                yield block
+        yield self.tail
+
+def output_name(path, ext):
+    """
+    Nome do resultado: o do original com a nova extensão. Se outro ficheiro convertível da mesma
+    pasta tiver o mesmo nome (ex: a.jpg e a.gif), mantém a extensão original (a.jpg.png, a.gif.png)
+    para que os resultados não se sobreponham.
+    """
+    folder, name = os.path.split(path)
+    stem = os.path.splitext(name)[0]
+    siblings = [
+        other for other in os.listdir(folder or ".")
+        if other != name and os.path.splitext(other)[0] == stem and get_file_extension(other) in CONVERSION_MAP
+    ]
+    return f"{name}{ext}" if siblings else f"{stem}{ext}"
+
+def percentile(values, pct):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    index = min(len(values) - 1, max(0, int(round(pct / 100 * (len(values) - 1)))))
+    return values[index]
+
+class BulkConversion:
+    """
+    Estado de uma conversão em massa: pedidos submetidos, resultados recebidos e estatísticas.
+    """
+    def __init__(self, src_dir, dest_dir):
+        self.src_dir = src_dir
+        self.dest_dir = dest_dir
+        self.incoming_dir = os.path.join(dest_dir, ".incoming")
+        self.lock = threading.Lock()
+        self.jobs = {}            # job_id -> dados do pedido
+        self.early_results = {}   # resultados que chegaram antes da resposta 202
+        self.done = threading.Event()
+        self.total = 0
+        self.submitted = 0
+        self.failed = 0
+        self.received = 0
+        self.bytes_up = 0
+        self.bytes_deduped = 0    # bytes não enviados por o dispatcher já ter o conteúdo
+        self.bytes_down = 0
+        self.latencies = []
+        self.upload_latencies = []
+        self.started = time.monotonic()
+
+    def dest_folder(self, job_id):
+        folder = os.path.join(self.incoming_dir, secure_filename(job_id) or "sem-id")
+        os.makedirs(folder, exist_ok=True)
+        return folder
+
+    def register(self, job_id, job):
+        with self.lock:
+            self.jobs[job_id] = job
+            self.submitted += 1
+            early = self.early_results.pop(job_id, None)
+        if early:
+            self.on_saved(job_id, early)
+
+    def mark_failed(self):
+        with self.lock:
+            self.failed += 1
+            self.check_done()
+
+    def mark_job_failed(self, job_id, status):
+        with self.lock:
+            job = self.jobs.get(job_id)
+            if job is None or job.get("received_at") or job.get("failed_status"):
+                return
+            job["failed_status"] = status
+            self.failed += 1
+            self.check_done()
+        logging.error(f"Conversão falhada ({status}): {job['path']}")
+
+    def outstanding(self):
+        """
+        Pedidos aceites pelo dispatcher que ainda não têm resultado nem falha registada.
+        """
+        with self.lock:
+            return [
+                job_id for job_id, job in self.jobs.items()
+                if not job.get("received_at") and not job.get("failed_status") and not job_id.startswith("inline-")
+            ]
+
+    def on_saved(self, job_id, save_path):
+        with self.lock:
+            job = self.jobs.get(job_id)
+            if job is None:
+                self.early_results[job_id] = save_path
+                return
+            if job.get("received_at") or job.get("failed_status"):
+                return
+            job["received_at"] = time.monotonic()
+            self.received += 1
+            self.bytes_down += os.path.getsize(save_path)
+            self.latencies.append(job["received_at"] - job["submitted_at"])
+            self.check_done()
+        # Coloca o resultado no caminho equivalente ao do ficheiro original
+        rel_dir = os.path.dirname(os.path.relpath(job["path"], self.src_dir))
+        final_dir = os.path.join(self.dest_dir, rel_dir)
+        os.makedirs(final_dir, exist_ok=True)
+        shutil.move(save_path, os.path.join(final_dir, output_name(job["path"], os.path.splitext(save_path)[1])))
+        shutil.rmtree(os.path.dirname(save_path), ignore_errors=True)
+
+    def check_done(self):
+        if self.received + self.failed >= self.total:
+            self.done.set()
+
+    def progress_line(self):
+        elapsed = max(time.monotonic() - self.started, 1e-6)
+        with self.lock:
+            latencies = list(self.latencies)
+            received, submitted, failed = self.received, self.submitted, self.failed
+            bytes_up, bytes_down = self.bytes_up, self.bytes_down
+        return (
+            f"[{received}/{self.total}] submetidos={submitted} falhados={failed} "
+            f"{received / elapsed:.2f} fich/s | up {bytes_up / elapsed / 1e6:.2f} MB/s "
+            f"| down {bytes_down / elapsed / 1e6:.2f} MB/s | p50 {percentile(latencies, 50):.2f}s"
+        )
+
+    def summary(self):
+        elapsed = max(time.monotonic() - self.started, 1e-6)
+        lines = [
+            "",
+            "=== Resumo ===",
+            f"Ficheiros: {self.total} | convertidos: {self.received} | falhados: {self.failed} | sem resultado: {self.total - self.received - self.failed}",
+            f"Tempo total: {elapsed:.1f}s | débito: {self.received / elapsed:.2f} ficheiros/s",
+            f"Enviado: {self.bytes_up / 1e6:.1f} MB ({self.bytes_up / elapsed / 1e6:.2f} MB/s) | recebido: {self.bytes_down / 1e6:.1f} MB ({self.bytes_down / elapsed / 1e6:.2f} MB/s)",
+            f"Não reenviado (conteúdo já no dispatcher): {self.bytes_deduped / 1e6:.1f} MB",
+        ]
+        for label, values in (("Latência total (envio -> resultado)", self.latencies), ("Latência do upload", self.upload_latencies)):
+            if values:
+                lines.append(
+                    f"{label}: p50 {percentile(values, 50):.2f}s | p90 {percentile(values, 90):.2f}s | "
+                    f"p99 {percentile(values, 99):.2f}s | máx {max(values):.2f}s"
+                )
+        # Pedidos mais lentos, com o trace_id para procurar os spans de cada etapa
+        with self.lock:
+            finished = [job for job in self.jobs.values() if job.get("received_at")]
+        slowest = sorted(finished, key=lambda job: job["received_at"] - job["submitted_at"], reverse=True)[:5]
+        if slowest:
+            lines.append("Pedidos mais lentos (latência | trace_id | ficheiro):")
+            for job in slowest:
+                lines.append(
+                    f"  {job['received_at'] - job['submitted_at']:.2f}s | {job.get('trace_id') or '-'} | "
+                    f"{os.path.relpath(job['path'], self.src_dir)}"
+                )
+        return "\n".join(lines)
+
+def collect_files(src_dir, target_formats=None):
+    """
+    Percorre a pasta e devolve (caminho, formato de destino) para cada ficheiro convertível
+    segundo o CONVERSION_MAP. Com vários formatos pedidos, o destino de cada ficheiro é a lista
+    dos que são possíveis para a sua extensão (um só pedido com várias saídas).
+    """
+    found = []
+    for dirpath, _, filenames in os.walk(src_dir):
+        for name in sorted(filenames):
+            path = os.path.join(dirpath, name)
+            valid_formats = CONVERSION_MAP.get(get_file_extension(path), [])
+            if not valid_formats:
+                continue
+            if target_formats:
+                formats = [f for f in target_formats if f in valid_formats]
+                if not formats:
+                    logging.info(f"Ignorado (sem conversão para {', '.join(target_formats)}): {path}")
+                    continue
+                found.append((path, formats[0] if len(formats) == 1 else formats))
+            else:
+                found.append((path, valid_formats[0]))
+    return found
+
+def submit_file(session, bulk, path, target_format, callback_url, inline=False):
+    if isinstance(target_format, list):
+        # Vários formatos de destino: um só pedido, entregue num ZIP com todas as saídas
+        fields = {"outputs": json.dumps([{"format": f} for f in target_format]), "callback_url": callback_url}
+    else:
+        fields = {"target_format": target_format, "callback_url": callback_url}
+    if inline:
+        fields["inline"] = "true"
+    started = time.monotonic()
+    for attempt in range(SUBMIT_MAX_RETRIES + 1):
+        try:
+            # Conteúdo já conhecido pelo dispatcher: pedido por referência, sem enviar o ficheiro
+            sha256 = file_sha256(path)
+            resp = None
+            uploaded = 0
+            if blob_exists(sha256, http=session):
+                resp = session.post(
+                    DISPATCHER_URL,
+                    data={**fields, "blob_sha256": sha256, "filename": os.path.basename(path)},
+                    timeout=120,
+                )
+            if resp is None or resp.status_code == 404:
+                body = MultipartUploadStream(path, fields)
+                resp = session.post(DISPATCHER_URL, data=body, headers={"Content-Type": body.content_type}, timeout=120)
+                uploaded = body.file_size
+        except Exception as e:
+            logging.error(f"Erro ao enviar {path}: {e}")
+            bulk.mark_failed()
+            return
+        # Dispatcher sobrecarregado: espera o tempo indicado em Retry-After e tenta de novo
+        if resp.status_code not in (429, 503) or attempt == SUBMIT_MAX_RETRIES:
+            break
+        try:
+            retry_after = min(int(resp.headers.get("Retry-After", "5")), SUBMIT_RETRY_AFTER_MAX)
+        except ValueError:
+            retry_after = 5
+        logging.warning(f"Dispatcher sobrecarregado ({resp.status_code}), nova tentativa de {path} dentro de {retry_after}s.")
+        time.sleep(retry_after)
+    if resp.status_code == 200:
+        # Convertido no fast path: o resultado veio na resposta, sem job nem callback
+        job_id = f"inline-{uuid.uuid4().hex}"
+        save_path = save_inline_result(resp, bulk.dest_folder(job_id), path, target_format)
+        with bulk.lock:
+            bulk.bytes_up += uploaded
+        bulk.register(job_id, {"path": path, "submitted_at": started, "trace_id": resp.headers.get("X-Trace-Id")})
+        bulk.on_saved(job_id, save_path)
+        return
+    if resp.status_code != 202:
+        logging.error(f"Pedido recusado para {path}: {resp.status_code} {resp.text}")
+        bulk.mark_failed()
+        return
+    job_id = resp.json().get("job_id")
+    trace_id = resp.json().get("trace_id")
+    with bulk.lock:
+        bulk.bytes_up += uploaded
+        if not uploaded:
+            bulk.bytes_deduped += os.path.getsize(path)
+        bulk.upload_latencies.append(time.monotonic() - started)
+    bulk.register(job_id, {"path": path, "submitted_at": started, "trace_id": trace_id})
+
+def poll_jobs(session, bulk):
+    """
+    Consulta o estado dos pedidos ainda sem resultado e conta como falhados os que terminaram em erro.
+    """
+    for job_id in bulk.outstanding():
+        try:
+            resp = session.get(f"{JOBS_URL}/{job_id}", timeout=10)
+            status = resp.json().get("status") if resp.status_code == 200 else None
+        except Exception as e:
+            logging.warning(f"Erro ao consultar o pedido {job_id}: {e}")
+            continue
+        if status in JOB_FAILED_STATES:
+            bulk.mark_job_failed(job_id, status)
+
+def run_headless(args):
+    """
+    Converte todos os ficheiros de uma pasta (recursivamente) sem interface gráfica,
+    com concorrência limitada e uma sessão HTTP keep-alive partilhada.
+    """
+    files = collect_files(args.src, args.to)
+    if not files:
+        print("Nenhum ficheiro para converter.")
+        return 1
+    os.makedirs(args.dest, exist_ok=True)
+    bulk = BulkConversion(args.src, args.dest)
+    bulk.total = len(files)
+
+    threading.Thread(
+        target=start_callback_server,
+        kwargs={"port": args.callback_port, "get_dest_folder": bulk.dest_folder, "on_saved": bulk.on_saved},
+        daemon=True,
+    ).start()
+    callback_url = f"http://{args.callback_host}:{args.callback_port}/callback"
+
+    urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
+    session = requests.Session()
+    session.auth = (USERNAME, PASSWORD)
+    session.verify = False
+    session.mount("https://", HTTPAdapter(pool_connections=1, pool_maxsize=args.concurrency))
+
+    def report_progress():
+        while not bulk.done.wait(1):
+            sys.stdout.write("\r" + bulk.progress_line())
+            sys.stdout.flush()
+
+    threading.Thread(target=report_progress, daemon=True).start()
+    print(f"A converter {bulk.total} ficheiros de {args.src} para {args.dest} (concorrência {args.concurrency})")
+    with concurrent.futures.ThreadPoolExecutor(max_workers=args.concurrency) as executor:
+        futures = {
+            executor.submit(submit_file, session, bulk, path, target_format, callback_url, args.inline): path
+            for path, target_format in files
+        }
+    for future, path in futures.items():
+        if future.exception():
+            logging.error(f"Erro ao submeter {path}: {future.exception()}")
+            bulk.mark_failed()
+    deadline = time.monotonic() + args.timeout
+    while not bulk.done.wait(min(JOB_POLL_INTERVAL, max(deadline - time.monotonic(), 0))):
+        if time.monotonic() >= deadline:
+            logging.warning("Tempo limite atingido antes de receber todos os resultados.")
+            break
+        poll_jobs(session, bulk)
+    print("\r" + bulk.progress_line())
+    print(bulk.summary())
+    shutil.rmtree(bulk.incoming_dir, ignore_errors=True)
+    return 0 if bulk.received == bulk.total else 2
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Conversor de ficheiros distribuído")
+    parser.add_argument("--headless", action="store_true", help="Modo linha de comandos (sem interface gráfica)")
+    parser.add_argument("--src", help="Pasta com os ficheiros a converter (percorrida recursivamente)")
+    parser.add_argument("--dest", help="Pasta onde guardar os ficheiros convertidos")
+    parser.add_argument("--to", help="Formato(s) de destino, separados por vírgulas (ex: pdf,png; por omissão, o primeiro possível para cada extensão)")
+    parser.add_argument("--concurrency", type=int, default=8, help="Uploads em simultâneo")
+    parser.add_argument("--callback-host", default="host.docker.internal", help="Host usado no callback_url")
+    parser.add_argument("--callback-port", type=int, default=CALLBACK_PORT)
+    parser.add_argument("--inline", action="store_true", help="Pede o fast path síncrono do dispatcher para ficheiros pequenos")
+    parser.add_argument("--timeout", type=float, default=3600, help="Tempo máximo (s) à espera dos resultados")
+    args = parser.parse_args()
+    if args.headless and not (args.src and args.dest):
+        parser.error("--headless requer --src e --dest")
+    if args.to:
+        args.to = [f.strip().lstrip(".") for f in args.to.lower().split(",") if f.strip()]
+    return args
 
 # --- Interface gráfica minimalista ---
-ctk.set_appearance_mode("dark")
-ctk.set_default_color_theme("green")  # Escolha um tema mais suave/minimalista
-
-root = ctk.CTk()
-root.title("Conversor de Ficheiros")
-root.geometry("420x280")
-root.resizable(False, False)
-
-main_frame = ctk.CTkFrame(root, fg_color="#242424", corner_radius=12)
-main_frame.pack(fill="both", expand=True, padx=18, pady=18)
-
-file_var = ctk.StringVar()
-format_var = ctk.StringVar()
-dest_folder_var = ctk.StringVar(value=os.path.expanduser("~/Downloads"))
-
-# Ficheiro
-file_label = ctk.CTkLabel(main_frame, text="Selecionar ficheiro", font=("Segoe UI", 15, "bold"), text_color="#FFFFFF")
-file_label.grid(row=0, column=0, sticky="w", pady=(0, 2), padx=(2,0), columnspan=2)
-
-file_entry = ctk.CTkEntry(main_frame, textvariable=file_var, width=220, font=("Segoe UI", 13), border_width=1, corner_radius=8)
-file_entry.grid(row=1, column=0, padx=(0, 8), pady=(0, 10), sticky="ew")
-
-browse_btn = ctk.CTkButton(
-    main_frame,
-    text="Procurar",
-    command=browse_file,
-    width=80,
-    fg_color="#1F6AA5",
-    hover_color="#033E6D",
-    text_color="white",
-    font=("Segoe UI", 13),
-    corner_radius=8
-)
-browse_btn.grid(row=1, column=1, padx=(0, 0), pady=(0, 10))
-
-# Formato destino
-format_label = ctk.CTkLabel(main_frame, text="Formato de destino", font=("Segoe UI", 15, "bold"), text_color="#FFFFFF")
-format_label.grid(row=2, column=0, sticky="w", pady=(0, 2), padx=(2,0), columnspan=2)
-
-segmented_btn = ctk.CTkSegmentedButton(
-    main_frame,
-    variable=format_var,
-    values=[],
-    font=("Segoe UI", 13),
-    width=180,
-    state="disabled",
-    corner_radius=8,
-    fg_color="#52575A",
-    selected_color="#1F6AA5",
-    selected_hover_color="#033E6D",
-    unselected_color="#52575A",
-    unselected_hover_color="#343638"
-)
-segmented_btn.grid(row=3, column=0, columnspan=2, padx=(0,0), pady=(0, 10), sticky="ew")
-
-# Pasta de destino
-dest_folder_label = ctk.CTkLabel(main_frame, text="Pasta de destino", font=("Segoe UI", 13), text_color="#FFFFFF")
-dest_folder_label.grid(row=4, column=0, sticky="w", padx=(2,0), pady=(0,2), columnspan=2)
-
-dest_folder_entry = ctk.CTkEntry(main_frame, textvariable=dest_folder_var, width=220, font=("Segoe UI", 12), border_width=1, corner_radius=8)
-dest_folder_entry.grid(row=5, column=0, padx=(0, 8), pady=(0, 10), sticky="ew")
-
-choose_folder_btn = ctk.CTkButton(
-    main_frame,
-    text="Escolher pasta",
-    command=choose_dest_folder,
-    width=80,
-    fg_color="#1F6AA5",
-    hover_color="#033E6D",
-    text_color="white",
-    font=("Segoe UI", 12),
-    corner_radius=8
-)
-choose_folder_btn.grid(row=5, column=1, padx=(0, 0), pady=(0, 10))
-
-# Botão converter
-convert_btn = ctk.CTkButton(
-    main_frame,
-    text="Converter",
-    command=start_conversion,
-    width=180,
-    font=("Segoe UI", 14, "bold"),
-    fg_color="#1F6AA5",
-    hover_color="#033E6D",
-    text_color="white",
-    corner_radius=12
-)
-convert_btn.grid(row=6, column=0, columnspan=2, pady=12, sticky="ew")
+def build_gui():
+    global root, file_var, format_var, dest_folder_var, segmented_btn, convert_btn, progress_bar, progress_label, status_label
+    ctk.set_appearance_mode("dark")
+    ctk.set_default_color_theme("green")  # Escolha um tema mais suave/minimalista
+
+    root = ctk.CTk()
+    root.title("Conversor de Ficheiros")
+    root.geometry("420x310")
+    root.resizable(False, False)
+
+    main_frame = ctk.CTkFrame(root, fg_color="#242424", corner_radius=12)
+    main_frame.pack(fill="both", expand=True, padx=18, pady=18)
+
+    file_var = ctk.StringVar()
+    format_var = ctk.StringVar()
+    dest_folder_var = ctk.StringVar(value=os.path.expanduser("~/Downloads"))
+
+    # Ficheiro
+    file_label = ctk.CTkLabel(main_frame, text="Selecionar ficheiro", font=("Segoe UI", 15, "bold"), text_color="#FFFFFF")
+    file_label.grid(row=0, column=0, sticky="w", pady=(0, 2), padx=(2,0), columnspan=2)
+
+    file_entry = ctk.CTkEntry(main_frame, textvariable=file_var, width=220, font=("Segoe UI", 13), border_width=1, corner_radius=8)
+    file_entry.grid(row=1, column=0, padx=(0, 8), pady=(0, 10), sticky="ew")
+
+    browse_btn = ctk.CTkButton(
+        main_frame,
+        text="Procurar",
+        command=browse_file,
+        width=80,
+        fg_color="#1F6AA5",
+        hover_color="#033E6D",
+        text_color="white",
+        font=("Segoe UI", 13),
+        corner_radius=8
+    )
+    browse_btn.grid(row=1, column=1, padx=(0, 0), pady=(0, 10))
+
+    # Formato destino
+    format_label = ctk.CTkLabel(main_frame, text="Formato de destino", font=("Segoe UI", 15, "bold"), text_color="#FFFFFF")
+    format_label.grid(row=2, column=0, sticky="w", pady=(0, 2), padx=(2,0), columnspan=2)
+
+    segmented_btn = ctk.CTkSegmentedButton(
+        main_frame,
+        variable=format_var,
+        values=[],
+        font=("Segoe UI", 13),
+        width=180,
+        state="disabled",
+        corner_radius=8,
+        fg_color="#52575A",
+        selected_color="#1F6AA5",
+        selected_hover_color="#033E6D",
+        unselected_color="#52575A",
+        unselected_hover_color="#343638"
+    )
+    segmented_btn.grid(row=3, column=0, columnspan=2, padx=(0,0), pady=(0, 10), sticky="ew")
+
+    # Pasta de destino
+    dest_folder_label = ctk.CTkLabel(main_frame, text="Pasta de destino", font=("Segoe UI", 13), text_color="#FFFFFF")
+    dest_folder_label.grid(row=4, column=0, sticky="w", padx=(2,0), pady=(0,2), columnspan=2)
+
+    dest_folder_entry = ctk.CTkEntry(main_frame, textvariable=dest_folder_var, width=220, font=("Segoe UI", 12), border_width=1, corner_radius=8)
+    dest_folder_entry.grid(row=5, column=0, padx=(0, 8), pady=(0, 10), sticky="ew")
+
+    choose_folder_btn = ctk.CTkButton(
+        main_frame,
+        text="Escolher pasta",
+        command=choose_dest_folder,
+        width=80,
+        fg_color="#1F6AA5",
+        hover_color="#033E6D",
+        text_color="white",
+        font=("Segoe UI", 12),
+        corner_radius=8
+    )
+    choose_folder_btn.grid(row=5, column=1, padx=(0, 0), pady=(0, 10))
+
+    # Botão converter
+    convert_btn = ctk.CTkButton(
+        main_frame,
+        text="Converter",
+        command=start_conversion,
+        width=180,
+        font=("Segoe UI", 14, "bold"),
+        fg_color="#1F6AA5",
+        hover_color="#033E6D",
+        text_color="white",
+        corner_radius=12
+    )
+    convert_btn.grid(row=6, column=0, columnspan=2, pady=12, sticky="ew")
+
+    # Barra de progresso (agora em baixo do botão)
+    progress_bar = ctk.CTkProgressBar(main_frame, width=320, height=8, mode="indeterminate", progress_color="#1F6AA5", fg_color="#52575A", corner_radius=4)
+    progress_bar.grid(row=7, column=0, columnspan=2, pady=(2, 0), sticky="ew")
+    progress_bar.grid_remove()
+    progress_label = ctk.CTkLabel(main_frame, text="A converter ficheiro...", font=("Segoe UI", 11), text_color="#666")
+    progress_label.grid(row=8, column=0, columnspan=2, pady=(2, 10))
+    progress_label.grid_remove()
+
+    # Estado dos resultados recebidos por callback
+    status_label = ctk.CTkLabel(main_frame, text="", font=("Segoe UI", 11), text_color="#999")
+    status_label.grid(row=9, column=0, columnspan=2, pady=(0, 4))
 
-# Barra de progresso (agora em baixo do botão)
-progress_bar = ctk.CTkProgressBar(main_frame, width=320, height=8, mode="indeterminate", progress_color="#1F6AA5", fg_color="#52575A", corner_radius=4)
-progress_bar.grid(row=7, column=0, columnspan=2, pady=(2, 0), sticky="ew")
-progress_bar.grid_remove()
-progress_label = ctk.CTkLabel(main_frame, text="A converter ficheiro...", font=("Segoe UI", 11), text_color="#666")
-progress_label.grid(row=8, column=0, columnspan=2, pady=(2, 10))
-progress_label.grid_remove()
+    # Centralizar e espaçar
+    main_frame.grid_columnconfigure(0, weight=1)
+    main_frame.grid_columnconfigure(1, weight=0)
 
-# Centralizar e espaçar
-main_frame.grid_columnconfigure(0, weight=1)
-main_frame.grid_columnconfigure(1, weight=0)
+    root.after(100, process_gui_events)
 
 # --- No início do main ---
 if __name__ == "__main__":
+    args = parse_args()
+    if args.headless:
+        sys.exit(run_headless(args))
+    build_gui()
     threading.Thread(target=start_callback_server, daemon=True).start()
     root.mainloop()
\ No newline at end of file
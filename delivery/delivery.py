@@ -0,0 +1,353 @@
+import os
+import logging
+import json
+import time
+import uuid
+import hashlib
+import functools
+import threading
+import sys
+import concurrent.futures
+from urllib.parse import urlsplit, quote
+
+import pika
+import requests
+from requests.adapters import HTTPAdapter
+from prometheus_client import Counter, Gauge, Histogram, start_http_server
+
+# Código comum aos componentes (pasta shared/ na raiz do repositório; nas imagens Docker é
+# copiada para /opt/shared, que está no PYTHONPATH)
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+from shared.tracing import JobContextFilter, set_log_context, init_tracing, new_span_id, emit_span, trace_context
+from shared.jobs import RESULTS_DIR, DELIVERY_QUEUE, update_job
+
+# Filas de entrega (DELIVERY_QUEUE em shared/jobs.py, onde os serviços publicam os resultados)
+DELIVERY_RETRY_QUEUE = "delivery_retry_queue"          # + ".<atraso em ms>", uma fila por atraso
+DELIVERY_DEAD_LETTER_QUEUE = "delivery_dead_letter_queue"
+
+# DELIVERY_SENDERS: envios em paralelo; DELIVERY_MAX_ATTEMPTS: tentativas antes do dead-letter
+# DELIVERY_BACKOFF_BASE / DELIVERY_BACKOFF_MAX: atraso exponencial entre tentativas (segundos)
+DELIVERY_SENDERS = int(os.getenv("DELIVERY_SENDERS", "8"))
+DELIVERY_MAX_ATTEMPTS = int(os.getenv("DELIVERY_MAX_ATTEMPTS", "6"))
+DELIVERY_BACKOFF_BASE = float(os.getenv("DELIVERY_BACKOFF_BASE", "2"))
+DELIVERY_BACKOFF_MAX = float(os.getenv("DELIVERY_BACKOFF_MAX", "300"))
+DELIVERY_CONNECT_TIMEOUT = float(os.getenv("DELIVERY_CONNECT_TIMEOUT", "5"))
+DELIVERY_READ_TIMEOUT = float(os.getenv("DELIVERY_READ_TIMEOUT", "60"))
+
+# Resultados a partir de DELIVERY_CHUNK_THRESHOLD_MB são enviados em blocos de DELIVERY_CHUNK_SIZE_MB
+# (protocolo retomável com offset e SHA-256 por bloco). Um bloco falhado não é repetido na thread de envio:
+# a mensagem segue para a fila de retry e a tentativa seguinte continua a partir do offset confirmado
+DELIVERY_CHUNK_THRESHOLD = int(float(os.getenv("DELIVERY_CHUNK_THRESHOLD_MB", "8")) * 1024 * 1024)
+DELIVERY_CHUNK_SIZE = int(float(os.getenv("DELIVERY_CHUNK_SIZE_MB", "4")) * 1024 * 1024)
+
+# Porta do endpoint /metrics (Prometheus)
+DELIVERY_METRICS_PORT = int(os.getenv("DELIVERY_METRICS_PORT", "9100"))
+
+# Configuração de logs
+base_log_dir = os.path.abspath(os.path.join(os.path.dirname(__file__), "../logs"))
+if not os.path.exists(base_log_dir):
+    os.makedirs(base_log_dir)
+log_file = os.path.join(base_log_dir, "delivery-logs.txt")
+logging.basicConfig(
+    level=logging.INFO,
+    format="%(asctime)s - %(levelname)s - [%(trace_id)s %(job_id)s] %(message)s",
+    handlers=[
+        logging.FileHandler(log_file),  # Logs para o ficheiro
+        logging.StreamHandler()        # Logs para o terminal
+    ]
+)
+for handler in logging.getLogger().handlers:
+    handler.addFilter(JobContextFilter())
+
+# --- Tracing --- (spans em JSON, ver shared/tracing.py)
+init_tracing("delivery", os.path.join(base_log_dir, "traces", "delivery-spans.jsonl"))
+
+
+# --- Métricas Prometheus ---
+DELIVERY_BUCKETS = (0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+DELIVERY_SECONDS = Histogram("delivery_seconds", "Duração de cada envio bem-sucedido para o callback (segundos)", ["mode"], buckets=DELIVERY_BUCKETS)
+DELIVERY_ATTEMPTS = Counter("delivery_attempts_total", "Tentativas de entrega, por resultado", ["outcome"])
+DELIVERY_BYTES = Counter("delivery_bytes_total", "Bytes de resultados entregues")
+DELIVERIES_IN_FLIGHT = Gauge("delivery_in_flight", "Envios em curso")
+DELIVERY_SENDERS_GAUGE = Gauge("delivery_senders", "Envios em paralelo configurados")
+DELIVERY_SENDERS_GAUGE.set(DELIVERY_SENDERS)
+
+
+class PermanentDeliveryError(Exception):
+    """Falha que não se resolve repetindo o envio (ex: resultado em falta, 4xx do cliente)."""
+
+
+# Uma sessão HTTP (com pool de ligações keep-alive) por host de callback
+sessions = {}
+sessions_lock = threading.Lock()
+
+def get_session(callback_url):
+    parts = urlsplit(callback_url)
+    key = (parts.scheme, parts.netloc)
+    with sessions_lock:
+        session = sessions.get(key)
+        if session is None:
+            session = requests.Session()
+            adapter = HTTPAdapter(pool_connections=1, pool_maxsize=DELIVERY_SENDERS)
+            session.mount(f"{parts.scheme}://{parts.netloc}", adapter)
+            sessions[key] = session
+        return session
+
+def backoff_seconds(attempt):
+    return min(DELIVERY_BACKOFF_MAX, DELIVERY_BACKOFF_BASE * (2 ** (attempt - 1)))
+
+def retry_queue_name(attempt):
+    # O atraso faz parte do nome: mudar DELIVERY_BACKOFF_* cria filas novas em vez de entrar em conflito
+    # (PRECONDITION_FAILED) com o x-message-ttl das filas já declaradas
+    return f"{DELIVERY_RETRY_QUEUE}.{int(backoff_seconds(attempt) * 1000)}"
+
+class MultipartFileStream:
+    """
+    Corpo multipart/form-data gerado em streaming a partir de um ficheiro em disco.
+    O tamanho total é conhecido (Content-Length), mas o ficheiro nunca é carregado inteiro em memória.
+    """
+    def __init__(self, path, filename, field="file", block_size=64 * 1024):
+        self.boundary = uuid.uuid4().hex
+        self.path = path
+        self.block_size = block_size
+        filename = filename.replace('"', "").replace("\r", "").replace("\n", "")
+        self.head = (
+            f"--{self.boundary}\r\n"
+            f'Content-Disposition: form-data; name="{field}"; filename="{filename}"\r\n'
+            "Content-Type: application/octet-stream\r\n\r\n"
+        ).encode("utf-8")
+        self.tail = f"\r\n--{self.boundary}--\r\n".encode("utf-8")
+        self.size = len(self.head) + os.path.getsize(path) + len(self.tail)
+
+    @property
+    def content_type(self):
+        return f"multipart/form-data; boundary={self.boundary}"
+
+    def __len__(self):
+        return self.size
+
+    def __iter__(self):
+        yield self.head
+        with open(self.path, "rb") as f:
+            while True:
+                block = f.read(self.block_size)
+                if not block:
+                    break
+                yield block
+        yield self.tail
+
+def chunk_url(callback_url, upload_id):
+    return f"{callback_url.rstrip('/')}/chunks/{upload_id}"
+
+def remote_offset(session, url, headers):
+    """
+    Pergunta ao cliente quantos bytes do envio já recebeu.
+    Devolve None se o cliente não suporta envios em blocos.
+    """
+    resp = session.head(url, headers=headers, timeout=(DELIVERY_CONNECT_TIMEOUT, DELIVERY_READ_TIMEOUT))
+    if resp.status_code in (404, 405):
+        return None
+    resp.raise_for_status()
+    return int(resp.headers.get("Upload-Offset", 0))
+
+def callback_headers(message, trace):
+    """
+    Cabeçalhos enviados em todos os pedidos ao cliente: job, trace_id e traceparent (W3C).
+    """
+    return {
+        "X-Job-Id": message["job_id"],
+        "X-Trace-Id": trace["trace_id"],
+        "traceparent": f"00-{trace['trace_id']}-{trace['span_id']}-01",
+    }
+
+def deliver_chunked(session, message, result_path, trace):
+    """
+    Envia o resultado em blocos retomáveis: cada bloco leva o offset e o SHA-256.
+    Uma falha termina esta tentativa (a espera é feita na fila de retry, não na thread de envio)
+    e a tentativa seguinte continua a partir do offset confirmado pelo cliente.
+    Devolve False se o cliente não suporta este protocolo.
+    """
+    url = chunk_url(message["callback_url"], message["job_id"])
+    total = os.path.getsize(result_path)
+    base_headers = {**callback_headers(message, trace), "X-Filename": quote(message["filename"])}
+    offset = remote_offset(session, url, base_headers)
+    if offset is None:
+        return False
+    if offset:
+        logging.info(f"Pedido {message['job_id']}: a retomar envio em {offset}/{total} bytes")
+
+    with open(result_path, "rb") as f:
+        while offset < total:
+            f.seek(offset)
+            chunk = f.read(DELIVERY_CHUNK_SIZE)
+            headers = {
+                **base_headers,
+                "Content-Type": "application/offset+octet-stream",
+                "Upload-Offset": str(offset),
+                "Upload-Length": str(total),
+                "X-Chunk-SHA256": hashlib.sha256(chunk).hexdigest(),
+            }
+            resp = session.put(url, data=chunk, headers=headers, timeout=(DELIVERY_CONNECT_TIMEOUT, DELIVERY_READ_TIMEOUT))
+            if resp.status_code == 409:
+                # O cliente tem outro offset (ex: bloco anterior chegou mas a resposta perdeu-se)
+                offset = int(resp.headers["Upload-Offset"])
+                continue
+            if 400 <= resp.status_code < 500 and resp.status_code not in (408, 422, 429):
+                raise PermanentDeliveryError(f"Bloco recusado com status {resp.status_code}")
+            resp.raise_for_status()
+            offset = int(resp.headers.get("Upload-Offset", offset + len(chunk)))
+    return True
+
+def deliver(message, trace):
+    """
+    Envia o resultado para o callback_url do cliente: em blocos retomáveis se for grande
+    (e o cliente suportar), senão num único POST multipart em streaming.
+    Levanta PermanentDeliveryError se não valer a pena tentar novamente.
+    Devolve o modo de envio usado ("chunked" ou "single").
+    """
+    result_path = os.path.join(RESULTS_DIR, message["path"])
+    if not os.path.exists(result_path):
+        raise PermanentDeliveryError(f"Resultado não encontrado: {result_path}")
+    callback_url = message["callback_url"]
+    session = get_session(callback_url)
+    if os.path.getsize(result_path) >= DELIVERY_CHUNK_THRESHOLD and deliver_chunked(session, message, result_path, trace):
+        return "chunked"
+    body = MultipartFileStream(result_path, message["filename"])
+    resp = session.post(
+        callback_url,
+        data=body,
+        headers={**callback_headers(message, trace), "Content-Type": body.content_type},
+        timeout=(DELIVERY_CONNECT_TIMEOUT, DELIVERY_READ_TIMEOUT),
+    )
+    if 400 <= resp.status_code < 500 and resp.status_code not in (408, 429):
+        raise PermanentDeliveryError(f"Callback recusado com status {resp.status_code}")
+    resp.raise_for_status()
+    return "single"
+
+def send(message, trace=None):
+    """
+    Corre numa thread de envio. Devolve o destino da mensagem: "ok", "retry" ou "dead".
+    Cada tentativa é um span filho do span de conversão (parent_id recebido nos cabeçalhos AMQP).
+    Um pedido enviado para o dead-letter fica com pinned=True: o dispatcher não apaga o resultado ao
+    expirar, para que a mensagem possa ser reenviada; uma entrega bem-sucedida retira o pin.
+    """
+    job_id = message.get("job_id")
+    attempt = message.get("attempt", 0) + 1
+    trace = {**(trace or {"trace_id": uuid.uuid4().hex, "parent_id": None}), "span_id": new_span_id()}
+    set_log_context(trace["trace_id"], job_id)
+    started_at, started = time.time(), time.perf_counter()
+    outcome, mode = "retry", None
+    DELIVERIES_IN_FLIGHT.inc()
+    try:
+        mode = deliver(message, trace)
+        DELIVERY_SECONDS.labels(mode).observe(time.perf_counter() - started)
+        DELIVERY_BYTES.inc(os.path.getsize(os.path.join(RESULTS_DIR, message["path"])))
+        DELIVERY_ATTEMPTS.labels("ok").inc()
+        logging.info(f"Pedido {job_id} entregue em {message['callback_url']} (tentativa {attempt})")
+        update_job(job_id, "delivered", delivery_attempts=attempt, pinned=None)
+        outcome = "ok"
+    except PermanentDeliveryError as e:
+        DELIVERY_ATTEMPTS.labels("dead").inc()
+        logging.error(f"Entrega do pedido {job_id} falhou definitivamente: {e}")
+        update_job(job_id, "delivery_failed", delivery_attempts=attempt, error=str(e), pinned=True)
+        outcome = "dead"
+    except Exception as e:
+        if attempt >= DELIVERY_MAX_ATTEMPTS:
+            DELIVERY_ATTEMPTS.labels("dead").inc()
+            logging.error(f"Entrega do pedido {job_id} falhou {attempt} vezes, enviado para {DELIVERY_DEAD_LETTER_QUEUE}: {e}")
+            update_job(job_id, "delivery_failed", delivery_attempts=attempt, error=str(e), pinned=True)
+            outcome = "dead"
+        else:
+            DELIVERY_ATTEMPTS.labels("retry").inc()
+            logging.warning(f"Entrega do pedido {job_id} falhou (tentativa {attempt}), nova tentativa em {backoff_seconds(attempt):.0f}s: {e}")
+            update_job(job_id, delivery_attempts=attempt)
+    finally:
+        DELIVERIES_IN_FLIGHT.dec()
+        emit_span("delivery.attempt", trace["trace_id"], trace["span_id"], trace["parent_id"], started_at,
+                  time.perf_counter() - started, job_id, attempt=attempt, outcome=outcome, mode=mode)
+        set_log_context()
+    return outcome
+
+def declare_queues(channel):
+    channel.queue_declare(queue=DELIVERY_QUEUE, durable=True)
+    channel.queue_declare(queue=DELIVERY_DEAD_LETTER_QUEUE, durable=True)
+    # Cada atraso tem a sua fila com TTL fixo; ao expirar, a mensagem volta à fila de entrega
+    for attempt in range(1, DELIVERY_MAX_ATTEMPTS):
+        channel.queue_declare(queue=retry_queue_name(attempt), durable=True, arguments={
+            "x-message-ttl": int(backoff_seconds(attempt) * 1000),
+            "x-dead-letter-exchange": "",
+            "x-dead-letter-routing-key": DELIVERY_QUEUE,
+        })
+
+def rabbitmq_consumer():
+    """
+    Consome a fila de entrega com DELIVERY_SENDERS envios em paralelo.
+    A mensagem só é confirmada depois de entregue, reagendada ou enviada para o dead-letter.
+    """
+    senders = concurrent.futures.ThreadPoolExecutor(max_workers=DELIVERY_SENDERS)
+
+    while True:
+        try:
+            connection = pika.BlockingConnection(pika.ConnectionParameters(host='rabbitmq'))
+            channel = connection.channel()
+
+            def finish(delivery_tag, message, headers, outcome, channel=channel):
+                # Corre na thread da ligação (pika não é thread-safe)
+                if not channel.is_open:
+                    return
+                if outcome == "retry":
+                    message["attempt"] = message.get("attempt", 0) + 1
+                    routing_key = retry_queue_name(message["attempt"])
+                elif outcome == "dead":
+                    message["attempt"] = message.get("attempt", 0) + 1
+                    routing_key = DELIVERY_DEAD_LETTER_QUEUE
+                else:
+                    routing_key = None
+                if routing_key:
+                    channel.basic_publish(
+                        exchange='',
+                        routing_key=routing_key,
+                        body=json.dumps(message),
+                        # Os cabeçalhos de tracing seguem com a mensagem para as próximas tentativas
+                        properties=pika.BasicProperties(delivery_mode=2, headers=headers)
+                    )
+                channel.basic_ack(delivery_tag=delivery_tag)
+
+            def on_done(delivery_tag, message, headers, future, connection=connection, finish=finish):
+                try:
+                    outcome = future.result()
+                except Exception as e:
+                    logging.error(f"Erro inesperado na entrega: {e}")
+                    outcome = "retry"
+                try:
+                    connection.add_callback_threadsafe(functools.partial(finish, delivery_tag, message, headers, outcome))
+                except Exception as e:
+                    logging.error(f"Não foi possível confirmar a mensagem {delivery_tag}: {e}")
+
+            def callback(ch, method, properties, body):
+                try:
+                    message = json.loads(body)
+                except Exception as e:
+                    logging.error(f"Mensagem de entrega inválida: {e}")
+                    ch.basic_ack(delivery_tag=method.delivery_tag)
+                    return
+                future = senders.submit(send, message, trace_context(properties))
+                # on_done é ligado já: após uma nova ligação, as entregas da ligação anterior não podem ser
+                # confirmadas (nem repetidas) no canal novo
+                future.add_done_callback(
+                    lambda f, tag=method.delivery_tag, m=message, h=properties.headers, on_done=on_done: on_done(tag, m, h, f)
+                )
+
+            declare_queues(channel)
+            channel.basic_qos(prefetch_count=DELIVERY_SENDERS)
+            channel.basic_consume(queue=DELIVERY_QUEUE, on_message_callback=callback)
+            logging.info(f"A consumir {DELIVERY_QUEUE} com {DELIVERY_SENDERS} envios em paralelo...")
+            channel.start_consuming()
+        except Exception as e:
+            logging.error(f"Erro na ligação ao RabbitMQ: {e}")
+            time.sleep(5)  # Espera antes de tentar novamente
+
+if __name__ == "__main__":
+    start_http_server(DELIVERY_METRICS_PORT)
+    logging.info(f"Serviço de entrega iniciado (métricas em :{DELIVERY_METRICS_PORT}/metrics).")
+    rabbitmq_consumer()
@@ -1,14 +1,34 @@
 import os
 import requests
 import consul
-from flask import Flask, request, jsonify, send_file
+from flask import Flask, request, jsonify, send_file, Response
 from flask_httpauth import HTTPBasicAuth
 from werkzeug.utils import secure_filename
 import logging
+import tempfile
 from io import BytesIO
 import pika
 import json
-import base64
+import uuid
+import re
+import math
+import time
+import shutil
+import threading
+import hashlib
+import random
+import hmac
+import sys
+from collections import deque
+import urllib3
+from requests.adapters import HTTPAdapter
+from prometheus_client import Counter, Gauge, Histogram, generate_latest, CONTENT_TYPE_LATEST
+
+# Código comum aos componentes (pasta shared/ na raiz do repositório; nas imagens Docker é
+# copiada para /opt/shared, que está no PYTHONPATH)
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+from shared.tracing import JobContextFilter, set_log_context, init_tracing, new_span_id, emit_span
+from shared.jobs import RESULTS_DIR, JOB_FILE, BLOBS_DIR, read_job, update_job
 
 # --- OpenCL imports (opcional, para demonstração de disponibilidade) ---
 try:
@@ -23,6 +43,122 @@ PASSWORD = os.getenv("BASIC_AUTH_PASSWORD", "admin_password")
 CONSUL_HTTP_ADDR = os.getenv("CONSUL_HTTP_ADDR", "localhost:8500")
 SERVICE_PORT = 5000
 
+# Opções de conversão opcionais, passadas tal como vêm ao microserviço
+CONVERSION_OPTION_FIELDS = ["quantize", "colors", "dither", "palette_max_side", "max_width", "max_height", "max_pixels", "profile"]
+# Perfis de codificação suportados pelos serviços (fast: codifica mais rápido, small: ficheiros menores)
+ENCODER_PROFILES = ["fast", "balanced", "small"]
+# Máximo de saídas num pedido com várias saídas
+MAX_OUTPUTS = int(os.getenv("MAX_OUTPUTS", "8"))
+# Pares do service-text: cada par tem a sua fila (text_convert_queue.<origem>.<destino>), para que
+# cada réplica consuma só os pares que tem ativos (ENABLED_CONVERSIONS no serviço). Os pedidos com
+# várias saídas seguem para text_convert_queue.<origem>.multi
+TEXT_CONVERSIONS = ["docx:pdf", "docx:png", "pdf:docx", "pdf:png"]
+# Formatos de destino do service-image (os mesmos que o serviço aceita em outputs)
+IMAGE_OUTPUT_FORMATS = ["jpg", "jpeg", "png", "gif"]
+
+# Store de resultados partilhado com os serviços (RESULTS_DIR/<job_id>/job.json + resultado, ver shared/jobs.py)
+# RESULT_TTL_SECONDS: tempo que cada pedido e o seu resultado ficam disponíveis
+RESULT_TTL_SECONDS = int(os.getenv("RESULT_TTL_SECONDS", "86400"))
+JOB_ID_RE = re.compile(r"^[0-9a-f]{32}$")
+# Estados finais: resultado disponível ou falha
+DONE_STATES = {"converted", "delivered", "delivery_failed", "failed"}
+# Long-poll (?wait=) e server-sent events
+JOB_WAIT_MAX_SECONDS = int(os.getenv("JOB_WAIT_MAX_SECONDS", "60"))
+JOB_EVENTS_TIMEOUT = int(os.getenv("JOB_EVENTS_TIMEOUT", "600"))
+JOB_POLL_INTERVAL = 0.5
+
+# Store de conteúdos (BLOBS_DIR/<sha256>), partilhado com os serviços: cada upload é guardado pelo seu
+# SHA-256 e pedidos seguintes com o mesmo conteúdo podem referi-lo (blob_sha256) em vez de o reenviar.
+# BLOB_TTL_SECONDS: tempo sem ser usado ao fim do qual um conteúdo é removido
+BLOB_TTL_SECONDS = int(os.getenv("BLOB_TTL_SECONDS", "604800"))
+SHA256_RE = re.compile(r"^[0-9a-f]{64}$")
+BLOB_READ_SIZE = 1024 * 1024
+# Cada tenant só vê os conteúdos que ele próprio enviou: BLOBS_DIR/owners/<tenant>/<sha256> (ficheiro
+# vazio, com a data do último uso pelo tenant). O conteúdo em si é guardado uma só vez.
+BLOB_OWNERS_DIR = os.path.join(BLOBS_DIR, "owners")
+
+# Controlo de admissão (backpressure): a profundidade das filas é lida em segundo plano a cada
+# ADMISSION_SAMPLE_INTERVAL segundos e os pedidos são recusados (429, ou 503 sem consumidores) com
+# Retry-After quando a fila de destino passa um dos limites. 0 desliga o limite.
+# - MAX_MESSAGES: mensagens à espera
+# - MAX_MB: bytes pendentes (mensagens à espera x tamanho médio dos ficheiros publicados)
+# - MAX_WAIT_SECONDS: tempo estimado para esvaziar a fila (mensagens / ritmo de consumo observado)
+ADMISSION_SAMPLE_INTERVAL = float(os.getenv("ADMISSION_SAMPLE_INTERVAL", "2"))
+ADMISSION_RETRY_AFTER_DEFAULT = int(os.getenv("ADMISSION_RETRY_AFTER_DEFAULT", "30"))
+ADMISSION_RETRY_AFTER_MAX = int(os.getenv("ADMISSION_RETRY_AFTER_MAX", "300"))
+
+def queue_limits(prefix, max_messages, max_mb, max_wait_seconds):
+    return {
+        "max_messages": int(os.getenv(f"{prefix}_QUEUE_MAX_MESSAGES", max_messages)),
+        "max_bytes": int(os.getenv(f"{prefix}_QUEUE_MAX_MB", max_mb)) * 1024 * 1024,
+        "max_wait_seconds": float(os.getenv(f"{prefix}_QUEUE_MAX_WAIT_SECONDS", max_wait_seconds)),
+    }
+
+# As filas por par do service-text usam os limites de text_convert_queue (cada fila tem os seus)
+ADMISSION_LIMITS = {
+    "text_convert_queue": queue_limits("TEXT", "200", "2048", "600"),
+    "image_convert_queue": queue_limits("IMAGE", "1000", "4096", "120"),
+}
+
+# Fast path síncrono: pedidos com inline=true pequenos e baratos são convertidos na hora, reencaminhados
+# para uma instância saudável do serviço (ligações keep-alive reutilizadas) e o resultado segue em stream
+# na resposta. Os restantes (ou se o serviço falhar) seguem o caminho assíncrono pela fila.
+# - INLINE_CONVERSIONS: pares origem:destino elegíveis (vazio desliga o fast path)
+# - INLINE_MAX_BYTES: tamanho máximo do ficheiro
+# - INLINE_MAX_PIXELS: máximo de píxeis das imagens (lido do cabeçalho, sem descodificar)
+# - INLINE_TIMEOUT: tempo máximo (s) à espera da resposta do serviço
+INLINE_CONVERSIONS = [p for p in os.getenv("INLINE_CONVERSIONS", ",".join(
+    f"{src}:{dst}" for src in ["jpg", "jpeg", "png", "gif"] for dst in ["jpg", "png", "gif"] if src != dst
+)).lower().split(",") if p]
+INLINE_MAX_BYTES = int(os.getenv("INLINE_MAX_BYTES", str(1024 * 1024)))
+INLINE_MAX_PIXELS = int(os.getenv("INLINE_MAX_PIXELS", str(4_000_000)))
+INLINE_TIMEOUT = float(os.getenv("INLINE_TIMEOUT", "10"))
+INLINE_CONNECT_TIMEOUT = float(os.getenv("INLINE_CONNECT_TIMEOUT", "2"))
+INLINE_POOL_SIZE = int(os.getenv("INLINE_POOL_SIZE", "16"))
+# Os serviços usam certificados autoassinados: por omissão o certificado não é verificado
+INLINE_TLS_VERIFY = os.getenv("INLINE_TLS_VERIFY", "false").lower() in ("1", "true", "yes")
+INLINE_STREAM_CHUNK = 64 * 1024
+
+# Tenants: cada utilizador do HTTP Basic auth é um tenant, com peso e limites próprios. TENANTS_FILE é um
+# JSON {"<utilizador>": {"password": ..., "weight": 2, "max_in_flight": 4, "rate": 5, "burst": 50,
+# "max_pending": 1000}}; os campos em falta usam os valores por omissão abaixo. O utilizador
+# BASIC_AUTH_USERNAME/BASIC_AUTH_PASSWORD é sempre um tenant (salvo se estiver também no ficheiro).
+# - weight: parte do débito de cada fila quando há vários tenants com pedidos à espera
+# - max_in_flight: pedidos publicados e ainda por converter (0 = sem limite)
+# - rate / burst: pedidos por segundo aceites em /convert (token bucket; 0 = sem limite)
+# - max_pending: pedidos aceites à espera de vez no escalonador (0 = sem limite)
+TENANTS_FILE = os.getenv("TENANTS_FILE", "")
+TENANT_DEFAULTS = {
+    "weight": float(os.getenv("TENANT_WEIGHT", "1")),
+    "max_in_flight": int(os.getenv("TENANT_MAX_IN_FLIGHT", "0")),
+    "rate": float(os.getenv("TENANT_RATE", "0")),
+    "burst": int(os.getenv("TENANT_BURST", "20")),
+    "max_pending": int(os.getenv("TENANT_MAX_PENDING", "10000")),
+}
+
+def load_tenants():
+    tenants = {USERNAME: {"password": PASSWORD}}
+    if TENANTS_FILE:
+        with open(TENANTS_FILE, encoding="utf-8") as f:
+            tenants.update(json.load(f))
+    for name, config in tenants.items():
+        if not config.get("password"):
+            raise RuntimeError(f"TENANTS_FILE inválido: o tenant {name} não tem password")
+        for key, default in TENANT_DEFAULTS.items():
+            config[key] = type(default)(config.get(key, default))
+    return tenants
+
+TENANTS = load_tenants()
+
+# Escalonador justo (ver TenantScheduler): os pedidos aceites esperam no dispatcher, numa subfila por
+# tenant e por fila de conversão, e só são publicados no RabbitMQ quando a fila tem menos de
+# SCHEDULER_QUEUE_WINDOW pedidos à espera de um consumidor.
+# SCHEDULER_QUANTUM_MB: crédito por ronda do deficit round-robin (x peso do tenant), gasto com o
+# tamanho dos ficheiros publicados.
+SCHEDULER_QUEUE_WINDOW = int(os.getenv("SCHEDULER_QUEUE_WINDOW", "4"))
+SCHEDULER_QUANTUM_MB = float(os.getenv("SCHEDULER_QUANTUM_MB", "8"))
+SCHEDULER_POLL_INTERVAL = float(os.getenv("SCHEDULER_POLL_INTERVAL", "0.25"))
+
 # Configuração de logs
 base_log_dir = os.path.abspath(os.path.join(os.path.dirname(__file__), "../logs"))
 if not os.path.exists(base_log_dir):
@@ -32,19 +168,77 @@ if not os.path.exists(os.path.dirname(log_file)):
     os.makedirs(os.path.dirname(log_file))
 logging.basicConfig(
     level=logging.INFO,
-    format="%(asctime)s - %(levelname)s - %(message)s",
+    format="%(asctime)s - %(levelname)s - [%(trace_id)s %(job_id)s] %(message)s",
     handlers=[
         logging.FileHandler(log_file),  # Logs para o ficheiro
         logging.StreamHandler()        # Logs para o terminal
     ]
 )
+for handler in logging.getLogger().handlers:
+    handler.addFilter(JobContextFilter())
+
+# --- Tracing --- (spans em JSON, ver shared/tracing.py)
+init_tracing("dispatcher", os.path.join(base_log_dir, "traces", "dispatcher-spans.jsonl"))
+
+# trace_id aceite no cabeçalho X-Trace-Id do pedido
+TRACE_ID_RE = re.compile(r"^[0-9a-f]{32}$")
 
 app = Flask(__name__)
 auth = HTTPBasicAuth()
 
+# --- Métricas Prometheus (expostas em /metrics) ---
+def conversion_queue(service_name, source, target):
+    if service_name == "service-text":
+        return f"text_convert_queue.{source}.{target}"
+    return "image_convert_queue"
+
+# Filas cuja profundidade é lida (queue_declare passivo) a cada recolha de métricas
+# (text_convert_queue: fila única usada antes das filas por par, esvaziada pelo service-text)
+METRICS_QUEUES = [conversion_queue("service-text", *pair.split(":")) for pair in TEXT_CONVERSIONS] + [
+    conversion_queue("service-text", source, "multi") for source in sorted({pair.split(":")[0] for pair in TEXT_CONVERSIONS})
+] + [
+    "text_convert_queue", "text_convert_dead_letter_queue", "image_convert_queue", "image_convert_dead_letter_queue", "delivery_queue", "delivery_dead_letter_queue",
+]
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+JOBS_SUBMITTED = Counter("dispatcher_jobs_submitted_total", "Pedidos aceites e publicados na fila", ["source", "target", "input"])
+INGEST_SECONDS = Histogram("dispatcher_ingest_seconds", "Receção e gravação do ficheiro no store de conteúdos (segundos)", ["source", "target"], buckets=LATENCY_BUCKETS)
+INGEST_BYTES = Counter("dispatcher_ingest_bytes_total", "Bytes recebidos em uploads", ["source", "target"])
+PUBLISH_SECONDS = Histogram("dispatcher_publish_seconds", "Publicação do pedido no RabbitMQ (segundos)", ["queue"], buckets=LATENCY_BUCKETS)
+BLOB_LOOKUPS = Counter("dispatcher_blob_lookups_total", "Consultas ao store de conteúdos (HEAD /blobs e pedidos por referência)", ["result"])
+BLOB_STORE_FILES = Gauge("dispatcher_blob_store_files", "Conteúdos guardados no store de conteúdos")
+BLOB_STORE_BYTES = Gauge("dispatcher_blob_store_bytes", "Tamanho total do store de conteúdos")
+RESULT_STORE_JOBS = Gauge("dispatcher_result_store_jobs", "Pedidos guardados no store de resultados")
+RESULT_DOWNLOADS = Counter("dispatcher_result_downloads_total", "Resultados descarregados em /jobs/<id>/result")
+RESULT_DOWNLOAD_BYTES = Counter("dispatcher_result_download_bytes_total", "Bytes de resultados servidos em /jobs/<id>/result")
+QUEUE_MESSAGES = Gauge("rabbitmq_queue_messages", "Mensagens à espera na fila", ["queue"])
+QUEUE_CONSUMERS = Gauge("rabbitmq_queue_consumers", "Consumidores ligados à fila", ["queue"])
+QUEUE_DRAIN_RATE = Gauge("dispatcher_queue_drain_rate", "Ritmo de consumo observado da fila (mensagens/segundo)", ["queue"])
+QUEUE_PENDING_BYTES = Gauge("dispatcher_queue_pending_bytes", "Bytes pendentes estimados na fila", ["queue"])
+ADMISSION_REJECTIONS = Counter("dispatcher_admission_rejections_total", "Pedidos recusados pelo controlo de admissão", ["queue", "reason"])
+TENANT_JOBS = Counter("dispatcher_tenant_jobs_total", "Pedidos aceites por tenant", ["tenant"])
+TENANT_REJECTIONS = Counter("dispatcher_tenant_rejections_total", "Pedidos recusados pelos limites do tenant", ["tenant", "reason"])
+TENANT_PENDING = Gauge("dispatcher_tenant_pending_jobs", "Pedidos à espera de vez no escalonador", ["tenant"])
+TENANT_IN_FLIGHT = Gauge("dispatcher_tenant_in_flight_jobs", "Pedidos publicados e ainda por converter", ["tenant"])
+SCHEDULER_WAIT = Histogram("dispatcher_scheduler_wait_seconds", "Espera no escalonador até à publicação (segundos)", ["tenant"], buckets=LATENCY_BUCKETS + (300, 900, 3600))
+INLINE_REQUESTS = Counter("dispatcher_inline_requests_total", "Pedidos do fast path síncrono (ok, error: recusado pelo serviço, fallback: enviado para a fila)", ["source", "target", "outcome"])
+INLINE_SECONDS = Histogram("dispatcher_inline_seconds", "Conversões do fast path síncrono, até ao início da resposta do serviço (segundos)", ["source", "target"], buckets=LATENCY_BUCKETS)
+
+@app.before_request
+def reset_log_context():
+    set_log_context()
+
 @auth.verify_password
 def verify_password(username, password):
-    return username == USERNAME and password == PASSWORD
+    tenant = TENANTS.get(username)
+    if tenant and hmac.compare_digest(str(tenant["password"]), password or ""):
+        return username
+    return None
+
+def owned_job(job):
+    """
+    Pedidos só são visíveis para o tenant que os criou (pedidos antigos, sem tenant, para todos).
+    """
+    return job if job and job.get("tenant", auth.current_user()) == auth.current_user() else None
 
 def discover_service(filetype):
     consul_host, consul_port = CONSUL_HTTP_ADDR.split(":")
@@ -62,7 +256,493 @@ def discover_service(filetype):
             return s
     return None
 
-def publish_to_queue(payload, queue_name):
+def healthy_instance(service_name):
+    """
+    Escolhe ao acaso uma instância do serviço com os health checks do Consul a passar.
+    Devolve (endereço, porta) ou None.
+    """
+    consul_host, consul_port = CONSUL_HTTP_ADDR.split(":")
+    c = consul.Consul(host=consul_host, port=int(consul_port))
+    _, nodes = c.health.service(service_name, passing=True)
+    if not nodes:
+        return None
+    service = random.choice(nodes)["Service"]
+    return service["Address"] or "localhost", service["Port"]
+
+def job_view(job):
+    """
+    Estado público do pedido, com a duração de cada etapa (em segundos).
+    """
+    first = {}
+    for event in job.get("events", []):
+        first.setdefault(event["status"], event["at"])
+    stages = [
+        ("queue_wait", "queued", "processing"),
+        ("conversion", "processing", "converted"),
+        ("delivery", "converted", "delivered"),
+    ]
+    timings = {name: round(first[end] - first[start], 3) for name, start, end in stages if start in first and end in first}
+    if first and job.get("status") in DONE_STATES:
+        timings["total"] = round(job["events"][-1]["at"] - job["events"][0]["at"], 3)
+    if job.get("released_at") and "queued" in first:
+        timings["scheduler_wait"] = round(job["released_at"] - first["queued"], 3)
+    view = dict(job)
+    view.pop("dispatch", None)
+    view["timings"] = timings
+    view["result_available"] = bool(job.get("result")) and os.path.exists(os.path.join(RESULTS_DIR, job["job_id"], job["result"]))
+    return view
+
+def wait_for_job(job_id, timeout):
+    """
+    Long-poll: espera até o pedido chegar a um estado final ou até acabar o tempo.
+    """
+    deadline = time.monotonic() + min(max(timeout, 0), JOB_WAIT_MAX_SECONDS)
+    job = read_job(job_id)
+    while job and job.get("status") not in DONE_STATES and time.monotonic() < deadline:
+        time.sleep(JOB_POLL_INTERVAL)
+        job = read_job(job_id)
+    return job
+
+def cleanup_expired_jobs():
+    """
+    Thread que apaga do store os pedidos (e resultados) sem alterações há mais de RESULT_TTL_SECONDS.
+    Os pedidos com pinned (entrega no dead-letter do delivery) ficam até serem reenviados ou apagados à mão.
+    """
+    while True:
+        try:
+            now = time.time()
+            for job_id in os.listdir(RESULTS_DIR) if os.path.isdir(RESULTS_DIR) else []:
+                job_dir = os.path.join(RESULTS_DIR, job_id)
+                job_path = os.path.join(job_dir, JOB_FILE)
+                reference = job_path if os.path.exists(job_path) else job_dir
+                if now - os.path.getmtime(reference) > RESULT_TTL_SECONDS:
+                    if (read_job(job_id) or {}).get("pinned"):
+                        continue
+                    shutil.rmtree(job_dir, ignore_errors=True)
+                    logging.info(f"Pedido {job_id} expirado e removido do store de resultados.")
+        except Exception as e:
+            logging.error(f"Erro na limpeza do store de resultados: {e}")
+        time.sleep(60)
+
+def blob_path(sha256):
+    return os.path.join(BLOBS_DIR, sha256)
+
+def store_blob(file):
+    """
+    Guarda o ficheiro enviado no store de conteúdos, calculando o SHA-256 enquanto o escreve em disco.
+    Devolve (sha256, tamanho).
+    """
+    os.makedirs(BLOBS_DIR, exist_ok=True)
+    digest = hashlib.sha256()
+    size = 0
+    fd, tmp_path = tempfile.mkstemp(dir=BLOBS_DIR, suffix=".part")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            for block in iter(lambda: file.stream.read(BLOB_READ_SIZE), b""):
+                digest.update(block)
+                f.write(block)
+                size += len(block)
+        sha256 = digest.hexdigest()
+        os.replace(tmp_path, blob_path(sha256))
+    except BaseException:
+        try:
+            os.remove(tmp_path)
+        except OSError:
+            pass
+        raise
+    return sha256, size
+
+def blob_owner_path(sha256, tenant):
+    # O nome do tenant é reduzido a um hash para ser sempre um nome de pasta válido
+    return os.path.join(BLOB_OWNERS_DIR, hashlib.sha256(tenant.encode("utf-8")).hexdigest()[:32], sha256)
+
+def add_blob_owner(sha256, tenant):
+    path = blob_owner_path(sha256, tenant)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, "a"):
+        os.utime(path)
+
+def touch_blob(sha256, tenant):
+    """
+    Marca o conteúdo como usado agora (adia a expiração). Devolve False se não existir ou se o tenant
+    nunca o tiver enviado (não revela conteúdos de outros tenants).
+    """
+    try:
+        os.utime(blob_owner_path(sha256, tenant))
+        os.utime(blob_path(sha256))
+        return True
+    except OSError:
+        return False
+
+def cleanup_expired_blobs():
+    """
+    Thread que apaga do store de conteúdos os ficheiros sem uso há mais de BLOB_TTL_SECONDS.
+    """
+    while True:
+        try:
+            now = time.time()
+            for name in os.listdir(BLOBS_DIR) if os.path.isdir(BLOBS_DIR) else []:
+                path = os.path.join(BLOBS_DIR, name)
+                if SHA256_RE.match(name) and now - os.path.getmtime(path) > BLOB_TTL_SECONDS:
+                    os.remove(path)
+                    logging.info(f"Conteúdo {name} expirado e removido do store de conteúdos.")
+            for dirpath, _, names in os.walk(BLOB_OWNERS_DIR):
+                for name in names:
+                    path = os.path.join(dirpath, name)
+                    if now - os.path.getmtime(path) > BLOB_TTL_SECONDS or not os.path.exists(blob_path(name)):
+                        os.remove(path)
+        except Exception as e:
+            logging.error(f"Erro na limpeza do store de conteúdos: {e}")
+        time.sleep(300)
+
+def sample_queue_depths():
+    """
+    Lê a profundidade e o número de consumidores de cada fila (queue_declare passivo, não cria filas).
+    """
+    connection = pika.BlockingConnection(pika.ConnectionParameters(host='rabbitmq'))
+    try:
+        for queue_name in METRICS_QUEUES:
+            channel = connection.channel()
+            try:
+                result = channel.queue_declare(queue=queue_name, passive=True)
+            except pika.exceptions.ChannelClosedByBroker:
+                continue  # fila ainda não declarada por nenhum serviço
+            QUEUE_MESSAGES.labels(queue_name).set(result.method.message_count)
+            QUEUE_CONSUMERS.labels(queue_name).set(result.method.consumer_count)
+            admission.update(queue_name, result.method.message_count, result.method.consumer_count)
+            channel.close()
+    finally:
+        connection.close()
+
+class QueueAdmission:
+    """
+    Estado de cada fila para o controlo de admissão: última amostra (mensagens e consumidores),
+    pedidos publicados desde essa amostra, tamanho médio dos ficheiros e ritmo de consumo.
+    O ritmo de consumo é estimado entre amostras: (mensagens antes + publicadas - mensagens agora) / intervalo.
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.queues = {}
+
+    def state(self, queue_name):
+        return self.queues.setdefault(queue_name, {
+            "messages": 0, "consumers": 0, "sampled_at": None,
+            "published": 0, "avg_bytes": 0.0, "drain_rate": None,
+        })
+
+    def published(self, queue_name, size):
+        with self.lock:
+            s = self.state(queue_name)
+            s["published"] += 1
+            s["avg_bytes"] = size if not s["avg_bytes"] else 0.9 * s["avg_bytes"] + 0.1 * size
+
+    def update(self, queue_name, messages, consumers):
+        now = time.monotonic()
+        with self.lock:
+            s = self.state(queue_name)
+            elapsed = now - s["sampled_at"] if s["sampled_at"] is not None else None
+            if elapsed is not None and elapsed < ADMISSION_SAMPLE_INTERVAL / 2:
+                return  # amostra demasiado próxima da anterior (ex: /metrics) para medir o ritmo
+            # O escalonador mantém a fila quase vazia, por isso o ritmo conta também as mensagens
+            # publicadas e consumidas no intervalo; só um intervalo sem qualquer atividade é ignorado
+            if elapsed and (s["messages"] or messages or s["published"]):
+                rate = max(0, s["messages"] + s["published"] - messages) / elapsed
+                s["drain_rate"] = rate if s["drain_rate"] is None else 0.7 * s["drain_rate"] + 0.3 * rate
+                QUEUE_DRAIN_RATE.labels(queue_name).set(s["drain_rate"])
+            s.update(messages=messages, consumers=consumers, sampled_at=now, published=0)
+            QUEUE_PENDING_BYTES.labels(queue_name).set(messages * s["avg_bytes"])
+
+    def check(self, queue_name, size):
+        """
+        Devolve None se o pedido pode ser aceite, ou (código HTTP, motivo, Retry-After em segundos).
+        Sem amostra recente (ex: RabbitMQ inacessível) o pedido é aceite.
+        """
+        limits = ADMISSION_LIMITS.get(queue_name.split(".")[0])
+        # Pedidos aceites que ainda esperam no escalonador contam como se já estivessem na fila
+        backlog, backlog_bytes = scheduler.backlog(queue_name)
+        with self.lock:
+            s = self.queues.get(queue_name)
+            if not limits or not s or s["sampled_at"] is None:
+                return None
+            if time.monotonic() - s["sampled_at"] > ADMISSION_SAMPLE_INTERVAL * 5:
+                return None
+            messages = s["messages"] + s["published"] + backlog
+            pending_bytes = (s["messages"] + s["published"]) * s["avg_bytes"] + backlog_bytes + size
+            drain_rate, consumers, avg_bytes = s["drain_rate"], s["consumers"], s["avg_bytes"]
+        wait = messages / drain_rate if drain_rate else None
+        if limits["max_messages"] and messages >= limits["max_messages"]:
+            reason, excess = "messages", messages - limits["max_messages"] + 1
+        elif limits["max_bytes"] and pending_bytes > limits["max_bytes"]:
+            reason, excess = "bytes", (pending_bytes - limits["max_bytes"]) / max(avg_bytes, 1)
+        elif limits["max_wait_seconds"] and wait is not None and wait > limits["max_wait_seconds"]:
+            reason, excess = "wait", (wait - limits["max_wait_seconds"]) * drain_rate
+        else:
+            return None
+        # Tempo para a fila consumir o excesso, ao ritmo observado
+        retry_after = math.ceil(excess / drain_rate) if drain_rate else ADMISSION_RETRY_AFTER_DEFAULT
+        retry_after = min(max(retry_after, 1), ADMISSION_RETRY_AFTER_MAX)
+        return (503 if consumers == 0 else 429), reason, retry_after
+
+admission = QueueAdmission()
+
+def admission_sampler():
+    """
+    Thread que lê periodicamente a profundidade das filas para o controlo de admissão.
+    """
+    while True:
+        try:
+            sample_queue_depths()
+        except Exception as e:
+            logging.warning(f"Não foi possível ler a profundidade das filas: {e}")
+        time.sleep(ADMISSION_SAMPLE_INTERVAL)
+
+class TokenBucket:
+    """
+    Limite de ritmo: até burst pedidos seguidos e, depois, rate pedidos por segundo.
+    """
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = max(burst, 1)
+        self.tokens = float(self.burst)
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def take(self):
+        """
+        Gasta um pedido. Devolve 0 se houver crédito, ou os segundos até haver.
+        """
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return 0
+            return (1 - self.tokens) / self.rate
+
+TENANT_BUCKETS = {name: TokenBucket(t["rate"], t["burst"]) for name, t in TENANTS.items() if t["rate"] > 0}
+
+class TenantScheduler:
+    """
+    Escalonamento justo dos pedidos aceites entre tenants, antes das filas do RabbitMQ.
+    Cada fila de conversão tem uma subfila por tenant. Um pedido só é publicado quando a fila tem menos de
+    SCHEDULER_QUEUE_WINDOW pedidos à espera de um consumidor, pelo que é aqui (e não na ordem de chegada)
+    que se decide o que é convertido a seguir; com a fila livre, os pedidos são publicados logo.
+    Entre tenants, deficit round-robin: na sua vez, cada tenant recebe peso x SCHEDULER_QUANTUM_MB de
+    crédito, gasto com o tamanho dos ficheiros que publica. Tenants no limite de pedidos em curso
+    (max_in_flight) são saltados; sem pedidos de outros tenants, um só tenant usa a fila inteira.
+    O estado dos pedidos publicados (à espera, em conversão, terminado) é lido do store de resultados.
+    """
+    def __init__(self):
+        self.condition = threading.Condition()
+        self.queues = {}    # fila -> {"tenants": deque, "pending": {tenant: deque de pedidos}, "deficit": {}, "credited": set()}
+        self.released = {}  # job_id -> {"tenant", "queue", "waiting"}
+        self.refreshed_at = 0.0
+        self.thread = None
+
+    def start(self):
+        with self.condition:
+            if self.thread is None:
+                self.recover()
+                self.thread = threading.Thread(target=self.run, daemon=True)
+                self.thread.start()
+
+    def submit(self, job):
+        """
+        job: {"job_id", "tenant", "queue", "payload", "headers", "size", "accepted_at"}
+        """
+        with self.condition:
+            q = self.queues.setdefault(job["queue"], {"tenants": deque(), "pending": {}, "deficit": {}, "credited": set()})
+            sub = q["pending"].setdefault(job["tenant"], deque())
+            if not sub:
+                q["tenants"].append(job["tenant"])
+            sub.append(job)
+            self.condition.notify()
+
+    def backlog(self, queue_name):
+        with self.condition:
+            q = self.queues.get(queue_name)
+            jobs = [job for sub in q["pending"].values() for job in sub] if q else []
+            return len(jobs), sum(job["size"] for job in jobs)
+
+    def pending_count(self, tenant):
+        with self.condition:
+            return sum(len(q["pending"].get(tenant, ())) for q in self.queues.values())
+
+    def in_flight(self, tenant):
+        return sum(1 for r in self.released.values() if r["tenant"] == tenant)
+
+    def waiting(self, queue_name):
+        return sum(1 for r in self.released.values() if r["queue"] == queue_name and r["waiting"])
+
+    def pick(self, queue_name):
+        """
+        Próximo pedido da fila, por deficit round-robin entre tenants (com o lock).
+        """
+        q = self.queues.get(queue_name)
+        if not q:
+            return None
+        tenants = q["tenants"]
+        blocked = 0
+        while tenants and blocked < len(tenants):
+            tenant = tenants[0]
+            config = TENANTS.get(tenant, TENANT_DEFAULTS)
+            if config["max_in_flight"] and self.in_flight(tenant) >= config["max_in_flight"]:
+                q["credited"].discard(tenant)
+                tenants.rotate(-1)
+                blocked += 1
+                continue
+            if tenant not in q["credited"]:
+                q["deficit"][tenant] = q["deficit"].get(tenant, 0) + config["weight"] * SCHEDULER_QUANTUM_MB * 1024 * 1024
+                q["credited"].add(tenant)
+            sub = q["pending"][tenant]
+            job = sub[0]
+            if max(job["size"], 1) <= q["deficit"][tenant]:
+                sub.popleft()
+                q["deficit"][tenant] -= max(job["size"], 1)
+                if not sub:
+                    # Sem pedidos à espera o tenant sai da ronda e perde o crédito que sobrou
+                    tenants.popleft()
+                    del q["pending"][tenant]
+                    q["deficit"].pop(tenant, None)
+                    q["credited"].discard(tenant)
+                return job
+            # Crédito insuficiente: passa a vez e acumula para a próxima ronda
+            q["credited"].discard(tenant)
+            tenants.rotate(-1)
+            blocked = 0
+        return None
+
+    def requeue(self, job):
+        """
+        Devolve ao início da subfila um pedido que não foi possível publicar.
+        """
+        with self.condition:
+            self.released.pop(job["job_id"], None)
+            q = self.queues[job["queue"]]
+            sub = q["pending"].setdefault(job["tenant"], deque())
+            if not sub:
+                q["tenants"].appendleft(job["tenant"])
+            sub.appendleft(job)
+            q["deficit"][job["tenant"]] = q["deficit"].get(job["tenant"], 0) + max(job["size"], 1)
+
+    def refresh(self):
+        """
+        Atualiza o estado dos pedidos publicados a partir do store de resultados.
+        """
+        if time.monotonic() - self.refreshed_at < SCHEDULER_POLL_INTERVAL:
+            return
+        self.refreshed_at = time.monotonic()
+        with self.condition:
+            job_ids = list(self.released)
+        states = {job_id: (read_job(job_id) or {}).get("status") for job_id in job_ids}
+        with self.condition:
+            for job_id, status in states.items():
+                if job_id not in self.released:
+                    continue
+                if status is None or status in DONE_STATES:
+                    del self.released[job_id]
+                else:
+                    self.released[job_id]["waiting"] = status in ("queued", "retrying")
+
+    def run(self):
+        while True:
+            try:
+                self.refresh()
+                batch = []
+                with self.condition:
+                    for queue_name in list(self.queues):
+                        while self.waiting(queue_name) < SCHEDULER_QUEUE_WINDOW:
+                            job = self.pick(queue_name)
+                            if job is None:
+                                break
+                            self.released[job["job_id"]] = {"tenant": job["tenant"], "queue": queue_name, "waiting": True}
+                            batch.append(job)
+                    if not batch:
+                        self.condition.wait(SCHEDULER_POLL_INTERVAL)
+                for job in batch:
+                    self.release(job)
+            except Exception as e:
+                logging.error(f"Erro no escalonador: {e}")
+                time.sleep(1)
+
+    def release(self, job):
+        """
+        Publica o pedido na fila de conversão. Só depois de a publicação terminar o job.json fica com
+        released_at e sem o pedido guardado (dispatch): se o dispatcher morrer antes disso, recover
+        publica-o de novo. Esta atualização não mexe no estado, pelo que não desfaz o que um serviço
+        já tenha escrito entretanto.
+        """
+        job_id, headers = job["job_id"], job["headers"]
+        set_log_context(headers["trace_id"], job_id)
+        released_at = time.time()
+        wait_seconds = max(0.0, released_at - job["accepted_at"])
+        publish_started_at, publish_started = time.time(), time.perf_counter()
+        try:
+            publish_to_queue(job["payload"], job["queue"], headers=headers)
+        except Exception as e:
+            logging.warning(f"Não foi possível publicar o pedido em {job['queue']}, nova tentativa em breve: {e}")
+            self.requeue(job)
+            set_log_context()
+            time.sleep(1)
+            return
+        publish_seconds = time.perf_counter() - publish_started
+        update_job(job_id, released_at=released_at, dispatch=None)
+        admission.published(job["queue"], job["size"])
+        PUBLISH_SECONDS.labels(job["queue"]).observe(publish_seconds)
+        SCHEDULER_WAIT.labels(job["tenant"]).observe(wait_seconds)
+        emit_span("scheduler_wait", headers["trace_id"], new_span_id(), headers["parent_id"], job["accepted_at"], wait_seconds, job_id, tenant=job["tenant"])
+        emit_span("publish", headers["trace_id"], new_span_id(), headers["parent_id"], publish_started_at, publish_seconds, job_id, queue=job["queue"])
+        logging.info(f"Pedido {job_id} do tenant {job['tenant']} publicado em {job['queue']} após {wait_seconds:.2f}s no escalonador.")
+        set_log_context()
+
+    def recover(self):
+        """
+        No arranque, volta a pôr no escalonador os pedidos aceites e nunca publicados (com o pedido
+        guardado no job.json e sem released_at) e volta a contar os publicados e por converter.
+        """
+        jobs = []
+        for job_id in os.listdir(RESULTS_DIR) if os.path.isdir(RESULTS_DIR) else []:
+            job = read_job(job_id)
+            if job and job.get("tenant") and job.get("queue") and job.get("status") not in DONE_STATES:
+                jobs.append(job)
+        for job in sorted(jobs, key=lambda j: j.get("created_at", 0)):
+            if job.get("dispatch") and not job.get("released_at") and job.get("status") == "queued":
+                self.submit({
+                    "job_id": job["job_id"], "tenant": job["tenant"], "queue": job["queue"],
+                    "payload": job["dispatch"]["payload"], "headers": job["dispatch"]["headers"],
+                    "size": job.get("size", 0), "accepted_at": job.get("created_at", time.time()),
+                })
+            elif job.get("released_at"):
+                self.released[job["job_id"]] = {"tenant": job["tenant"], "queue": job["queue"], "waiting": job.get("status") == "queued"}
+        if jobs:
+            logging.info(f"Escalonador: {len(jobs)} pedidos recuperados do store de resultados.")
+
+    def sample_metrics(self):
+        with self.condition:
+            pending = {}
+            for q in self.queues.values():
+                for tenant, sub in q["pending"].items():
+                    pending[tenant] = pending.get(tenant, 0) + len(sub)
+            for tenant in TENANTS:
+                TENANT_PENDING.labels(tenant).set(pending.get(tenant, 0))
+                TENANT_IN_FLIGHT.labels(tenant).set(self.in_flight(tenant))
+
+scheduler = TenantScheduler()
+
+def sample_store_sizes():
+    files = size = 0
+    if os.path.isdir(BLOBS_DIR):
+        with os.scandir(BLOBS_DIR) as entries:
+            for entry in entries:
+                if SHA256_RE.match(entry.name):
+                    files += 1
+                    size += entry.stat().st_size
+    BLOB_STORE_FILES.set(files)
+    BLOB_STORE_BYTES.set(size)
+    RESULT_STORE_JOBS.set(len(os.listdir(RESULTS_DIR)) if os.path.isdir(RESULTS_DIR) else 0)
+
+def publish_to_queue(payload, queue_name, headers=None):
     connection = pika.BlockingConnection(pika.ConnectionParameters(host='rabbitmq'))
     channel = connection.channel()
     channel.queue_declare(queue=queue_name, durable=True)
@@ -70,42 +750,376 @@ def publish_to_queue(payload, queue_name):
         exchange='',
         routing_key=queue_name,
         body=json.dumps(payload),
-        properties=pika.BasicProperties(delivery_mode=2)
+        properties=pika.BasicProperties(delivery_mode=2, headers=headers)
     )
     connection.close()
 
+# Sessão partilhada pelo fast path: as ligações TLS aos serviços ficam abertas e são reutilizadas
+if not INLINE_TLS_VERIFY:
+    urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
+inline_session = requests.Session()
+inline_session.auth = (USERNAME, PASSWORD)
+inline_session.verify = INLINE_TLS_VERIFY
+inline_session.mount("https://", HTTPAdapter(pool_connections=4, pool_maxsize=INLINE_POOL_SIZE))
+
+def upload_size(file):
+    position = file.stream.tell()
+    file.stream.seek(0, os.SEEK_END)
+    size = file.stream.tell()
+    file.stream.seek(position)
+    return size
+
+def image_pixels(stream):
+    """
+    Número de píxeis da imagem, lido só do cabeçalho. None se não for possível (ex: Pillow não instalado).
+    """
+    try:
+        from PIL import Image
+    except ImportError:
+        return None
+    position = stream.tell()
+    try:
+        with Image.open(stream) as img:
+            return img.width * img.height
+    except Exception:
+        return None
+    finally:
+        stream.seek(position)
+
+def inline_eligible(service_name, source, target, file, outputs):
+    """
+    Indica se o pedido pode seguir pelo fast path: par ativo em INLINE_CONVERSIONS, uma só saída,
+    ficheiro enviado no pedido e abaixo dos limites de tamanho e de píxeis.
+    """
+    if outputs or not file or f"{source}:{target}" not in INLINE_CONVERSIONS:
+        return False
+    if upload_size(file) > INLINE_MAX_BYTES:
+        return False
+    if service_name == "service-image" and INLINE_MAX_PIXELS:
+        pixels = image_pixels(file.stream)
+        if pixels is not None and pixels > INLINE_MAX_PIXELS:
+            return False
+    return True
+
+def convert_inline(service_name, file, filename, source, target, trace_id, parent_id):
+    """
+    Reencaminha o pedido para uma instância saudável do serviço e devolve a resposta em stream.
+    Devolve None se o pedido deve seguir pela fila (sem instância, erro de ligação ou erro 5xx).
+    """
+    started_at, started = time.time(), time.perf_counter()
+    instance = healthy_instance(service_name)
+    if not instance:
+        return None
+    address, port = instance
+    # O service-image lê o formato de destino do campo "format", o service-text de "target_format"
+    data = {"format" if service_name == "service-image" else "target_format": target}
+    data.update({k: request.form[k] for k in CONVERSION_OPTION_FIELDS if k in request.form})
+    file.stream.seek(0)
+    try:
+        upstream = inline_session.post(
+            f"https://{address}:{port}/convert",
+            files={"file": (filename, file.stream, file.mimetype)},
+            data=data,
+            headers={"X-Trace-Id": trace_id},
+            stream=True,
+            timeout=(INLINE_CONNECT_TIMEOUT, INLINE_TIMEOUT),
+        )
+    except requests.RequestException as e:
+        logging.warning(f"Fast path: {service_name} em {address}:{port} inacessível ({e}), pedido enviado para a fila.")
+        file.stream.seek(0)
+        return None
+    seconds = time.perf_counter() - started
+    INLINE_SECONDS.labels(source, target).observe(seconds)
+    emit_span("inline", trace_id, new_span_id(), parent_id, started_at, seconds,
+              service=service_name, instance=f"{address}:{port}", status=upstream.status_code)
+    if upstream.status_code >= 500:
+        logging.warning(f"Fast path: {service_name} respondeu {upstream.status_code}, pedido enviado para a fila.")
+        upstream.close()
+        file.stream.seek(0)
+        return None
+
+    def stream():
+        try:
+            for chunk in upstream.iter_content(INLINE_STREAM_CHUNK):
+                yield chunk
+        finally:
+            upstream.close()
+
+    headers = {k: upstream.headers[k] for k in ("Content-Type", "Content-Disposition", "Content-Length") if k in upstream.headers}
+    headers["X-Trace-Id"] = trace_id
+    headers["X-Conversion-Mode"] = "inline"
+    logging.info(f"Fast path: {filename} convertido para {target} por {address}:{port} ({upstream.status_code}).")
+    return Response(stream(), status=upstream.status_code, headers=headers)
+
 @app.route("/convert", methods=["POST"])
 @auth.login_required
 def dispatch():
-    if 'file' not in request.files or 'target_format' not in request.form:
+    started_at, started = time.time(), time.perf_counter()
+    trace_id = request.headers.get("X-Trace-Id", "").lower()
+    if not TRACE_ID_RE.match(trace_id):
+        trace_id = uuid.uuid4().hex
+    job_id = uuid.uuid4().hex
+    span_id = new_span_id()
+    set_log_context(trace_id, job_id)
+    tenant = auth.current_user()
+
+    # Limite de ritmo do tenant (token bucket)
+    bucket = TENANT_BUCKETS.get(tenant)
+    retry_after = bucket.take() if bucket else 0
+    if retry_after:
+        TENANT_REJECTIONS.labels(tenant, "rate").inc()
+        resp = jsonify({"error": "Tenant rate limit exceeded, retry later", "tenant": tenant, "reason": "rate", "retry_after": math.ceil(retry_after)})
+        resp.headers["Retry-After"] = str(math.ceil(retry_after))
+        return resp, 429
+
+    # O ficheiro pode vir no pedido ou ser referido pelo SHA-256 de um conteúdo já enviado (ver HEAD /blobs/<sha256>)
+    blob_sha256 = request.form.get('blob_sha256', '').lower()
+    has_input = 'file' in request.files or (blob_sha256 and request.form.get('filename'))
+    if not has_input or not ('target_format' in request.form or 'outputs' in request.form):
         return jsonify({"error": "Missing file or target_format"}), 400
-    file = request.files['file']
-    target_format = request.form['target_format'].lower()
-    filename = secure_filename(file.filename)
+    if 'file' not in request.files and not SHA256_RE.match(blob_sha256):
+        return jsonify({"error": "Invalid blob_sha256"}), 400
+    if 'file' not in request.files and not os.path.exists(blob_owner_path(blob_sha256, tenant)):
+        BLOB_LOOKUPS.labels("miss").inc()
+        return jsonify({"error": "Blob not found"}), 404
+    file = request.files.get('file')
+    target_format = request.form.get('target_format', '').lower()
+
+    # Várias saídas a partir do mesmo ficheiro (lista JSON de {"format": ..., "max_width": ..., "profile": ...})
+    outputs = None
+    if request.form.get('outputs'):
+        try:
+            outputs = json.loads(request.form['outputs'])
+        except ValueError:
+            return jsonify({"error": "Invalid outputs: not valid JSON"}), 400
+        if not isinstance(outputs, list) or not outputs or not all(isinstance(o, dict) and o.get("format") for o in outputs):
+            return jsonify({"error": "Invalid outputs: expected a non-empty list of objects with a format"}), 400
+        if len(outputs) > MAX_OUTPUTS:
+            return jsonify({"error": f"Invalid outputs: at most {MAX_OUTPUTS} outputs per request"}), 400
+        if any(str(o.get("profile") or "balanced").lower() not in ENCODER_PROFILES for o in outputs):
+            return jsonify({"error": f"Invalid profile. Supported: {', '.join(ENCODER_PROFILES)}"}), 400
+        target_format = target_format or str(outputs[0]["format"]).lower()
+    options = {k: request.form[k] for k in CONVERSION_OPTION_FIELDS if k in request.form}
+    if "profile" in options:
+        options["profile"] = options["profile"].lower()
+        if options["profile"] not in ENCODER_PROFILES:
+            return jsonify({"error": f"Invalid profile. Supported: {', '.join(ENCODER_PROFILES)}"}), 400
+    filename = secure_filename(file.filename if file else request.form['filename'])
     ext = filename.rsplit('.', 1)[-1].lower()
 
     # Descobrir serviço com base na extensão do ficheiro de origem!
     service = discover_service(ext)
     if not service:
         return jsonify({"error": "No service found for this format"}), 404
+    if service["Service"] == "service-text":
+        # Várias saídas de texto: um formato de cada, todos suportados a partir da origem
+        formats = [str(o["format"]).lower() for o in outputs] if outputs else [target_format]
+        unsupported = [f for f in formats if f"{ext}:{f}" not in TEXT_CONVERSIONS]
+        if unsupported:
+            return jsonify({"error": f"Unsupported conversion: {ext} -> {', '.join(unsupported)}"}), 400
+        if len(set(formats)) != len(formats):
+            return jsonify({"error": "Invalid outputs: each format can only be requested once"}), 400
+        if outputs:
+            target_format = "multi"
+    elif service["Service"] == "service-image":
+        # Validado aqui para que um formato inválido não seja aceite (202) e só falhe no worker
+        formats = [str(o["format"]).lower() for o in outputs] if outputs else [target_format]
+        unsupported = [f for f in formats if f not in IMAGE_OUTPUT_FORMATS]
+        if unsupported:
+            return jsonify({"error": f"Unsupported conversion: {ext} -> {', '.join(unsupported)}"}), 400
+
+    # Fast path síncrono (inline=true): conversões pequenas e baratas são feitas na hora, sem fila nem job
+    if request.form.get("inline", "").lower() in ("1", "true", "yes") and inline_eligible(service["Service"], ext, target_format, file, outputs):
+        try:
+            resp = convert_inline(service["Service"], file, filename, ext, target_format, trace_id, span_id)
+        except Exception as e:
+            logging.warning(f"Fast path indisponível ({e}), pedido enviado para a fila.")
+            file.stream.seek(0)
+            resp = None
+        if resp is not None:
+            INLINE_REQUESTS.labels(ext, target_format, "ok" if resp.status_code < 400 else "error").inc()
+            return resp
+        INLINE_REQUESTS.labels(ext, target_format, "fallback").inc()
+
+    queue_name = conversion_queue(service["Service"], ext, target_format)
 
-    # --- CALLBACK SYSTEM ---
-    callback_url = request.form.get("callback_url")
-    if not callback_url:
-        return jsonify({"error": "Missing callback_url"}), 400
+    # Backpressure: recusa o pedido antes de guardar o ficheiro se a fila de destino estiver sobrecarregada
+    if file:
+        size = request.content_length or 0
+    else:
+        size = os.path.getsize(blob_path(blob_sha256)) if os.path.exists(blob_path(blob_sha256)) else 0
+    rejection = admission.check(queue_name, size)
+    if rejection:
+        status, reason, retry_after = rejection
+        ADMISSION_REJECTIONS.labels(queue_name, reason).inc()
+        logging.warning(f"Pedido recusado pelo controlo de admissão ({queue_name}: {reason}), Retry-After {retry_after}s.")
+        resp = jsonify({"error": "Service overloaded, retry later", "queue": queue_name, "reason": reason, "retry_after": retry_after})
+        resp.headers["Retry-After"] = str(retry_after)
+        return resp, status
+    max_pending = TENANTS[tenant]["max_pending"]
+    if max_pending and scheduler.pending_count(tenant) >= max_pending:
+        TENANT_REJECTIONS.labels(tenant, "pending").inc()
+        logging.warning(f"Pedido recusado: o tenant {tenant} já tem {max_pending} pedidos à espera.")
+        resp = jsonify({"error": "Too many pending jobs for this tenant, retry later", "tenant": tenant, "reason": "pending",
+                        "retry_after": ADMISSION_RETRY_AFTER_DEFAULT})
+        resp.headers["Retry-After"] = str(ADMISSION_RETRY_AFTER_DEFAULT)
+        return resp, 429
+
+    # --- CALLBACK SYSTEM (opcional: sem callback_url o resultado fica disponível em /jobs/<id>/result) ---
+    callback_url = request.form.get("callback_url") or None
 
-    # Codifica o ficheiro em base64 para enviar na fila
-    file_bytes = file.read()
+    # O ficheiro segue na fila por referência ao store de conteúdos (só o SHA-256, não os bytes)
+    if file:
+        ingest_started_at, ingest_started = time.time(), time.perf_counter()
+        blob_sha256, size = store_blob(file)
+        add_blob_owner(blob_sha256, tenant)
+        ingest_seconds = time.perf_counter() - ingest_started
+        INGEST_SECONDS.labels(ext, target_format).observe(ingest_seconds)
+        emit_span("ingest", trace_id, new_span_id(), span_id, ingest_started_at, ingest_seconds, job_id, bytes=size)
+        INGEST_BYTES.labels(ext, target_format).inc(size)
+        logging.info(f"Conteúdo {blob_sha256} recebido ({size} bytes).")
+    elif touch_blob(blob_sha256, tenant):
+        BLOB_LOOKUPS.labels("hit").inc()
+        logging.info(f"Pedido por referência ao conteúdo {blob_sha256}: upload evitado.")
+    else:
+        BLOB_LOOKUPS.labels("miss").inc()
+        return jsonify({"error": "Blob not found"}), 404
     payload = {
+        "job_id": job_id,
+        "tenant": tenant,
         "filename": filename,
-        "file_bytes": base64.b64encode(file_bytes).decode("utf-8"),
+        "blob_sha256": blob_sha256,
         "target_format": target_format,
-        "callback_url": callback_url
+        "callback_url": callback_url,
+        "enqueued_at": time.time(),
     }
-    queue_name = "text_convert_queue" if service["Service"] == "service-text" else "image_convert_queue"
-    publish_to_queue(payload, queue_name)
-    logging.info(f"Pedido publicado em {queue_name} com callback_url: {callback_url}")
-    return jsonify({"status": "Pedido enviado para processamento assíncrono via RabbitMQ! O resultado será enviado para o callback_url."}), 202
+    if options:
+        payload["options"] = options
+    if outputs:
+        payload["outputs"] = outputs
+    # O pedido fica no escalonador (e no job.json, para sobreviver a um reinício) até ser a sua vez
+    headers = {"trace_id": trace_id, "parent_id": span_id, "job_id": job_id, "tenant": tenant}
+    accepted_at = time.time()
+    update_job(job_id, "queued", filename=filename, target_format=target_format, callback_url=callback_url, created_at=accepted_at,
+               trace_id=trace_id, tenant=tenant, queue=queue_name, size=size, dispatch={"payload": payload, "headers": headers})
+    scheduler.submit({"job_id": job_id, "tenant": tenant, "queue": queue_name, "payload": payload, "headers": headers,
+                      "size": size, "accepted_at": accepted_at})
+    input_mode = "upload" if file else "reference"
+    JOBS_SUBMITTED.labels(ext, target_format, input_mode).inc()
+    TENANT_JOBS.labels(tenant).inc()
+    emit_span("dispatcher.convert", trace_id, span_id, None, started_at, time.perf_counter() - started, job_id,
+              source=ext, target=target_format, input=input_mode, tenant=tenant)
+    logging.info(f"Pedido {job_id} do tenant {tenant} aceite para {queue_name} com callback_url: {callback_url}")
+    resp = jsonify({
+        "status": "Pedido enviado para processamento assíncrono via RabbitMQ! O resultado será enviado para o callback_url (se indicado) e fica disponível em result_url.",
+        "job_id": job_id,
+        "trace_id": trace_id,
+        "tenant": tenant,
+        "status_url": f"/jobs/{job_id}",
+        "result_url": f"/jobs/{job_id}/result",
+        "events_url": f"/jobs/{job_id}/events",
+    })
+    resp.headers["X-Trace-Id"] = trace_id
+    return resp, 202
+
+@app.route("/blobs/<sha256>", methods=["HEAD"])
+@auth.login_required
+def blob_head(sha256):
+    """
+    Indica se o conteúdo com este SHA-256 já foi enviado por este tenant (200, com Content-Length) ou não (404).
+    """
+    sha256 = sha256.lower()
+    if not SHA256_RE.match(sha256):
+        return Response(status=400)
+    if not touch_blob(sha256, auth.current_user()):
+        BLOB_LOOKUPS.labels("miss").inc()
+        return Response(status=404)
+    BLOB_LOOKUPS.labels("hit").inc()
+    resp = Response(status=200)
+    resp.headers["Content-Length"] = str(os.path.getsize(blob_path(sha256)))
+    resp.headers["ETag"] = f'"{sha256}"'
+    return resp
+
+@app.route("/jobs/<job_id>", methods=["GET"])
+@auth.login_required
+def job_status(job_id):
+    """
+    Estado do pedido e duração de cada etapa. Com ?wait=N faz long-poll até N segundos.
+    """
+    if not JOB_ID_RE.match(job_id):
+        return jsonify({"error": "Invalid job id"}), 400
+    wait = request.args.get("wait", type=float)
+    job = wait_for_job(job_id, wait) if wait else read_job(job_id)
+    job = owned_job(job)
+    if not job:
+        return jsonify({"error": "Job not found"}), 404
+    return jsonify(job_view(job)), 200
+
+@app.route("/jobs/<job_id>/events", methods=["GET"])
+@auth.login_required
+def job_events(job_id):
+    """
+    Server-sent events com cada mudança de estado do pedido, até chegar a um estado final.
+    """
+    if not JOB_ID_RE.match(job_id):
+        return jsonify({"error": "Invalid job id"}), 400
+    if not owned_job(read_job(job_id)):
+        return jsonify({"error": "Job not found"}), 404
+
+    def stream():
+        deadline = time.monotonic() + JOB_EVENTS_TIMEOUT
+        sent_events = -1
+        last_write = time.monotonic()
+        while time.monotonic() < deadline:
+            job = read_job(job_id)
+            if job is None:
+                yield "event: expired\ndata: {}\n\n"
+                return
+            if len(job.get("events", [])) != sent_events:
+                sent_events = len(job.get("events", []))
+                last_write = time.monotonic()
+                yield f"event: status\ndata: {json.dumps(job_view(job))}\n\n"
+                if job.get("status") in DONE_STATES:
+                    return
+            elif time.monotonic() - last_write > 15:
+                last_write = time.monotonic()
+                yield ": keep-alive\n\n"
+            time.sleep(JOB_POLL_INTERVAL)
+
+    return Response(stream(), mimetype="text/event-stream", headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
+@app.route("/jobs/<job_id>/result", methods=["GET"])
+@auth.login_required
+def job_result(job_id):
+    """
+    Descarrega o resultado do pedido (suporta pedidos HTTP Range). Com ?wait=N espera até N segundos.
+    """
+    if not JOB_ID_RE.match(job_id):
+        return jsonify({"error": "Invalid job id"}), 400
+    wait = request.args.get("wait", type=float)
+    job = owned_job(wait_for_job(job_id, wait) if wait else read_job(job_id))
+    if not job:
+        return jsonify({"error": "Job not found"}), 404
+    if job.get("status") == "failed":
+        return jsonify({"error": "Conversion failed", "detail": job.get("error")}), 409
+    result_path = os.path.join(RESULTS_DIR, job_id, job.get("result") or "")
+    if not job.get("result") or not os.path.isfile(result_path):
+        if job.get("status") not in DONE_STATES:
+            return jsonify({"status": job.get("status"), "message": "Result not ready yet"}), 202
+        return jsonify({"error": "Result no longer available", "status": job.get("status")}), 404
+    RESULT_DOWNLOADS.inc()
+    RESULT_DOWNLOAD_BYTES.inc(os.path.getsize(result_path))
+    return send_file(result_path, as_attachment=True, download_name=job["result"], conditional=True)
+
+@app.route("/metrics", methods=["GET"])
+def metrics():
+    try:
+        sample_queue_depths()
+    except Exception as e:
+        logging.warning(f"Não foi possível ler a profundidade das filas: {e}")
+    sample_store_sizes()
+    scheduler.sample_metrics()
+    return Response(generate_latest(), mimetype=CONTENT_TYPE_LATEST)
 
 @app.route("/health", methods=["GET"])
 def health():
@@ -113,6 +1127,10 @@ def health():
     return jsonify({"status": "ok", "opencl": OPENCL_AVAILABLE}), 200
 
 if __name__ == "__main__":
+    threading.Thread(target=cleanup_expired_jobs, daemon=True).start()
+    threading.Thread(target=cleanup_expired_blobs, daemon=True).start()
+    threading.Thread(target=admission_sampler, daemon=True).start()
+    scheduler.start()
     cert_path = os.path.join("certs", "server.crt")
     key_path = os.path.join("certs", "server.key")
     context = (cert_path, key_path)
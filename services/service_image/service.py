@@ -1,17 +1,31 @@
 import os
-from flask import Flask, request, send_file, jsonify, after_this_request
+from flask import Flask, request, send_file, jsonify, after_this_request, Response
 from flask_httpauth import HTTPBasicAuth
 from werkzeug.utils import secure_filename
 import logging
 import consul
 import tempfile
-import requests
+import shutil
+import uuid
+import time
+import functools
+import multiprocessing
+import concurrent.futures
+import zipfile
+from prometheus_client import Counter, Gauge, Histogram, generate_latest, CONTENT_TYPE_LATEST
 
 # --- RabbitMQ imports ---
 import pika
 import json
-import base64
 import threading
+import sys
+
+# Código comum aos componentes (pasta shared/ na raiz do repositório; nas imagens Docker é
+# copiada para /opt/shared, que está no PYTHONPATH)
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "../..")))
+from shared.tracing import JobContextFilter, set_log_context, init_tracing, new_span_id, emit_span, trace_context, StageTimings
+from shared.jobs import update_job, load_input, store_result, enqueue_delivery
+from shared.cgroup import cgroup_cpu_count
 
 # --- OpenCL imports ---
 try:
@@ -22,12 +36,72 @@ try:
 except ImportError:
     from PIL import Image
     OPENCL_AVAILABLE = False
+from PIL import features
 
 USERNAME = os.getenv("BASIC_AUTH_USERNAME", "admin")
 PASSWORD = os.getenv("BASIC_AUTH_PASSWORD", "admin_password")
 SERVICE_NAME = "service-image"
 SERVICE_PORT = 5002
 
+# Quando um worker morre (ex: OOM) todos os pedidos em curso no pool falham com BrokenProcessPool: cada
+# mensagem volta à fila com o cabeçalho worker_crashes incrementado e só depois de IMAGE_MAX_CRASHES
+# quedas o pedido fica "failed" e a mensagem segue para esta fila
+IMAGE_DEAD_LETTER_QUEUE = "image_convert_dead_letter_queue"
+IMAGE_MAX_CRASHES = int(os.getenv("IMAGE_MAX_CRASHES", "3"))
+
+# Quantização para GIF (valores por omissão, cada pedido pode escolher os seus)
+# Métodos: mediancut (comportamento antigo), fastoctree (rápido) e libimagequant (melhor qualidade, se disponível)
+GIF_QUANTIZE_METHOD = os.getenv("GIF_QUANTIZE_METHOD", "mediancut").lower()
+GIF_COLORS = int(os.getenv("GIF_COLORS", "256"))
+GIF_DITHER = os.getenv("GIF_DITHER", "false").lower() in ("1", "true", "yes")
+# Lado máximo (px) da cópia reduzida usada para calcular a paleta (0 = usa a imagem inteira)
+GIF_PALETTE_MAX_SIDE = int(os.getenv("GIF_PALETTE_MAX_SIDE", "0"))
+
+# Limites de tamanho das imagens
+# MAX_INPUT_PIXELS: tamanho máximo declarado no ficheiro, também usado como limite da proteção
+# "decompression bomb" do Pillow (que continua ligada para qualquer Image.open do processo)
+# MAX_IMAGE_PIXELS: máximo de píxeis efetivamente descodificados por pedido (cada pedido pode baixar com max_pixels)
+MAX_INPUT_PIXELS = int(os.getenv("MAX_INPUT_PIXELS", "1000000000"))
+MAX_IMAGE_PIXELS = int(os.getenv("MAX_IMAGE_PIXELS", "250000000"))
+Image.MAX_IMAGE_PIXELS = MAX_INPUT_PIXELS
+# Memória máxima (MB) usada por cada faixa no processamento OpenCL. Só o filtro OpenCL é feito por faixas:
+# a descodificação, a conversão de modo e a codificação do Pillow precisam da imagem inteira em memória.
+TILE_MEMORY_LIMIT_MB = int(os.getenv("TILE_MEMORY_LIMIT_MB", "64"))
+
+# Perfis de codificação (velocidade vs. tamanho) por formato de saída
+# "balanced" corresponde às opções por omissão do Pillow
+ENCODER_PROFILES = {
+    "fast": {
+        "PNG": {"compress_level": 1},
+        "JPEG": {"quality": 75},
+        "GIF": {},
+    },
+    "balanced": {
+        "PNG": {"compress_level": 6},
+        "JPEG": {"quality": 75},
+        "GIF": {},
+    },
+    "small": {
+        "PNG": {"compress_level": 9, "optimize": True},
+        "JPEG": {"quality": 70, "optimize": True, "progressive": True},
+        "GIF": {"optimize": True},
+    },
+}
+DEFAULT_ENCODER_PROFILE = os.getenv("ENCODER_PROFILE", "balanced").lower()
+
+# Pedidos com várias saídas ("decode once, encode many")
+# MAX_OUTPUTS: máximo de saídas por pedido; IMAGE_OUTPUT_THREADS: saídas codificadas em paralelo
+MAX_OUTPUTS = int(os.getenv("MAX_OUTPUTS", "8"))
+IMAGE_OUTPUT_THREADS = int(os.getenv("IMAGE_OUTPUT_THREADS", "4"))
+
+# Pool de processos para as conversões (o Pillow é CPU-bound)
+# IMAGE_WORKERS: número de processos (0 = calculado a partir da quota de CPU do cgroup)
+# IMAGE_MAX_INFLIGHT: máximo de mensagens RabbitMQ em processamento/espera (0 = 2 x workers)
+# IMAGE_WORKER_MAX_TASKS: cada processo é reciclado após este número de conversões
+IMAGE_WORKERS = int(os.getenv("IMAGE_WORKERS", "0"))
+IMAGE_MAX_INFLIGHT = int(os.getenv("IMAGE_MAX_INFLIGHT", "0"))
+IMAGE_WORKER_MAX_TASKS = int(os.getenv("IMAGE_WORKER_MAX_TASKS", "50"))
+
 # Configuração de logs
 base_log_dir = os.path.abspath(os.path.join(os.path.dirname(__file__), "../../logs"))
 if not os.path.exists(base_log_dir):
@@ -40,7 +114,7 @@ log_file = os.path.join(log_dir, "service-image-logs.txt")
 # --- Configuração manual dos handlers (igual ao service_text) ---
 logger = logging.getLogger()
 logger.setLevel(logging.INFO)
-formatter = logging.Formatter("%(asctime)s - %(levelname)s - %(message)s")
+formatter = logging.Formatter("%(asctime)s - %(levelname)s - [%(trace_id)s %(job_id)s] %(message)s")
 
 # Remove handlers antigos (importante para evitar duplicados)
 if logger.hasHandlers():
@@ -48,13 +122,18 @@ if logger.hasHandlers():
 
 file_handler = logging.FileHandler(log_file, encoding="utf-8")
 file_handler.setFormatter(formatter)
+file_handler.addFilter(JobContextFilter())
 logger.addHandler(file_handler)
 
 stream_handler = logging.StreamHandler()
 stream_handler.setFormatter(formatter)
+stream_handler.addFilter(JobContextFilter())
 logger.addHandler(stream_handler)
 # --- FIM DA CORREÇÃO ---
 
+# --- Tracing --- (spans em JSON, ver shared/tracing.py)
+init_tracing("service-image", os.path.join(base_log_dir, "traces", "service-image-spans.jsonl"))
+
 app = Flask(__name__)
 auth = HTTPBasicAuth()
 
@@ -63,114 +142,484 @@ def verify_password(username, password):
     logging.info(f"Autenticação recebida para o utilizador: {username}")
     return username == USERNAME and password == PASSWORD
 
-def opencl_invert_image(img_path):
+# --- Métricas Prometheus (expostas em /metrics) ---
+# As conversões correm nos processos do pool: cada worker mede as etapas do seu pedido (StageTimings)
+# e devolve-as ao processo principal, que é o único a registar métricas.
+STAGE_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600)
+STAGE_SECONDS = Histogram("conversion_stage_seconds", "Duração de cada etapa da conversão (segundos)", ["source", "target", "stage"], buckets=STAGE_BUCKETS)
+JOB_SECONDS = Histogram("conversion_job_seconds", "Duração total da conversão no serviço (segundos)", ["source", "target"], buckets=STAGE_BUCKETS)
+JOBS_TOTAL = Counter("conversion_jobs_total", "Pedidos de conversão processados", ["source", "target", "outcome"])
+JOBS_IN_FLIGHT = Gauge("conversion_jobs_in_flight", "Pedidos de conversão em curso ou à espera no pool")
+BYTES_IN = Counter("conversion_input_bytes_total", "Bytes de entrada convertidos", ["source", "target"])
+BYTES_OUT = Counter("conversion_output_bytes_total", "Bytes de resultados produzidos", ["source", "target"])
+WORKERS = Gauge("conversion_workers", "Workers de conversão disponíveis")
+WORKER_BUSY_SECONDS = Counter("conversion_worker_busy_seconds_total", "Tempo total dos workers ocupados com conversões (segundos)")
+
+# Cada processo do pool converte um pedido de cada vez
+stage_timings = StageTimings()
+
+def run_timed(fn, *args):
+    """
+    Corre fn num processo do pool e devolve (resultado, tempos por etapa, duração total).
+    """
+    stage_timings.reset()
+    start = time.perf_counter()
+    result = fn(*args)
+    return result, dict(stage_timings.seconds), time.perf_counter() - start
+
+def record_job_metrics(source, target, outcome, stages, busy_seconds, bytes_in=0, bytes_out=0):
+    for stage, seconds in stages.items():
+        STAGE_SECONDS.labels(source, target, stage).observe(seconds)
+    JOB_SECONDS.labels(source, target).observe(busy_seconds)
+    JOBS_TOTAL.labels(source, target, outcome).inc()
+    BYTES_IN.labels(source, target).inc(bytes_in)
+    BYTES_OUT.labels(source, target).inc(bytes_out)
+    WORKER_BUSY_SECONDS.inc(busy_seconds)
+
+class ImageTooLargeError(ValueError):
+    pass
+
+INVERT_KERNEL = """
+__kernel void invert(__global uchar *data) {
+    int i = get_global_id(0);
+    data[i] = 255 - data[i];
+}
+"""
+
+def opencl_invert_image(img):
+    """
+    Exemplo de processamento OpenCL: inverte as cores da imagem (em memória).
+    A imagem é processada em faixas horizontais para que a memória usada por faixa
+    (host + dispositivo) fique abaixo de TILE_MEMORY_LIMIT_MB, mesmo em digitalizações enormes.
+    """
     if not OPENCL_AVAILABLE:
-        return
+        return img
     try:
-        img = Image.open(img_path).convert("RGB")
-        img_np = np.array(img).astype(np.uint8)
-        flat_img = img_np.flatten()
-
         ctx = cl.create_some_context()
         queue = cl.CommandQueue(ctx)
+        prg = cl.Program(ctx, INVERT_KERNEL).build()
         mf = cl.mem_flags
-        buf = cl.Buffer(ctx, mf.READ_WRITE | mf.COPY_HOST_PTR, hostbuf=flat_img)
-
-        kernel = """
-        __kernel void invert(__global uchar *data) {
-            int i = get_global_id(0);
-            data[i] = 255 - data[i];
-        }
-        """
-        prg = cl.Program(ctx, kernel).build()
-        prg.invert(queue, flat_img.shape, None, buf)
-        result = np.empty_like(flat_img)
-        cl.enqueue_copy(queue, result, buf)
-        img_out = Image.fromarray(result.reshape(img_np.shape))
-        img_out.save(img_path)
-        logging.info(f"Imagem processada com OpenCL (inversão de cores): {img_path}")
+
+        if img.mode != "RGB":
+            img = img.convert("RGB")
+        width, height = img.size
+        # Cada faixa existe ~4 vezes: recorte, array numpy, buffer no dispositivo e resultado
+        rows = max(1, (TILE_MEMORY_LIMIT_MB * 1024 * 1024) // (width * 3 * 4))
+        tiles = 0
+        for top in range(0, height, rows):
+            box = (0, top, width, min(top + rows, height))
+            tile = np.asarray(img.crop(box), dtype=np.uint8)
+            flat_tile = tile.ravel()
+            buf = cl.Buffer(ctx, mf.READ_WRITE | mf.COPY_HOST_PTR, hostbuf=flat_tile)
+            prg.invert(queue, flat_tile.shape, None, buf)
+            result = np.empty_like(flat_tile)
+            cl.enqueue_copy(queue, result, buf)
+            buf.release()
+            img.paste(Image.fromarray(result.reshape(tile.shape)), box)
+            tiles += 1
+        logging.info(f"Imagem processada com OpenCL (inversão de cores) em {tiles} faixa(s) de até {rows} linhas.")
     except Exception as e:
         logging.warning(f"Erro ao processar imagem com OpenCL: {e}")
+    return img
+
+GIF_QUANTIZE_METHODS = {
+    "mediancut": Image.Quantize.MEDIANCUT,
+    "fastoctree": Image.Quantize.FASTOCTREE,
+    "libimagequant": Image.Quantize.LIBIMAGEQUANT,
+}
+IMAGE_OPTION_FIELDS = ["quantize", "colors", "dither", "palette_max_side", "max_width", "max_height", "max_pixels", "profile"]
+OUTPUT_OPTION_FIELDS = ["quantize", "colors", "dither", "palette_max_side", "max_width", "max_height", "profile"]
+LIBIMAGEQUANT_AVAILABLE = bool(features.check_feature("libimagequant"))
+
+def option_bool(value, default=False):
+    if value is None or value == "":
+        return default
+    if isinstance(value, bool):
+        return value
+    return str(value).lower() in ("1", "true", "yes", "on")
+
+def quantize_for_gif(img, method=None, colors=None, dither=None, palette_max_side=None):
+    """
+    Reduz a imagem a uma paleta de cores para GIF.
+    Se palette_max_side for indicado, a paleta é calculada numa cópia reduzida da imagem
+    e depois aplicada à imagem original, o que é muito mais rápido em fotografias grandes.
+    """
+    method = (method or GIF_QUANTIZE_METHOD).lower()
+    if method not in GIF_QUANTIZE_METHODS:
+        raise ValueError(f"Método de quantização inválido: {method}. Suportados: {', '.join(GIF_QUANTIZE_METHODS)}")
+    if method == "libimagequant" and not LIBIMAGEQUANT_AVAILABLE:
+        logging.warning("libimagequant não disponível neste Pillow, a usar fastoctree.")
+        method = "fastoctree"
+    colors = max(2, min(256, int(colors or GIF_COLORS)))
+    dither = option_bool(dither, GIF_DITHER)
+    palette_max_side = int(palette_max_side if palette_max_side not in (None, "") else GIF_PALETTE_MAX_SIDE)
+
+    if img.mode != "RGB":
+        img = img.convert("RGB")
+
+    source = img
+    if palette_max_side > 0 and max(img.size) > palette_max_side:
+        source = img.copy()
+        source.thumbnail((palette_max_side, palette_max_side), Image.Resampling.BILINEAR)
+    palette_img = source.quantize(colors=colors, method=GIF_QUANTIZE_METHODS[method])
+    if source is img and not dither:
+        return palette_img
+    # Aplica a paleta calculada à imagem em resolução original
+    return img.quantize(palette=palette_img, dither=Image.Dither.FLOYDSTEINBERG if dither else Image.Dither.NONE)
+
+def encoder_params(pil_format, profile=None):
+    """
+    Parâmetros do encoder do Pillow para o formato e perfil indicados ("fast", "balanced" ou "small").
+    """
+    profile = (profile or DEFAULT_ENCODER_PROFILE).lower()
+    if profile not in ENCODER_PROFILES:
+        raise ValueError(f"Perfil de codificação inválido: {profile}. Suportados: {', '.join(ENCODER_PROFILES)}")
+    return dict(ENCODER_PROFILES[profile].get(pil_format, {}))
+
+def open_image(input_path, options):
+    """
+    Abre a imagem aplicando os limites de píxeis e, se o pedido indicar max_width/max_height
+    menores que a imagem, descodifica em resolução reduzida (JPEG: draft a 1/2, 1/4 ou 1/8)
+    e redimensiona para caber nessas dimensões.
+    """
+    max_width = int(options.get("max_width") or 0)
+    max_height = int(options.get("max_height") or 0)
+    max_pixels = min(int(options.get("max_pixels") or MAX_IMAGE_PIXELS), MAX_IMAGE_PIXELS)
 
-def save_image_with_opencl(img, output_path, output_format):
-    img.save(output_path, output_format)
     try:
-        opencl_invert_image(output_path)
-    except Exception as e:
-        logging.warning(f"OpenCL não disponível ou erro ao inverter imagem: {e}")
+        img = Image.open(input_path)
+    except Image.DecompressionBombError as e:
+        raise ImageTooLargeError(str(e)) from e
+    try:
+        if img.width * img.height > MAX_INPUT_PIXELS:
+            raise ImageTooLargeError(f"Imagem com {img.width}x{img.height} píxeis excede o limite de entrada ({MAX_INPUT_PIXELS} píxeis)")
+        target = None
+        if max_width or max_height:
+            target = (min(max_width or img.width, img.width), min(max_height or img.height, img.height))
+            if target == img.size:
+                target = None
+            else:
+                img.draft(None, target)
+        if img.width * img.height > max_pixels:
+            raise ImageTooLargeError(f"Imagem com {img.width}x{img.height} píxeis excede o limite do pedido ({max_pixels} píxeis)")
+        if target:
+            img.thumbnail(target, Image.Resampling.LANCZOS)
+        else:
+            img.load()
+    except Exception:
+        img.close()
+        raise
+    return img
+
+def finish_image(img, output_path, output_format, options):
+    """
+    Prepara a imagem já descodificada para o formato de saída (modo de cor, OpenCL, paleta GIF)
+    e codifica-a em output_path com o perfil pedido.
+    """
+    if output_format in ["jpg", "jpeg"]:
+        if img.mode in ("RGBA", "LA"):
+            background = Image.new("RGB", img.size, (255, 255, 255))
+            background.paste(img, mask=img.split()[-1])
+            img = background
+        else:
+            img = img.convert("RGB")
+    # Pós-processamento com OpenCL (exemplo: inverter cores), por faixas
+    if OPENCL_AVAILABLE:
+        with stage_timings.stage("opencl"):
+            img = opencl_invert_image(img)
+    if output_format == "gif":
+        with stage_timings.stage("quantize"):
+            img = quantize_for_gif(
+                img,
+                method=options.get("quantize"),
+                colors=options.get("colors"),
+                dither=options.get("dither"),
+                palette_max_side=options.get("palette_max_side"),
+            )
+    format_map = {"jpg": "JPEG", "jpeg": "JPEG", "png": "PNG", "gif": "GIF"}
+    pil_format = format_map.get(output_format, output_format.upper())
+    with stage_timings.stage("encode"):
+        img.save(output_path, pil_format, **encoder_params(pil_format, options.get("profile")))
     return output_path
 
-def process_image_conversion(data):
+def convert_image_file(input_path, output_path, output_format, options=None):
+    """
+    Converte a imagem em input_path para output_format e guarda em output_path.
+    options pode conter as opções de quantização GIF (quantize, colors, dither, palette_max_side)
+    e os limites de tamanho (max_width, max_height, max_pixels) e o perfil de codificação (profile).
+    """
+    options = options or {}
+    with stage_timings.stage("decode"):
+        img = open_image(input_path, options)
+    with img:
+        finish_image(img, output_path, output_format, options)
+    return output_path
+
+def parse_outputs(outputs):
+    """
+    Valida a lista de saídas de um pedido "decode once, encode many", por exemplo:
+    [{"format": "jpg", "max_width": 200, "max_height": 200, "profile": "small", "name": "thumb"}, {"format": "png"}]
+    """
+    if isinstance(outputs, str):
+        outputs = json.loads(outputs)
+    if not isinstance(outputs, list) or not outputs:
+        raise ValueError("outputs tem de ser uma lista não vazia")
+    if len(outputs) > MAX_OUTPUTS:
+        raise ValueError(f"Máximo de {MAX_OUTPUTS} saídas por pedido")
+    parsed = []
+    names = set()
+    for i, spec in enumerate(outputs):
+        if not isinstance(spec, dict) or not spec.get("format"):
+            raise ValueError(f"Saída {i + 1} inválida: falta o campo format")
+        spec = {k: spec[k] for k in OUTPUT_OPTION_FIELDS + ["format", "name"] if k in spec}
+        spec["format"] = str(spec["format"]).lower()
+        if spec["format"] not in ["jpg", "jpeg", "png", "gif"]:
+            raise ValueError(f"Formato de saída inválido: {spec['format']}")
+        if spec.get("profile") and str(spec["profile"]).lower() not in ENCODER_PROFILES:
+            raise ValueError(f"Perfil de codificação inválido: {spec['profile']}")
+        spec["name"] = secure_filename(str(spec.get("name") or i + 1))
+        if not spec["name"] or spec["name"] in names:
+            raise ValueError(f"Nome de saída inválido ou repetido: {spec.get('name')}")
+        names.add(spec["name"])
+        parsed.append(spec)
+    return parsed
+
+def render_output(base, output_path, spec, options):
+    """
+    Produz uma saída a partir da imagem base partilhada (que nunca é alterada).
+    """
+    # Um campo em falta ou null na saída herda o valor do pedido (ex: "profile": null usa o perfil do pedido)
+    spec_options = {**options, **{k: spec[k] for k in OUTPUT_OPTION_FIELDS if spec.get(k) is not None}}
+    max_width = int(spec.get("max_width") or 0)
+    max_height = int(spec.get("max_height") or 0)
+    img = base
+    if (max_width and max_width < base.width) or (max_height and max_height < base.height):
+        img = base.copy()
+        img.thumbnail((max_width or base.width, max_height or base.height), Image.Resampling.LANCZOS)
+    elif OPENCL_AVAILABLE and base.mode == "RGB":
+        # A inversão OpenCL escreve por faixas na própria imagem
+        img = base.copy()
+    return finish_image(img, output_path, spec["format"], spec_options)
+
+def convert_image_outputs(input_path, zip_path, outputs, options=None):
     """
-    Função para processar pedidos vindos do RabbitMQ.
-    Agora envia o resultado para o callback_url fornecido.
+    Descodifica a imagem uma única vez e gera todas as saídas pedidas em paralelo
+    (formatos, tamanhos e perfis diferentes), entregues juntas num ZIP.
     """
+    options = options or {}
+    decode_options = dict(options)
+    if all(spec.get("max_width") and spec.get("max_height") for spec in outputs):
+        # Todas as saídas são reduzidas: basta descodificar até ao tamanho da maior
+        for key in ("max_width", "max_height"):
+            largest = max(int(spec[key]) for spec in outputs)
+            decode_options[key] = min(int(options.get(key) or largest), largest)
+    stem = os.path.splitext(os.path.basename(input_path))[0]
+    output_dir = os.path.dirname(zip_path)
+    paths = [os.path.join(output_dir, f"{stem}_{spec['name']}.{spec['format']}") for spec in outputs]
+
+    with stage_timings.stage("decode"):
+        base = open_image(input_path, decode_options)
+    with base:
+        if base.mode == "P":
+            base = base.convert("RGBA" if "transparency" in base.info else "RGB")
+        workers = min(len(outputs), IMAGE_OUTPUT_THREADS)
+        with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+            futures = [executor.submit(render_output, base, path, spec, options) for path, spec in zip(paths, outputs)]
+            for future in futures:
+                future.result()
+
+    with stage_timings.stage("zip"), zipfile.ZipFile(zip_path, "w") as zipf:
+        for path in paths:
+            zipf.write(path, os.path.basename(path))
+            os.remove(path)
+    logging.info(f"{len(paths)} saídas geradas a partir de uma única descodificação: {zip_path}")
+    return zip_path
+
+def process_image_conversion(data, trace=None):
+    """
+    Função para processar pedidos vindos do RabbitMQ (corre num processo do worker pool).
+    O resultado é publicado na fila de entrega, que o envia para o callback_url fornecido.
+    trace é o contexto de tracing recebido nos cabeçalhos da mensagem; os spans são emitidos pelo worker.
+    Devolve os dados do pedido para as métricas (origem, destino, resultado e bytes).
+    """
+    work_dir = tempfile.mkdtemp(prefix="service-image-")
+    job_id = data.get("job_id") or uuid.uuid4().hex
+    trace = trace or {"trace_id": uuid.uuid4().hex, "parent_id": None}
+    span_id = new_span_id()
+    trace_headers = {"trace_id": trace["trace_id"], "parent_id": span_id, "job_id": job_id}
+    set_log_context(trace["trace_id"], job_id)
+    started_at, started = time.time(), time.perf_counter()
+    stats = {"source": "unknown", "target": "unknown", "outcome": "failed", "bytes_in": 0, "bytes_out": 0}
     try:
+        update_job(job_id, "processing")
         filename = data["filename"]
-        file_bytes = base64.b64decode(data["file_bytes"])
         output_format = data["output_format"] if "output_format" in data else data.get("target_format")
         callback_url = data.get("callback_url")
-        input_path = os.path.join(tempfile.gettempdir(), filename)
-        with open(input_path, "wb") as f:
-            f.write(file_bytes)
-
-        output_path = input_path.rsplit('.', 1)[0] + f".{output_format}"
+        options = data.get("options", {})
+        stats["source"] = filename.rsplit('.', 1)[-1].lower()
+        stats["target"] = "multi" if data.get("outputs") else str(output_format).lower()
+        if data.get("enqueued_at"):
+            stage_timings.add("queue_wait", max(0.0, time.time() - float(data["enqueued_at"])))
+        input_path = os.path.join(work_dir, filename)
+        with stage_timings.stage("input"):
+            load_input(data, input_path)
+        stats["bytes_in"] = os.path.getsize(input_path)
 
-        with Image.open(input_path) as img:
-            if output_format in ["jpg", "jpeg"]:
-                if img.mode in ("RGBA", "LA"):
-                    background = Image.new("RGB", img.size, (255, 255, 255))
-                    background.paste(img, mask=img.split()[-1])
-                    img = background
-                else:
-                    img = img.convert("RGB")
-            elif output_format == "gif":
-                img = img.convert("P", palette=Image.ADAPTIVE)
-            format_map = {"jpg": "JPEG", "jpeg": "JPEG", "png": "PNG", "gif": "GIF"}
-            save_image_with_opencl(img, output_path, format_map.get(output_format, output_format.upper()))
-        logging.info(f"Ficheiro {filename} convertido com sucesso para {output_format.upper()}.")
-
-        # --- CALLBACK: envia o ficheiro convertido para o callback_url ---
-        if callback_url and os.path.exists(output_path):
-            with open(output_path, "rb") as f:
-                files = {"file": (os.path.basename(output_path), f)}
-                try:
-                    resp = requests.post(callback_url, files=files, timeout=30)
-                    if resp.status_code == 200:
-                        logging.info(f"Ficheiro enviado com sucesso para callback_url: {callback_url}")
-                    else:
-                        logging.error(f"Falha ao enviar ficheiro para callback_url: {callback_url} | Status: {resp.status_code}")
-                except Exception as e:
-                    logging.error(f"Erro ao fazer callback para {callback_url}: {e}")
+        if data.get("outputs"):
+            # Várias saídas: uma descodificação, entrega única num ZIP
+            outputs = parse_outputs(data["outputs"])
+            output_path = input_path.rsplit('.', 1)[0] + "_outputs.zip"
+            convert_image_outputs(input_path, output_path, outputs, options)
+            logging.info(f"Ficheiro {filename} convertido com sucesso para {len(outputs)} saídas.")
+        else:
+            output_path = input_path.rsplit('.', 1)[0] + f".{output_format}"
+            convert_image_file(input_path, output_path, output_format, options)
+            logging.info(f"Ficheiro {filename} convertido com sucesso para {output_format.upper()}.")
 
-        # Limpeza
-        if os.path.exists(input_path):
-            os.remove(input_path)
-        if os.path.exists(output_path):
-            os.remove(output_path)
+        # Guarda o resultado no store de resultados e, com callback, entrega-o através da fila de entrega
+        result_filename = os.path.basename(output_path)
+        stats["bytes_out"] = os.path.getsize(output_path)
+        with stage_timings.stage("store"):
+            result_path = store_result(job_id, output_path, result_filename)
+        if callback_url:
+            with stage_timings.stage("enqueue_delivery"):
+                enqueue_delivery(job_id, result_path, result_filename, callback_url, trace_headers)
+        stats["outcome"] = "ok"
     except Exception as e:
         logging.error(f"Erro ao processar pedido RabbitMQ: {e}")
+        update_job(job_id, "failed", error=str(e))
+    finally:
+        # Limpeza
+        shutil.rmtree(work_dir, ignore_errors=True)
+        if data.get("enqueued_at"):
+            enqueued_at = float(data["enqueued_at"])
+            emit_span("queue_wait", trace["trace_id"], new_span_id(), trace["parent_id"], enqueued_at, max(0.0, started_at - enqueued_at), job_id)
+        stage_timings.emit_spans(trace["trace_id"], span_id, job_id)
+        emit_span(f"{SERVICE_NAME}.convert", trace["trace_id"], span_id, trace["parent_id"], started_at, time.perf_counter() - started, job_id,
+                  worker_pid=os.getpid(), **stats)
+        set_log_context()
+    return stats
+
+worker_pool = None
+worker_pool_lock = threading.Lock()
+
+def get_worker_pool(broken=None):
+    """
+    Devolve o pool de processos partilhado pelo consumidor RabbitMQ e pelo endpoint /convert.
+    Com broken, substitui esse pool partido (ex: processo morto por falta de memória), se ainda for o
+    atual: várias threads podem detetar a mesma falha e só a primeira cria um pool novo.
+    """
+    global worker_pool
+    with worker_pool_lock:
+        if broken is not None and worker_pool is broken:
+            worker_pool.shutdown(wait=False, cancel_futures=False)
+            worker_pool = None
+        if worker_pool is None:
+            workers = IMAGE_WORKERS or cgroup_cpu_count()
+            # "spawn" é necessário para reciclar processos (max_tasks_per_child)
+            worker_pool = concurrent.futures.ProcessPoolExecutor(
+                max_workers=workers,
+                mp_context=multiprocessing.get_context("spawn"),
+                max_tasks_per_child=IMAGE_WORKER_MAX_TASKS,
+            )
+            WORKERS.set(workers)
+            logging.info(f"Pool de conversão criado com {workers} processo(s), reciclados a cada {IMAGE_WORKER_MAX_TASKS} conversões.")
+        return worker_pool
+
+def submit_to_pool(fn, *args):
+    pool = get_worker_pool()
+    try:
+        return pool.submit(fn, *args)
+    except concurrent.futures.process.BrokenProcessPool:
+        logging.warning("Pool de conversão partido, a criar um novo.")
+        return get_worker_pool(broken=pool).submit(fn, *args)
+
+def worker_crashes(properties):
+    headers = getattr(properties, "headers", None) or {}
+    try:
+        return int(headers.get("worker_crashes") or 0)
+    except (TypeError, ValueError):
+        return 0
 
 def rabbitmq_consumer():
     """
     Thread para consumir pedidos RabbitMQ.
+    Cada mensagem é entregue ao pool de processos; o prefetch limita o trabalho em curso
+    e o ack só é enviado quando a conversão termina.
     """
-    def callback(ch, method, properties, body):
-        try:
-            data = json.loads(body)
-            process_image_conversion(data)
-        except Exception as e:
-            logging.error(f"Erro no callback RabbitMQ: {e}")
-        ch.basic_ack(delivery_tag=method.delivery_tag)
+    workers = IMAGE_WORKERS or cgroup_cpu_count()
+    max_inflight = IMAGE_MAX_INFLIGHT or workers * 2
 
     while True:
         try:
             connection = pika.BlockingConnection(pika.ConnectionParameters(host='rabbitmq'))
             channel = connection.channel()
+
+            def ack(delivery_tag, publish=None, channel=channel):
+                # publish: (fila, corpo, propriedades) a publicar antes do ack (dead-letter ou nova tentativa)
+                if not channel.is_open:
+                    return
+                if publish:
+                    queue_name, body, properties = publish
+                    channel.basic_publish(exchange='', routing_key=queue_name, body=body, properties=properties)
+                channel.basic_ack(delivery_tag=delivery_tag)
+
+            def on_done(delivery_tag, future, job_id, body, properties, connection=connection, ack=ack):
+                # Corre numa thread do pool: o ack tem de ser feito na thread da ligação
+                JOBS_IN_FLIGHT.dec()
+                publish = None
+                try:
+                    stats, stages, busy_seconds = future.result()
+                    record_job_metrics(
+                        stats["source"], stats["target"], stats["outcome"], stages, busy_seconds,
+                        stats["bytes_in"], stats["bytes_out"],
+                    )
+                except concurrent.futures.process.BrokenProcessPool as e:
+                    # Um worker morreu e partiu o pool: este pedido pode não ser o culpado, por isso volta à
+                    # fila; só depois de IMAGE_MAX_CRASHES quedas falha e segue para a dead-letter
+                    crashes = worker_crashes(properties) + 1
+                    if crashes < IMAGE_MAX_CRASHES:
+                        logging.warning(f"Pool de conversão partido ({crashes} de {IMAGE_MAX_CRASHES}), o pedido volta à fila: {e}")
+                        if job_id:
+                            update_job(job_id, "retrying", error=f"Conversion worker crashed: {e}", worker_crashes=crashes)
+                        headers = {**(getattr(properties, "headers", None) or {}), "worker_crashes": crashes}
+                        publish = ("image_convert_queue", body, pika.BasicProperties(delivery_mode=2, headers=headers))
+                    else:
+                        logging.error(f"Pool de conversão partido {crashes} vezes com este pedido, segue para a dead-letter: {e}")
+                        if job_id:
+                            update_job(job_id, "failed", error=f"Conversion worker crashed {crashes} times: {e}")
+                        publish = (IMAGE_DEAD_LETTER_QUEUE, body, properties)
+                except Exception as e:
+                    logging.error(f"Erro no worker de conversão: {e}")
+                    if job_id:
+                        update_job(job_id, "failed", error=f"Conversion worker failed: {e}")
+                    publish = (IMAGE_DEAD_LETTER_QUEUE, body, properties)
+                try:
+                    connection.add_callback_threadsafe(functools.partial(ack, delivery_tag, publish))
+                except Exception as e:
+                    logging.error(f"Não foi possível confirmar a mensagem {delivery_tag}: {e}")
+
+            def callback(ch, method, properties, body):
+                try:
+                    data = json.loads(body)
+                    future = submit_to_pool(run_timed, process_image_conversion, data, trace_context(properties))
+                except Exception as e:
+                    logging.error(f"Erro no callback RabbitMQ: {e}")
+                    ch.basic_ack(delivery_tag=method.delivery_tag)
+                    return
+                JOBS_IN_FLIGHT.inc()
+                # on_done é ligado já (e não procurado na altura do callback): após uma nova ligação,
+                # os pedidos da ligação anterior não podem ser confirmados no canal novo
+                future.add_done_callback(
+                    lambda f, tag=method.delivery_tag, job_id=data.get("job_id"), body=body, properties=properties, on_done=on_done:
+                        on_done(tag, f, job_id, body, properties)
+                )
+
+            channel.queue_declare(queue=IMAGE_DEAD_LETTER_QUEUE, durable=True)
             channel.queue_declare(queue='image_convert_queue', durable=True)
-            channel.basic_qos(prefetch_count=1)
+            channel.basic_qos(prefetch_count=max_inflight)
             channel.basic_consume(queue='image_convert_queue', on_message_callback=callback)
-            logging.info("A consumir pedidos RabbitMQ em image_convert_queue...")
+            logging.info(f"A consumir pedidos RabbitMQ em image_convert_queue ({workers} workers, até {max_inflight} em curso)...")
             channel.start_consuming()
         except Exception as e:
             logging.error(f"Erro na ligação ao RabbitMQ: {e}")
@@ -190,53 +639,66 @@ def convert_image():
         return jsonify({"error": "No selected file"}), 400
 
     filename = secure_filename(file.filename)
-    input_path = os.path.join(tempfile.gettempdir(), filename)
-    file.save(input_path)
-
+    outputs = None
     output_format = request.form.get("format", "").lower()
-    if output_format not in ["jpg", "png", "gif"]:
+    if request.form.get("outputs"):
+        try:
+            outputs = parse_outputs(request.form["outputs"])
+        except ValueError as e:
+            logging.warning(f"Lista de saídas inválida: {e}")
+            return jsonify({"error": f"Invalid outputs: {e}"}), 400
+    elif output_format not in ["jpg", "png", "gif"]:
         logging.warning("Formato de destino inválido.")
         return jsonify({"error": "Invalid format. Supported formats: jpg, png, gif"}), 400
+    options = {k: request.form[k] for k in IMAGE_OPTION_FIELDS if k in request.form}
+    if options.get("quantize") and options["quantize"].lower() not in GIF_QUANTIZE_METHODS:
+        logging.warning("Método de quantização inválido.")
+        return jsonify({"error": f"Invalid quantize method. Supported: {', '.join(GIF_QUANTIZE_METHODS)}"}), 400
+    if options.get("profile") and options["profile"].lower() not in ENCODER_PROFILES:
+        logging.warning("Perfil de codificação inválido.")
+        return jsonify({"error": f"Invalid profile. Supported: {', '.join(ENCODER_PROFILES)}"}), 400
 
-    output_path = input_path.rsplit('.', 1)[0] + f".{output_format}"
+    # Pasta própria por pedido: pedidos em simultâneo com o mesmo nome de ficheiro (ex: vindos do
+    # fast path inline do dispatcher) não se sobrepõem
+    work_dir = tempfile.mkdtemp(prefix="service-image-sync-")
+    input_path = os.path.join(work_dir, filename)
+    file.save(input_path)
+    if outputs:
+        output_path = input_path.rsplit('.', 1)[0] + "_outputs.zip"
+    else:
+        output_path = input_path.rsplit('.', 1)[0] + f".{output_format}"
 
+    source = filename.rsplit('.', 1)[-1].lower()
+    target = "multi" if outputs else output_format
+    JOBS_IN_FLIGHT.inc()
     try:
-        with Image.open(input_path) as img:
-            if output_format in ["jpg", "jpeg"]:
-                if img.mode in ("RGBA", "LA"):
-                    background = Image.new("RGB", img.size, (255, 255, 255))
-                    background.paste(img, mask=img.split()[-1])
-                    img = background
-                else:
-                    img = img.convert("RGB")
-            elif output_format == "gif":
-                img = img.convert("P", palette=Image.ADAPTIVE)
-            format_map = {"jpg": "JPEG", "jpeg": "JPEG", "png": "PNG", "gif": "GIF"}
-            save_image_with_opencl(img, output_path, format_map.get(output_format, output_format.upper()))
-        logging.info(f"Ficheiro {filename} convertido com sucesso para {output_format.upper()}.")
+        # A conversão corre no pool de processos, tal como os pedidos RabbitMQ
+        if outputs:
+            _, stages, busy_seconds = submit_to_pool(run_timed, convert_image_outputs, input_path, output_path, outputs, options).result()
+            logging.info(f"Ficheiro {filename} convertido com sucesso para {len(outputs)} saídas.")
+        else:
+            _, stages, busy_seconds = submit_to_pool(run_timed, convert_image_file, input_path, output_path, output_format, options).result()
+            logging.info(f"Ficheiro {filename} convertido com sucesso para {output_format.upper()}.")
+        record_job_metrics(source, target, "ok", stages, busy_seconds, os.path.getsize(input_path), os.path.getsize(output_path))
 
         @after_this_request
         def cleanup(response):
-            try:
-                if os.path.exists(input_path):
-                    os.remove(input_path)
-                if os.path.exists(output_path):
-                    os.remove(output_path)
-            except Exception as e:
-                logging.error(f"Erro ao remover ficheiros temporários: {e}")
+            shutil.rmtree(work_dir, ignore_errors=True)
             return response
 
         return send_file(output_path, as_attachment=True)
     except Exception as e:
         logging.error(f"Erro ao converter {filename}: {e}")
-        try:
-            if os.path.exists(input_path):
-                os.remove(input_path)
-            if os.path.exists(output_path):
-                os.remove(output_path)
-        except Exception as err:
-            logging.error(f"Erro ao remover ficheiros temporários após erro: {err}")
-        return jsonify({"error": str(e)}), 500
+        JOBS_TOTAL.labels(source, target, "failed").inc()
+        status = 413 if isinstance(e, ImageTooLargeError) else 500
+        shutil.rmtree(work_dir, ignore_errors=True)
+        return jsonify({"error": str(e)}), status
+    finally:
+        JOBS_IN_FLIGHT.dec()
+
+@app.route("/metrics", methods=["GET"])
+def metrics():
+    return Response(generate_latest(), mimetype=CONTENT_TYPE_LATEST)
 
 @app.route("/health", methods=["GET"])
 def health():
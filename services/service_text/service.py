@@ -1,35 +1,34 @@
 import os
-from flask import Flask, request, send_file, jsonify, after_this_request
+from flask import Flask, request, send_file, jsonify, after_this_request, Response
 from flask_httpauth import HTTPBasicAuth
 from werkzeug.utils import secure_filename
-from docx2pdf import convert
-from pdf2image import convert_from_path
-from pdf2docx import Converter
-from docx import Document
 import logging
-import sys
 import consul
 import tempfile
 import zipfile
 import subprocess
 import concurrent.futures
-import requests
+import shutil
+import uuid
+import time
+import hashlib
+import contextlib
+import functools
+from prometheus_client import Counter, Gauge, Histogram, generate_latest, CONTENT_TYPE_LATEST
 
 # --- RabbitMQ imports ---
 import pika
 import json
-import base64
 import threading
+import socket
+import sys
 
-# --- OpenCL imports ---
-try:
-    import pyopencl as cl
-    import numpy as np
-    from PIL import Image
-    OPENCL_AVAILABLE = True
-except ImportError:
-    from PIL import Image
-    OPENCL_AVAILABLE = False
+# Código comum aos componentes (pasta shared/ na raiz do repositório; nas imagens Docker é
+# copiada para /opt/shared, que está no PYTHONPATH)
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "../..")))
+from shared.tracing import JobContextFilter, set_log_context, init_tracing, new_span_id, emit_span, trace_context, StageTimings
+from shared.jobs import update_job, load_input, store_result, enqueue_delivery
+from shared.cgroup import cgroup_cpu_count
 
 # Configurações
 USERNAME = os.getenv("BASIC_AUTH_USERNAME", "admin")
@@ -37,6 +36,60 @@ PASSWORD = os.getenv("BASIC_AUTH_PASSWORD", "admin_password")
 SERVICE_NAME = "service-text"
 SERVICE_PORT = 5001
 
+# Área de trabalho de cada pedido (WORK_DIR/<job_id>), com os checkpoints: PDF intermédio e páginas já
+# codificadas. Se a conversão falhar (ou o processo morrer), a mensagem volta à fila e a tentativa
+# seguinte continua a partir da última página concluída, até TEXT_MAX_ATTEMPTS tentativas; depois disso
+# o pedido falha e a mensagem segue para TEXT_DEAD_LETTER_QUEUE.
+WORK_DIR = os.getenv("WORK_DIR", os.path.join(tempfile.gettempdir(), "conv-work"))
+CHECKPOINT_FILE = "checkpoint.json"
+TEXT_MAX_ATTEMPTS = int(os.getenv("TEXT_MAX_ATTEMPTS", "3"))
+TEXT_DEAD_LETTER_QUEUE = "text_convert_dead_letter_queue"
+# Uma falha temporária espera numa fila de atraso (TEXT_RETRY_QUEUE.<fila>.<ms>, TTL no nome) antes de
+# voltar à fila de origem: TEXT_RETRY_BACKOFF_BASE x 2^(n-1) segundos, até TEXT_RETRY_BACKOFF_MAX
+TEXT_RETRY_QUEUE = "text_convert_retry_queue"
+TEXT_RETRY_BACKOFF_BASE = float(os.getenv("TEXT_RETRY_BACKOFF_BASE", "5"))
+TEXT_RETRY_BACKOFF_MAX = float(os.getenv("TEXT_RETRY_BACKOFF_MAX", "300"))
+# Páginas rasterizadas de cada vez (limita a memória e a perda numa falha)
+RASTER_CHUNK_PAGES = int(os.getenv("RASTER_CHUNK_PAGES", "10"))
+# Documentos grandes (pedidos para PNG com pelo menos SHARD_MIN_PAGES páginas) são divididos em partes de
+# SHARD_PAGES páginas, publicadas na fila pdf:png: qualquer réplica rasteriza a sua parte a partir do PDF
+# na área de trabalho partilhada (volume work) e a última parte a terminar junta as páginas num ZIP
+# ordenado e faz uma única entrega. SHARD_MIN_PAGES=0 desliga.
+SHARD_MIN_PAGES = int(os.getenv("SHARD_MIN_PAGES", "60"))
+SHARD_PAGES = int(os.getenv("SHARD_PAGES", "20"))
+SHARD_MANIFEST = "shards.json"
+# O lock da junção guarda o dono (host, pid) e a hora: um lock cujo processo morreu, ou com mais de
+# MERGE_LOCK_TIMEOUT segundos, é retomado por outra parte ou pela verificação periódica (MERGE_SWEEP_INTERVAL)
+MERGE_LOCK = "merge.lock"
+MERGE_LOCK_TIMEOUT = int(os.getenv("MERGE_LOCK_TIMEOUT", "1800"))
+MERGE_SWEEP_INTERVAL = int(os.getenv("MERGE_SWEEP_INTERVAL", "60"))
+
+# Governador de memória: os pedidos e os lotes de páginas reservam a memória estimada num orçamento
+# comum (MEMORY_BUDGET_FRACTION do limite de memória do cgroup, ou TEXT_MEMORY_BUDGET_MB). Um pedido só
+# começa quando a sua memória mínima cabe no orçamento; cada lote de páginas usa tantas páginas e threads
+# (até RASTER_CHUNK_PAGES / PAGE_THREADS) quantas a memória livre nesse momento permitir.
+TEXT_MAX_JOBS = int(os.getenv("TEXT_MAX_JOBS", "0"))  # pedidos em simultâneo (0 = CPUs do contentor)
+TEXT_MEMORY_BUDGET_MB = int(os.getenv("TEXT_MEMORY_BUDGET_MB", "0"))
+MEMORY_BUDGET_FRACTION = float(os.getenv("MEMORY_BUDGET_FRACTION", "0.75"))
+PAGE_THREADS = int(os.getenv("PAGE_THREADS", "5"))
+RASTER_DPI = 200  # resolução por omissão do pdf2image
+# Estimativas de memória: página RGB descodificada x PAGE_MEMORY_FACTOR (buffer PPM, cópias OpenCL,
+# codificação PNG), LibreOffice por processo e pdf2docx (base + por página)
+PAGE_MEMORY_FACTOR = float(os.getenv("PAGE_MEMORY_FACTOR", "3"))
+LIBREOFFICE_MEMORY_MB = int(os.getenv("LIBREOFFICE_MEMORY_MB", "400"))
+PDF2DOCX_MEMORY_MB = int(os.getenv("PDF2DOCX_MEMORY_MB", "150"))
+PDF2DOCX_PAGE_MEMORY_MB = float(os.getenv("PDF2DOCX_PAGE_MEMORY_MB", "4"))
+A4_POINTS = (595.0, 842.0)
+
+# Perfis de codificação PNG das páginas (velocidade vs. tamanho)
+# "balanced" corresponde às opções por omissão do Pillow
+PNG_ENCODER_PROFILES = {
+    "fast": {"compress_level": 1},
+    "balanced": {"compress_level": 6},
+    "small": {"compress_level": 9, "optimize": True},
+}
+DEFAULT_ENCODER_PROFILE = os.getenv("ENCODER_PROFILE", "balanced").lower()
+
 # Configuração de logs
 base_log_dir = os.path.abspath(os.path.join(os.path.dirname(__file__), "../../logs"))
 if not os.path.exists(base_log_dir):
@@ -49,7 +102,7 @@ log_file = os.path.join(log_dir, "service-text-logs.txt")
 # --- Configuração manual dos handlers ---
 logger = logging.getLogger()
 logger.setLevel(logging.INFO)
-formatter = logging.Formatter("%(asctime)s - %(levelname)s - %(message)s")
+formatter = logging.Formatter("%(asctime)s - %(levelname)s - [%(trace_id)s %(job_id)s] %(message)s")
 
 # Remove handlers antigos (importante para evitar duplicados)
 if logger.hasHandlers():
@@ -57,13 +110,18 @@ if logger.hasHandlers():
 
 file_handler = logging.FileHandler(log_file, encoding="utf-8")
 file_handler.setFormatter(formatter)
+file_handler.addFilter(JobContextFilter())
 logger.addHandler(file_handler)
 
 stream_handler = logging.StreamHandler()
 stream_handler.setFormatter(formatter)
+stream_handler.addFilter(JobContextFilter())
 logger.addHandler(stream_handler)
 # --- FIM DA CORREÇÃO ---
 
+# --- Tracing --- (spans em JSON, ver shared/tracing.py)
+init_tracing("service-text", os.path.join(base_log_dir, "traces", "service-text-spans.jsonl"))
+
 app = Flask(__name__)
 auth = HTTPBasicAuth()
 
@@ -72,12 +130,188 @@ def verify_password(username, password):
     logging.info(f"Autenticação recebida para o utilizador: {username}")
     return username == USERNAME and password == PASSWORD
 
+# --- Métricas Prometheus (expostas em /metrics) ---
+# Durações até 10 minutos: as etapas vão de milissegundos (ZIP) a minutos (LibreOffice em documentos grandes)
+STAGE_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600)
+STAGE_SECONDS = Histogram("conversion_stage_seconds", "Duração de cada etapa da conversão (segundos)", ["source", "target", "stage"], buckets=STAGE_BUCKETS)
+JOB_SECONDS = Histogram("conversion_job_seconds", "Duração total da conversão no serviço (segundos)", ["source", "target"], buckets=STAGE_BUCKETS)
+JOBS_TOTAL = Counter("conversion_jobs_total", "Pedidos de conversão processados", ["source", "target", "outcome"])
+JOBS_IN_FLIGHT = Gauge("conversion_jobs_in_flight", "Pedidos de conversão em curso")
+BYTES_IN = Counter("conversion_input_bytes_total", "Bytes de entrada convertidos", ["source", "target"])
+BYTES_OUT = Counter("conversion_output_bytes_total", "Bytes de resultados produzidos", ["source", "target"])
+WORKERS = Gauge("conversion_workers", "Workers de conversão disponíveis")
+WORKER_BUSY_SECONDS = Counter("conversion_worker_busy_seconds_total", "Tempo total dos workers ocupados com conversões (segundos)")
+MEMORY_BUDGET = Gauge("conversion_memory_budget_bytes", "Orçamento de memória do governador")
+MEMORY_RESERVED = Gauge("conversion_memory_reserved_bytes", "Memória reservada pelos pedidos e lotes de páginas em curso")
+PAGE_BATCH_SIZE = Histogram("conversion_page_batch_pages", "Páginas por lote, conforme a memória livre", buckets=(1, 2, 3, 5, 10, 20, 50))
+
+def record_job_metrics(source, target, outcome, stages, busy_seconds, bytes_in=0, bytes_out=0):
+    for stage, seconds in stages.items():
+        STAGE_SECONDS.labels(source, target, stage).observe(seconds)
+    JOB_SECONDS.labels(source, target).observe(busy_seconds)
+    JOBS_TOTAL.labels(source, target, outcome).inc()
+    BYTES_IN.labels(source, target).inc(bytes_in)
+    BYTES_OUT.labels(source, target).inc(bytes_out)
+    WORKER_BUSY_SECONDS.inc(busy_seconds)
+
+def read_int(path):
+    try:
+        with open(path) as f:
+            value = f.read().strip()
+        return None if value == "max" else int(value)
+    except (OSError, ValueError):
+        return None
+
+def memory_stat(path, key):
+    try:
+        with open(path) as f:
+            for line in f:
+                name, value = line.split()
+                if name == key:
+                    return int(value)
+    except (OSError, ValueError):
+        pass
+    return 0
+
+def cgroup_memory_limit():
+    """
+    Limite de memória do contentor (cgroup v2: memory.max, v1: memory.limit_in_bytes),
+    ou a memória física da máquina se não houver limite.
+    """
+    physical = os.sysconf("SC_PAGE_SIZE") * os.sysconf("SC_PHYS_PAGES")
+    limit = read_int("/sys/fs/cgroup/memory.max") or read_int("/sys/fs/cgroup/memory/memory.limit_in_bytes")
+    # cgroup v1 sem limite devolve um valor enorme (ex: 9223372036854771712)
+    return min(limit, physical) if limit else physical
+
+def cgroup_memory_usage():
+    """
+    Memória em uso pelo contentor, sem a cache de ficheiros inativa (que o kernel pode libertar).
+    None se o cgroup não estiver disponível.
+    """
+    usage = read_int("/sys/fs/cgroup/memory.current")
+    if usage is not None:
+        return usage - memory_stat("/sys/fs/cgroup/memory.stat", "inactive_file")
+    usage = read_int("/sys/fs/cgroup/memory/memory.usage_in_bytes")
+    if usage is not None:
+        return usage - memory_stat("/sys/fs/cgroup/memory/memory.stat", "total_inactive_file")
+    return None
+
+class MemoryGovernor:
+    """
+    Orçamento de memória partilhado pelos pedidos em curso. acquire bloqueia até a reserva caber
+    (ou até não haver nada reservado: um pedido maior do que o orçamento corre sozinho);
+    try_acquire concede só as unidades que cabem já, tendo também em conta a memória realmente em uso no cgroup.
+    """
+    def __init__(self, budget):
+        self.budget = budget
+        self.reserved = 0
+        self.condition = threading.Condition()
+        MEMORY_BUDGET.set(budget)
+
+    def acquire(self, nbytes):
+        with self.condition:
+            self.condition.wait_for(lambda: self.reserved == 0 or self.reserved + nbytes <= self.budget)
+            self.reserved += nbytes
+            MEMORY_RESERVED.set(self.reserved)
+
+    def try_acquire(self, unit, max_units):
+        if unit <= 0 or max_units <= 0:
+            return 0
+        usage = cgroup_memory_usage()
+        with self.condition:
+            free = self.budget - self.reserved
+            if usage is not None:
+                # Memória em uso para além das reservas (ex: estimativas por baixo) também conta
+                free = min(free, self.budget - usage)
+            units = max(0, min(max_units, int(free // unit)))
+            self.reserved += units * unit
+            MEMORY_RESERVED.set(self.reserved)
+            return units
+
+    def release(self, nbytes):
+        with self.condition:
+            self.reserved = max(0, self.reserved - nbytes)
+            MEMORY_RESERVED.set(self.reserved)
+            self.condition.notify_all()
+
+    @contextlib.contextmanager
+    def reserve(self, nbytes):
+        self.acquire(nbytes)
+        try:
+            yield
+        finally:
+            self.release(nbytes)
+
+governor = MemoryGovernor(TEXT_MEMORY_BUDGET_MB * 1024 * 1024 or int(cgroup_memory_limit() * MEMORY_BUDGET_FRACTION))
+TEXT_JOB_WORKERS = TEXT_MAX_JOBS or cgroup_cpu_count()
+WORKERS.set(TEXT_JOB_WORKERS)
+
+def page_memory(width_pts, height_pts, dpi=RASTER_DPI):
+    """
+    Memória estimada para uma página em curso (descodificada em RGB e codificada).
+    """
+    return int(width_pts / 72 * dpi * height_pts / 72 * dpi * 3 * PAGE_MEMORY_FACTOR)
+
+def pdf_page_info(pdf_path):
+    """
+    Número de páginas e tamanho da primeira página (em pontos) de um PDF.
+    """
+    from pdf2image import pdfinfo_from_path
+
+    info = pdfinfo_from_path(pdf_path)
+    try:
+        # ex: "595.276 x 841.89 pts (A4)"
+        width, _, height = info["Page size"].split()[:3]
+        size = (float(width), float(height))
+    except (KeyError, ValueError):
+        size = A4_POINTS
+    return info["Pages"], size
+
+def estimate_job_memory(input_path, source, target):
+    """
+    Estima a memória de um pedido antes de começar: devolve (mínimo para avançar, pico com
+    todos os lotes de páginas em paralelo), em bytes. O governador reserva o mínimo durante todo o pedido.
+    """
+    mb = 1024 * 1024
+    if source == "docx":
+        # O número de páginas só se sabe depois do LibreOffice: assume A4
+        page = page_memory(*A4_POINTS)
+        libreoffice = LIBREOFFICE_MEMORY_MB * mb
+        if target == "png":
+            return max(libreoffice, page), max(libreoffice, page * RASTER_CHUNK_PAGES)
+        return libreoffice, libreoffice
+    pages, size = pdf_page_info(input_path)
+    if target == "png":
+        page = page_memory(*size)
+        return page, page * min(pages, RASTER_CHUNK_PAGES)
+    pdf2docx = int((PDF2DOCX_MEMORY_MB + pages * PDF2DOCX_PAGE_MEMORY_MB) * mb)
+    return pdf2docx, pdf2docx
+
+def run_converter(convert, input_path, source, target, profile=None, timings=None, checkpoint=False):
+    """
+    Corre o conversor depois de reservar no governador a memória mínima estimada do pedido.
+    """
+    try:
+        floor, peak = estimate_job_memory(input_path, source, target)
+    except Exception as e:
+        logging.warning(f"Não foi possível estimar a memória do pedido: {e}")
+        floor = peak = page_memory(*A4_POINTS)
+    logging.info(f"Memória estimada: mínimo {floor // 2**20} MB, pico {peak // 2**20} MB "
+                 f"(reservado {governor.reserved // 2**20} de {governor.budget // 2**20} MB)")
+    started = time.perf_counter()
+    governor.acquire(floor)
+    if timings is not None:
+        timings.add("admission", time.perf_counter() - started)
+    try:
+        return convert(input_path, profile, timings, checkpoint=checkpoint)
+    finally:
+        governor.release(floor)
+
 def convert_docx_to_pdf(input_path, output_path):
     """
     Converte DOCX para PDF usando docx2pdf (Windows) ou LibreOffice (Linux/Docker).
     """
     import shutil
-    import sys
     import platform
 
     output_dir = os.path.dirname(output_path)
@@ -95,10 +329,13 @@ def convert_docx_to_pdf(input_path, output_path):
                 logging.error(f"docx2pdf falhou no Windows: {e}", exc_info=True)
                 return False
         else:
-            # Usa LibreOffice em Linux/Docker
+            # Usa LibreOffice em Linux/Docker, com um perfil próprio por conversão: várias instâncias
+            # com o mesmo perfil não correm em paralelo
+            profile_dir = tempfile.mkdtemp(prefix="lo-profile-")
             try:
                 subprocess.run([
-                    "libreoffice", "--headless", "--convert-to", "pdf", input_path, "--outdir", output_dir
+                    "libreoffice", f"-env:UserInstallation=file://{profile_dir}",
+                    "--headless", "--convert-to", "pdf", input_path, "--outdir", output_dir
                 ], check=True)
                 base = os.path.splitext(os.path.basename(input_path))[0]
                 converted_pdf = os.path.join(output_dir, base + ".pdf")
@@ -108,18 +345,34 @@ def convert_docx_to_pdf(input_path, output_path):
             except Exception as e:
                 logging.error(f"Erro ao converter DOCX para PDF com LibreOffice: {e}", exc_info=True)
                 return False
+            finally:
+                shutil.rmtree(profile_dir, ignore_errors=True)
     except Exception as e:
         logging.error(f"Erro inesperado na conversão DOCX para PDF: {e}", exc_info=True)
         return False
 
-def opencl_invert_image(img_path):
+@functools.lru_cache(maxsize=None)
+def opencl_modules():
+    """
+    Importa o pyopencl e o NumPy na primeira utilização. Devolve (cl, np), ou None se não estiverem instalados.
+    """
+    try:
+        import pyopencl as cl
+        import numpy as np
+    except ImportError:
+        return None
+    return cl, np
+
+def opencl_invert_image(img):
     """
-    Exemplo de processamento OpenCL: inverte as cores da imagem PNG.
+    Exemplo de processamento OpenCL: inverte as cores da imagem (em memória).
     """
-    if not OPENCL_AVAILABLE:
-        return
+    if opencl_modules() is None:
+        return img
+    cl, np = opencl_modules()
+    from PIL import Image
     try:
-        img = Image.open(img_path).convert("RGB")
+        img = img.convert("RGB")
         img_np = np.array(img).astype(np.uint8)
         flat_img = img_np.flatten()
 
@@ -138,117 +391,675 @@ def opencl_invert_image(img_path):
         prg.invert(queue, flat_img.shape, None, buf)
         result = np.empty_like(flat_img)
         cl.enqueue_copy(queue, result, buf)
-        img_out = Image.fromarray(result.reshape(img_np.shape))
-        img_out.save(img_path)
-        logging.info(f"Imagem processada com OpenCL (inversão de cores): {img_path}")
+        img = Image.fromarray(result.reshape(img_np.shape))
+        logging.info("Imagem processada com OpenCL (inversão de cores).")
     except Exception as e:
         logging.warning(f"Erro ao processar imagem com OpenCL: {e}")
+    return img
 
-def save_image(img, img_path):
-    img.save(img_path, 'PNG')
-    # Pós-processamento com OpenCL (exemplo: inverter cores)
+def png_encoder_params(profile=None):
+    """
+    Parâmetros do encoder PNG do Pillow para o perfil indicado ("fast", "balanced" ou "small").
+    """
+    profile = (profile or DEFAULT_ENCODER_PROFILE).lower()
+    if profile not in PNG_ENCODER_PROFILES:
+        raise ValueError(f"Perfil de codificação inválido: {profile}. Suportados: {', '.join(PNG_ENCODER_PROFILES)}")
+    return dict(PNG_ENCODER_PROFILES[profile])
+
+def save_image(img, img_path, profile=None, timings=None):
+    # Pós-processamento com OpenCL (exemplo: inverter cores), antes de codificar uma única vez
     try:
-        opencl_invert_image(img_path)
+        if timings is not None and opencl_modules() is not None:
+            with timings.stage("opencl"):
+                img = opencl_invert_image(img)
+        else:
+            img = opencl_invert_image(img)
     except Exception as e:
         logging.warning(f"OpenCL não disponível ou erro ao inverter imagem: {e}")
+    img.save(img_path, 'PNG', **png_encoder_params(profile))
     return img_path
 
-def process_text_conversion(data):
+# --- Registo de conversores ---
+# Cada par origem:destino é um conversor registado com @converter, que recebe o ficheiro de entrada e
+# devolve a lista de ficheiros produzidos. As dependências pesadas (pdf2image, pdf2docx, pyopencl/NumPy)
+# só são importadas na primeira conversão que as usa.
+# ENABLED_CONVERSIONS limita os pares que esta réplica converte e consome (ex: "docx:pdf,pdf:png");
+# vazio = todos. Cada par tem a sua fila (text_convert_queue.<origem>.<destino>); os pedidos com várias
+# saídas usam text_convert_queue.<origem>.multi, consumida pelas réplicas com todos os pares da origem.
+TEXT_CONVERT_QUEUE = "text_convert_queue"
+CONVERTERS = {}
+
+class ConversionError(Exception):
+    """
+    Falha da conversão. Com retry=False o pedido falha logo, sem novas tentativas.
+    """
+    def __init__(self, message, retry=True):
+        super().__init__(message)
+        self.retry = retry
+
+def converter(source, target):
+    def register(fn):
+        CONVERTERS[f"{source}:{target}"] = fn
+        return fn
+    return register
+
+def timed(timings, name):
+    return timings.stage(name) if timings is not None else contextlib.nullcontext()
+
+def page_path(base_path, page):
+    return f"{base_path}_page_{page:03d}.png"
+
+def rasterize_pdf(pdf_path, base_path, profile=None, timings=None, resume=False, first_page=1, last_page=None):
+    """
+    Converte cada página do PDF (ou só as páginas first_page a last_page) numa imagem PNG, por lotes de
+    páginas consecutivas codificadas em paralelo. O tamanho de cada lote (até RASTER_CHUNK_PAGES) e o
+    número de threads (até PAGE_THREADS) dependem da memória livre no governador no início do lote; a
+    primeira página de cada lote está coberta pela reserva mínima do pedido (ver run_converter).
+    Cada página só aparece com o nome final depois de escrita por inteiro, por isso com resume=True as
+    páginas que já existem (de uma tentativa anterior) não são convertidas de novo.
+    Devolve os caminhos das páginas, por ordem.
+    """
+    from pdf2image import convert_from_path
+
+    pages, size = pdf_page_info(pdf_path)
+    page_bytes = page_memory(*size)
+    last_page = min(last_page or pages, pages)
+    page_paths = {i: page_path(base_path, i) for i in range(first_page, last_page + 1)}
+    missing = [i for i in page_paths if not (resume and os.path.exists(page_paths[i]))]
+    logging.info(f"Total de páginas a processar: {len(missing)} de {len(page_paths)}")
+
+    def process_page(page_img):
+        page, img = page_img
+        img_path = page_paths[page]
+        # Nome temporário único: entregas repetidas da mesma parte podem escrever a mesma página em simultâneo
+        part_path = f"{img_path}.{uuid.uuid4().hex}.part"
+        save_image(img, part_path, profile, timings)
+        os.replace(part_path, img_path)
+
+    while missing:
+        # Páginas consecutivas em falta, até RASTER_CHUNK_PAGES
+        run = 1
+        while run < min(len(missing), RASTER_CHUNK_PAGES) and missing[run] == missing[0] + run:
+            run += 1
+        extra = governor.try_acquire(page_bytes, run - 1)
+        batch = missing[:1 + extra]
+        missing = missing[len(batch):]
+        PAGE_BATCH_SIZE.observe(len(batch))
+        try:
+            with timed(timings, "rasterize"):
+                images = convert_from_path(pdf_path, first_page=batch[0], last_page=batch[-1])
+            threads = min(len(batch), PAGE_THREADS)
+            with timed(timings, "encode"), concurrent.futures.ThreadPoolExecutor(max_workers=threads) as executor:
+                list(executor.map(process_page, zip(batch, images)))
+            del images
+        finally:
+            governor.release(extra * page_bytes)
+    return [page_paths[i] for i in sorted(page_paths)]
+
+@converter("docx", "pdf")
+def docx_to_pdf(input_path, profile=None, timings=None, checkpoint=False):
+    output_path = os.path.splitext(input_path)[0] + ".pdf"
+    logging.info(f"Convertendo DOCX para PDF: {input_path} -> {output_path}")
+    with timed(timings, "libreoffice"):
+        if not convert_docx_to_pdf(input_path, output_path):
+            raise ConversionError("DOCX to PDF conversion failed")
+    return [output_path]
+
+def libreoffice_pdf(input_path, timings=None, checkpoint=False):
+    """
+    PDF intermédio de um DOCX (LibreOffice), partilhado pela rasterização das páginas e, num pedido
+    com várias saídas, pela saída PDF. Com checkpoint=True é reutilizado se já existir de uma
+    tentativa anterior (o LibreOffice não volta a correr).
+    """
+    temp_pdf = os.path.splitext(input_path)[0] + "_temp.pdf"
+    if checkpoint and os.path.exists(temp_pdf):
+        logging.info(f"A retomar a partir do PDF temporário: {temp_pdf}")
+        return temp_pdf
+    logging.info(f"Convertendo DOCX para PDF temporário: {input_path} -> {temp_pdf}")
+    with timed(timings, "libreoffice"):
+        if not convert_docx_to_pdf(input_path, temp_pdf):
+            raise ConversionError("DOCX to PDF conversion failed")
+    return temp_pdf
+
+@converter("docx", "png")
+def docx_to_png(input_path, profile=None, timings=None, checkpoint=False):
+    """
+    Com checkpoint=True o PDF intermédio fica na área de trabalho do pedido até todas as páginas
+    estarem convertidas, e é reutilizado numa nova tentativa.
+    """
+    base_path = os.path.splitext(input_path)[0]
+    temp_pdf = libreoffice_pdf(input_path, timings, checkpoint)
+    try:
+        page_paths = rasterize_pdf(temp_pdf, base_path, profile, timings, resume=checkpoint)
+    except Exception:
+        if not checkpoint and os.path.exists(temp_pdf):
+            os.remove(temp_pdf)
+        raise
+    os.remove(temp_pdf)
+    return page_paths
+
+@converter("pdf", "docx")
+def pdf_to_docx(input_path, profile=None, timings=None, checkpoint=False):
+    from pdf2docx import Converter
+
+    output_path = os.path.splitext(input_path)[0] + ".docx"
+    logging.info(f"Convertendo PDF para DOCX: {input_path} -> {output_path}")
+    with timed(timings, "pdf2docx"):
+        cv = Converter(input_path)
+        try:
+            cv.convert(output_path, start=0, end=None)
+        finally:
+            cv.close()
+    return [output_path]
+
+@converter("pdf", "png")
+def pdf_to_png(input_path, profile=None, timings=None, checkpoint=False):
+    logging.info(f"Convertendo PDF para PNG(s): {input_path}")
+    return rasterize_pdf(input_path, os.path.splitext(input_path)[0], profile, timings, resume=checkpoint)
+
+ENABLED_CONVERSIONS = [p.strip().lower() for p in os.getenv("ENABLED_CONVERSIONS", "").split(",") if p.strip()] or list(CONVERTERS)
+_unknown_conversions = [p for p in ENABLED_CONVERSIONS if p not in CONVERTERS]
+if _unknown_conversions:
+    raise RuntimeError(f"ENABLED_CONVERSIONS inválido: {', '.join(_unknown_conversions)}. Suportados: {', '.join(CONVERTERS)}")
+
+def get_converter(source, target):
+    """
+    Conversor do par origem:destino, ou None se o par não existir ou não estiver ativo nesta réplica.
+    """
+    pair = f"{source}:{target}"
+    return CONVERTERS[pair] if pair in ENABLED_CONVERSIONS else None
+
+def conversion_queue(pair):
+    return f"{TEXT_CONVERT_QUEUE}.{pair.replace(':', '.')}"
+
+def parse_outputs(source, outputs):
+    """
+    Valida a lista de saídas de um pedido com vários formatos de destino a partir do mesmo ficheiro,
+    por exemplo [{"format": "pdf"}, {"format": "png", "profile": "small"}].
+    Cada formato só pode aparecer uma vez e todos os pares têm de estar ativos nesta réplica.
+    """
+    if isinstance(outputs, str):
+        outputs = json.loads(outputs)
+    if not isinstance(outputs, list) or not outputs:
+        raise ValueError("outputs tem de ser uma lista não vazia")
+    parsed = []
+    for i, spec in enumerate(outputs):
+        if not isinstance(spec, dict) or not spec.get("format"):
+            raise ValueError(f"Saída {i + 1} inválida: falta o campo format")
+        spec = {"format": str(spec["format"]).lower(), "profile": str(spec.get("profile") or "").lower() or None}
+        if get_converter(source, spec["format"]) is None:
+            raise ValueError(f"Conversão não suportada: {source} -> {spec['format']}")
+        if spec["profile"] and spec["profile"] not in PNG_ENCODER_PROFILES:
+            raise ValueError(f"Perfil de codificação inválido: {spec['profile']}")
+        if any(p["format"] == spec["format"] for p in parsed):
+            raise ValueError(f"Formato de saída repetido: {spec['format']}")
+        parsed.append(spec)
+    return parsed
+
+def convert_outputs(input_path, source, outputs, timings=None, checkpoint=False):
+    """
+    Gera várias saídas a partir do mesmo ficheiro. Os intermédios partilhados são calculados uma só
+    vez (de um DOCX, o PDF do LibreOffice serve tanto a saída PDF como a rasterização das páginas) e
+    as saídas são produzidas em paralelo. Devolve a lista de ficheiros produzidos, por ordem das saídas.
+    """
+    base_path = os.path.splitext(input_path)[0]
+    pdf_path = input_path if source == "pdf" else None
+    if source == "docx" and any(spec["format"] in ("pdf", "png") for spec in outputs):
+        pdf_path = libreoffice_pdf(input_path, timings, checkpoint)
+
+    def produce(spec):
+        target = spec["format"]
+        if source == "docx" and target == "pdf":
+            shutil.copyfile(pdf_path, base_path + ".pdf")
+            return [base_path + ".pdf"]
+        if target == "png":
+            return rasterize_pdf(pdf_path, base_path, spec["profile"], timings, resume=checkpoint)
+        # Sem intermédio partilhado (ex: pdf:docx): conversor do par
+        return get_converter(source, target)(input_path, spec["profile"], timings, checkpoint=checkpoint)
+
+    try:
+        with concurrent.futures.ThreadPoolExecutor(max_workers=len(outputs)) as executor:
+            results = list(executor.map(produce, outputs))
+    except Exception:
+        if source == "docx" and pdf_path and not checkpoint and os.path.exists(pdf_path):
+            os.remove(pdf_path)
+        raise
+    if source == "docx" and pdf_path:
+        os.remove(pdf_path)
+    logging.info(f"{len(outputs)} saídas geradas ({', '.join(spec['format'] for spec in outputs)}) a partir de {input_path}")
+    return [f for files in results for f in files]
+
+def run_outputs(input_path, source, outputs, timings=None, checkpoint=False):
+    """
+    Como run_converter, para um pedido com várias saídas. Num DOCX o LibreOffice corre sozinho antes
+    das saídas, pelo que basta a maior das reservas mínimas; num PDF as saídas correm em paralelo desde
+    o início e as reservas somam-se.
+    """
+    floors = []
+    for spec in outputs:
+        try:
+            floors.append(estimate_job_memory(input_path, source, spec["format"])[0])
+        except Exception as e:
+            logging.warning(f"Não foi possível estimar a memória do pedido: {e}")
+            floors.append(page_memory(*A4_POINTS))
+    floor = max(floors) if source == "docx" else sum(floors)
+    logging.info(f"Memória mínima estimada para {len(outputs)} saídas: {floor // 2**20} MB "
+                 f"(reservado {governor.reserved // 2**20} de {governor.budget // 2**20} MB)")
+    started = time.perf_counter()
+    governor.acquire(floor)
+    if timings is not None:
+        timings.add("admission", time.perf_counter() - started)
+    try:
+        return convert_outputs(input_path, source, outputs, timings, checkpoint)
+    finally:
+        governor.release(floor)
+
+def multi_output_sources():
+    """
+    Formatos de origem cujos pedidos com várias saídas esta réplica consome (fila
+    text_convert_queue.<origem>.multi): os que têm todos os pares ativos.
+    """
+    sources = sorted({pair.split(":")[0] for pair in CONVERTERS})
+    return [src for src in sources if all(p in ENABLED_CONVERSIONS for p in CONVERTERS if p.startswith(f"{src}:"))]
+
+def start_attempt(workspace):
+    """
+    Regista uma nova tentativa no checkpoint da área de trabalho do pedido e devolve o número da tentativa.
+    """
+    path = os.path.join(workspace, CHECKPOINT_FILE)
+    try:
+        with open(path, encoding="utf-8") as f:
+            state = json.load(f)
+    except (OSError, ValueError):
+        state = {}
+    state["attempts"] = state.get("attempts", 0) + 1
+    state["started_at"] = time.time()
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(state, f)
+    os.replace(tmp_path, path)
+    return state["attempts"]
+
+def shard_marker(workspace, index, state):
+    """
+    Marcador de uma parte terminada (state="done") ou falhada de vez (state="failed").
+    """
+    return os.path.join(workspace, f"shard_{index:04d}.{state}")
+
+def read_manifest(workspace):
+    try:
+        with open(os.path.join(workspace, SHARD_MANIFEST), encoding="utf-8") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+def write_manifest(workspace, manifest):
+    path = os.path.join(workspace, SHARD_MANIFEST)
+    with open(path + ".tmp", "w", encoding="utf-8") as f:
+        json.dump(manifest, f)
+    os.replace(path + ".tmp", path)
+
+def publish_messages(queue_name, messages, headers=None):
+    connection = pika.BlockingConnection(pika.ConnectionParameters(host='rabbitmq'))
+    try:
+        channel = connection.channel()
+        channel.queue_declare(queue=queue_name, durable=True)
+        for message in messages:
+            channel.basic_publish(
+                exchange='',
+                routing_key=queue_name,
+                body=json.dumps(message),
+                properties=pika.BasicProperties(delivery_mode=2, headers=headers)
+            )
+    finally:
+        connection.close()
+
+def shard_ranges(pages):
+    """
+    Intervalos de páginas (primeira, última, a contar de 1) das partes de um documento com pages páginas:
+    SHARD_PAGES páginas por parte, a última com as que sobram.
+    """
+    return [(first, min(first + SHARD_PAGES - 1, pages)) for first in range(1, pages + 1, SHARD_PAGES)]
+
+def start_sharding(data, workspace, input_path, source, timings=None, trace_headers=None):
+    """
+    Divide um pedido para PNG de um documento grande em partes (intervalos de páginas), publicadas na
+    fila pdf:png. O PDF (de um DOCX, o do LibreOffice) fica na área de trabalho partilhada do pedido.
+    Devolve o número de partes, ou 0 se o documento for pequeno e a conversão deve continuar aqui.
+    O manifesto é escrito antes da publicação (as partes precisam dele) e marcado como publicado depois:
+    numa nova entrega da mensagem as partes só voltam a ser publicadas se a publicação não terminou.
+    """
+    manifest = read_manifest(workspace)
+    if manifest and manifest.get("published"):
+        return manifest["count"]
+    if source == "docx":
+        with governor.reserve(LIBREOFFICE_MEMORY_MB * 1024 * 1024):
+            pdf_path = libreoffice_pdf(input_path, timings, checkpoint=True)
+    else:
+        pdf_path = input_path
+    pages = pdf_page_info(pdf_path)[0]
+    if pages < SHARD_MIN_PAGES:
+        return 0
+    count = len(shard_ranges(pages))
+    fields = {k: data[k] for k in ("job_id", "filename", "callback_url", "options") if k in data}
+    # O pedido fica no manifesto para que a verificação periódica possa fazer a junção (ver merge_lock_sweeper)
+    manifest = {"count": count, "pages": pages, "pdf": os.path.basename(pdf_path), "published": False, "request": fields}
+    write_manifest(workspace, manifest)
+    messages = []
+    for index, (first_page, last_page) in enumerate(shard_ranges(pages)):
+        shard = {"index": index, "count": count, "first_page": first_page, "last_page": last_page}
+        messages.append({**fields, "target_format": "png", "shard": shard, "enqueued_at": time.time()})
+    with timed(timings, "enqueue_shards"):
+        publish_messages(conversion_queue("pdf:png"), messages, trace_headers)
+    manifest["published"] = True
+    write_manifest(workspace, manifest)
+    update_job(data["job_id"], shards=count, pages=pages)
+    logging.info(f"Documento com {pages} páginas dividido em {count} partes de até {SHARD_PAGES} páginas.")
+    return count
+
+def read_merge_lock(lock_path):
+    try:
+        with open(lock_path, "rb") as f:
+            content = f.read()
+        mtime = os.path.getmtime(lock_path)
+    except OSError:
+        return None, None
+    try:
+        owner = json.loads(content)
+    except ValueError:
+        owner = {}  # lock a meio da escrita (ou de uma versão anterior, vazio): conta a hora do ficheiro
+    return content, {"host": owner.get("host"), "pid": owner.get("pid"), "at": owner.get("at") or mtime}
+
+def merge_lock_stale(owner):
+    """
+    Um lock está abandonado se tiver mais de MERGE_LOCK_TIMEOUT segundos ou se o processo que o criou,
+    neste host, já não existir.
+    """
+    if time.time() - owner["at"] > MERGE_LOCK_TIMEOUT:
+        return True
+    if owner["host"] != socket.gethostname() or not owner["pid"] or owner["pid"] == os.getpid():
+        return False
+    try:
+        os.kill(owner["pid"], 0)
+    except ProcessLookupError:
+        return True
+    except OSError:
+        pass
+    return False
+
+def acquire_merge_lock(workspace):
+    """
+    Cria o lock da junção das partes (O_EXCL, válido entre réplicas no volume partilhado) com o dono e a
+    hora. Um lock abandonado é retirado com rename para um nome único, pelo que só um processo o retoma;
+    se entretanto outro o tinha retomado (o conteúdo mudou), o lock novo é reposto e este desiste.
+    """
+    lock_path = os.path.join(workspace, MERGE_LOCK)
+    owner = json.dumps({"host": socket.gethostname(), "pid": os.getpid(), "at": time.time()}).encode("utf-8")
+    for _ in range(2):
+        try:
+            fd = os.open(lock_path, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+        except FileExistsError:
+            content, current = read_merge_lock(lock_path)
+            if current is None:
+                continue  # retirado entretanto
+            if not merge_lock_stale(current):
+                return False
+            stale_path = f"{lock_path}.{uuid.uuid4().hex}.stale"
+            try:
+                os.rename(lock_path, stale_path)
+            except FileNotFoundError:
+                continue
+            with open(stale_path, "rb") as f:
+                taken = f.read()
+            if taken != content:
+                with contextlib.suppress(OSError):
+                    os.link(stale_path, lock_path)
+                os.remove(stale_path)
+                return False
+            os.remove(stale_path)
+            logging.warning(f"Lock da junção abandonado retomado ({current['host']}, pid {current['pid']}): {workspace}")
+            continue
+        try:
+            os.write(fd, owner)
+        finally:
+            os.close(fd)
+        return True
+    return False
+
+def finish_shards(data, workspace, manifest, timings=None, trace_headers=None):
+    """
+    Chamado por cada parte que termina ou falha de vez (e pela verificação periódica). Quando todas as
+    partes terminaram, quem obtiver o lock (ver acquire_merge_lock) junta as páginas num ZIP ordenado,
+    guarda-o no store de resultados e faz a única entrega do pedido. Se alguma parte falhou (o pedido
+    já está marcado como falhado), só limpa a área de trabalho.
+    """
+    count = manifest["count"]
+    if not all(os.path.exists(shard_marker(workspace, i, "done")) or os.path.exists(shard_marker(workspace, i, "failed"))
+               for i in range(count)):
+        return False
+    lock_path = os.path.join(workspace, MERGE_LOCK)
+    if not acquire_merge_lock(workspace):
+        return False
+    if any(os.path.exists(shard_marker(workspace, i, "failed")) for i in range(count)):
+        shutil.rmtree(workspace, ignore_errors=True)
+        return False
+    job_id = data["job_id"]
+    stem = os.path.splitext(data["filename"])[0]
+    base_path = os.path.join(workspace, stem)
+    zip_path = base_path + "_pages.zip"
+    zip_filename = stem + ".zip"
+    try:
+        with timed(timings, "zip"), zipfile.ZipFile(zip_path, 'w') as zipf:
+            for page in range(1, manifest["pages"] + 1):
+                zipf.write(page_path(base_path, page), os.path.basename(page_path(base_path, page)))
+        with timed(timings, "store"):
+            result_path = store_result(job_id, zip_path, zip_filename)
+        if data.get("callback_url"):
+            with timed(timings, "enqueue_delivery"):
+                enqueue_delivery(job_id, result_path, zip_filename, data["callback_url"], trace_headers)
+    except Exception:
+        # Sem lock, a nova tentativa desta parte volta a juntar as páginas
+        os.remove(lock_path)
+        raise
+    shutil.rmtree(workspace, ignore_errors=True)
+    logging.info(f"{count} partes juntas num ZIP com {manifest['pages']} páginas: {zip_filename}")
+    return True
+
+def merge_lock_sweeper():
+    """
+    Thread que procura em WORK_DIR pedidos divididos em partes com o lock da junção abandonado (ex: réplica
+    morta a meio da junção, depois de todas as partes confirmadas) e faz a junção no lugar dela.
+    """
+    while True:
+        time.sleep(MERGE_SWEEP_INTERVAL)
+        try:
+            job_ids = os.listdir(WORK_DIR) if os.path.isdir(WORK_DIR) else []
+        except OSError:
+            job_ids = []
+        for job_id in job_ids:
+            workspace = os.path.join(WORK_DIR, job_id)
+            _, owner = read_merge_lock(os.path.join(workspace, MERGE_LOCK))
+            if owner is None or not merge_lock_stale(owner):
+                continue
+            manifest = read_manifest(workspace)
+            if not manifest or not manifest.get("request"):
+                continue
+            set_log_context(None, job_id)
+            try:
+                finish_shards(manifest["request"], workspace, manifest)
+            except Exception as e:
+                logging.error(f"Erro ao juntar as partes de um lock abandonado: {e}")
+            finally:
+                set_log_context()
+
+def process_text_shard(data, trace=None):
+    """
+    Rasteriza um intervalo de páginas de um pedido dividido em partes (ver start_sharding), a partir do
+    PDF na área de trabalho partilhada do pedido. Devolve "ok", "failed" ou "retry", como
+    process_text_conversion; cada parte tem as suas tentativas e retoma a partir das páginas já escritas.
+    """
+    job_id = data["job_id"]
+    shard = data["shard"]
+    index, count = shard["index"], shard["count"]
+    trace = trace or {"trace_id": uuid.uuid4().hex, "parent_id": None}
+    span_id = new_span_id()
+    trace_headers = {"trace_id": trace["trace_id"], "parent_id": span_id, "job_id": job_id}
+    set_log_context(trace["trace_id"], job_id)
+    workspace = os.path.join(WORK_DIR, job_id)
+    manifest = read_manifest(workspace)
+    if manifest is None:
+        # Entrega repetida de uma parte de um pedido que já terminou
+        logging.info(f"Parte {index + 1}/{count} ignorada: o pedido já não está em curso.")
+        set_log_context()
+        return "ok"
+    started_at = time.time()
+    timings = StageTimings()
+    outcome = "failed"
+    attempt = 0
+    job_started = time.perf_counter()
+    JOBS_IN_FLIGHT.inc()
+    try:
+        shard_dir = os.path.join(workspace, f"shard_{index:04d}")
+        os.makedirs(shard_dir, exist_ok=True)
+        attempt = start_attempt(shard_dir)
+        if attempt > TEXT_MAX_ATTEMPTS:
+            raise ConversionError(f"Shard interrupted {attempt - 1} times", retry=False)
+        if any(os.path.exists(shard_marker(workspace, i, "failed")) for i in range(count)):
+            raise ConversionError("Another shard of this job failed", retry=False)
+        if data.get("enqueued_at"):
+            timings.add("queue_wait", max(0.0, time.time() - float(data["enqueued_at"])))
+        pdf_path = os.path.join(workspace, manifest["pdf"])
+        base_path = os.path.join(workspace, os.path.splitext(data["filename"])[0])
+        profile = data.get("options", {}).get("profile")
+        floor = page_memory(*pdf_page_info(pdf_path)[1])
+        started = time.perf_counter()
+        governor.acquire(floor)
+        timings.add("admission", time.perf_counter() - started)
+        try:
+            logging.info(f"Parte {index + 1}/{count}: páginas {shard['first_page']} a {shard['last_page']} (tentativa {attempt}).")
+            rasterize_pdf(pdf_path, base_path, profile, timings, resume=True,
+                          first_page=shard["first_page"], last_page=shard["last_page"])
+        finally:
+            governor.release(floor)
+        open(shard_marker(workspace, index, "done"), "w").close()
+        finish_shards(data, workspace, manifest, timings, trace_headers)
+        outcome = "ok"
+    except Exception as e:
+        if getattr(e, "retry", True) and attempt < TEXT_MAX_ATTEMPTS:
+            outcome = "retry"
+            logging.warning(f"Parte {index + 1}/{count}: tentativa {attempt} de {TEXT_MAX_ATTEMPTS} falhou, vai ser repetida: {e}")
+        else:
+            logging.error(f"Parte {index + 1}/{count} falhou: {e}")
+            update_job(job_id, "failed", error=f"Shard {index + 1}/{count}: {e}")
+            try:
+                open(shard_marker(workspace, index, "failed"), "w").close()
+                finish_shards(data, workspace, manifest)
+            except OSError as err:
+                logging.warning(f"Não foi possível registar a falha da parte: {err}")
+    finally:
+        JOBS_IN_FLIGHT.dec()
+        job_seconds = time.perf_counter() - job_started
+        record_job_metrics("pdf", "png", outcome, timings.seconds, job_seconds)
+        if data.get("enqueued_at"):
+            enqueued_at = float(data["enqueued_at"])
+            emit_span("queue_wait", trace["trace_id"], new_span_id(), trace["parent_id"], enqueued_at, max(0.0, started_at - enqueued_at), job_id)
+        timings.emit_spans(trace["trace_id"], span_id, job_id)
+        emit_span(f"{SERVICE_NAME}.shard", trace["trace_id"], span_id, trace["parent_id"], started_at, job_seconds, job_id,
+                  shard=index, shards=count, first_page=shard["first_page"], last_page=shard["last_page"], outcome=outcome, attempt=attempt)
+        set_log_context()
+    return outcome
+
+def process_text_conversion(data, trace=None):
     """
     Função para processar pedidos vindos do RabbitMQ.
-    Agora envia o resultado para o callback_url fornecido.
+    O resultado é publicado na fila de entrega, que o envia para o callback_url fornecido.
+    trace é o contexto de tracing recebido nos cabeçalhos da mensagem (ver trace_context).
+    Devolve "ok", "failed" ou "retry" (falha temporária: a mensagem deve voltar à fila e a
+    tentativa seguinte retoma a partir dos checkpoints em WORK_DIR/<job_id>), ou "sharded" se o
+    documento foi dividido em partes (a área de trabalho fica para as partes).
     """
+    if data.get("shard"):
+        return process_text_shard(data, trace)
+    job_id = data.get("job_id") or uuid.uuid4().hex
+    trace = trace or {"trace_id": uuid.uuid4().hex, "parent_id": None}
+    span_id = new_span_id()
+    trace_headers = {"trace_id": trace["trace_id"], "parent_id": span_id, "job_id": job_id}
+    set_log_context(trace["trace_id"], job_id)
+    started_at = time.time()
+    timings = StageTimings()
+    source = target = "unknown"
+    bytes_in = bytes_out = 0
+    outcome = "failed"
+    attempt = 0
+    workspace = os.path.join(WORK_DIR, job_id)
+    job_started = time.perf_counter()
+    JOBS_IN_FLIGHT.inc()
     try:
+        os.makedirs(workspace, exist_ok=True)
+        attempt = start_attempt(workspace)
+        if attempt > TEXT_MAX_ATTEMPTS:
+            # A tentativa anterior não terminou (processo morto a meio da conversão)
+            raise ConversionError(f"Conversion interrupted {attempt - 1} times", retry=False)
+        update_job(job_id, "processing", attempt=attempt)
         filename = data["filename"]
-        file_bytes = base64.b64decode(data["file_bytes"])
         input_ext = filename.rsplit('.', 1)[-1].lower()
         target_format = data["target_format"].lower()
+        source, target = input_ext, target_format
         callback_url = data.get("callback_url")
-        input_path = os.path.join(tempfile.gettempdir(), filename)
-        with open(input_path, "wb") as f:
-            f.write(file_bytes)
-
-        output_files = []
-        zip_path = None
-
-        # DOCX para PDF
-        if input_ext == "docx" and target_format == "pdf":
-            output_path = input_path.replace('.docx', '.pdf')
-            logging.info(f"RabbitMQ: Convertendo DOCX para PDF: {input_path} -> {output_path}")
-            if not convert_docx_to_pdf(input_path, output_path):
-                logging.error("RabbitMQ: Erro ao converter DOCX para PDF (Word e LibreOffice falharam)")
-                return
-            output_files = [output_path]
-
-        # DOCX para PNG
-        elif input_ext == "docx" and target_format == "png":
-            temp_pdf = input_path.replace('.docx', '_temp.pdf')
-            logging.info(f"RabbitMQ: Convertendo DOCX para PDF temporário: {input_path} -> {temp_pdf}")
-            if not convert_docx_to_pdf(input_path, temp_pdf):
-                logging.error("RabbitMQ: Erro ao converter DOCX para PDF (Word e LibreOffice falharam)")
-                return
+        profile = data.get("options", {}).get("profile")
+        if data.get("enqueued_at"):
+            timings.add("queue_wait", max(0.0, time.time() - float(data["enqueued_at"])))
+        input_path = os.path.join(workspace, filename)
+        with timings.stage("input"):
+            load_input(data, input_path)
+        bytes_in = os.path.getsize(input_path)
+
+        # Várias saídas (ex: PDF e PNG do mesmo DOCX): um só pedido, intermédios partilhados, um só ZIP
+        outputs = None
+        if data.get("outputs"):
+            target = "multi"
             try:
-                images = convert_from_path(temp_pdf)
-                output_files = []
-                def process_page(i_img):
-                    i, img = i_img
-                    img_path = input_path.replace('.docx', f'_page_{i+1:03d}.png')
-                    save_image(img, img_path)
-                    return img_path
-                with concurrent.futures.ThreadPoolExecutor(max_workers=5) as executor:
-                    futures = [executor.submit(process_page, (i, img)) for i, img in enumerate(images)]
-                    for future in concurrent.futures.as_completed(futures):
-                        output_files.append(future.result())
-                output_files.sort(key=lambda x: int(x.split('_page_')[-1].split('.png')[0]))
-            finally:
-                if os.path.exists(temp_pdf):
-                    os.remove(temp_pdf)
-
-        # PDF para DOCX
-        elif input_ext == "pdf" and target_format == "docx":
-            output_path = input_path.replace('.pdf', '.docx')
-            logging.info(f"RabbitMQ: Convertendo PDF para DOCX: {input_path} -> {output_path}")
-            cv = Converter(input_path)
-            cv.convert(output_path, start=0, end=None)
-            cv.close()
-            output_files = [output_path]
-
-        # PDF para PNG
-        elif input_ext == "pdf" and target_format == "png":
-            images = convert_from_path(input_path)
-            output_files = []
-            def process_page(i_img):
-                i, img = i_img
-                img_path = input_path.replace('.pdf', f'_page_{i+1:03d}.png')
-                save_image(img, img_path)
-                return img_path
-            with concurrent.futures.ThreadPoolExecutor(max_workers=5) as executor:
-                futures = [executor.submit(process_page, (i, img)) for i, img in enumerate(images)]
-                for future in concurrent.futures.as_completed(futures):
-                    output_files.append(future.result())
-            output_files.sort(key=lambda x: int(x.split('_page_')[-1].split('.png')[0]))
-
-        # Para PNG, cria SEMPRE um ZIP com todas as páginas
-        if target_format == "png":
-            zip_path = input_path + "_pages.zip"
-            with zipfile.ZipFile(zip_path, 'w') as zipf:
+                outputs = parse_outputs(input_ext, data["outputs"])
+            except ValueError as e:
+                raise ConversionError(f"Invalid outputs: {e}", retry=False)
+            # Uma saída sem perfil (ou com null) usa o perfil do pedido
+            for spec in outputs:
+                spec["profile"] = spec["profile"] or profile
+        else:
+            convert = get_converter(input_ext, target_format)
+            if convert is None:
+                raise ConversionError(f"Unsupported conversion: {input_ext} -> {target_format}", retry=False)
+        if attempt > 1:
+            logging.info(f"Tentativa {attempt} de {TEXT_MAX_ATTEMPTS}: a retomar a partir dos checkpoints.")
+        # Documentos grandes para PNG: as páginas são divididas pelas réplicas (só se esta réplica
+        # também rasterizar partes, ou seja, com pdf:png ativo)
+        if not outputs and target_format == "png" and SHARD_MIN_PAGES and "pdf:png" in ENABLED_CONVERSIONS:
+            if start_sharding(data, workspace, input_path, input_ext, timings, trace_headers):
+                outcome = "sharded"
+                return outcome
+        if outputs:
+            output_files = run_outputs(input_path, input_ext, outputs, timings, checkpoint=True)
+        else:
+            output_files = run_converter(convert, input_path, input_ext, target_format, profile, timings, checkpoint=True)
+
+        # Para PNG (e pedidos com várias saídas), cria SEMPRE um ZIP com todos os ficheiros
+        if outputs or target_format == "png":
+            zip_path = input_path + ("_outputs.zip" if outputs else "_pages.zip")
+            with timings.stage("zip"), zipfile.ZipFile(zip_path, 'w') as zipf:
                 for f in output_files:
                     zipf.write(f, os.path.basename(f))
-            logging.info(f"RabbitMQ: ZIP criado com {len(output_files)} imagens: {zip_path}")
-
-            # --- CALLBACK: envia o ficheiro ZIP convertido para o callback_url ---
-            if callback_url and os.path.exists(zip_path):
-                zip_filename = os.path.splitext(filename)[0] + ".zip"
-                with open(zip_path, "rb") as f:
-                    files = {"file": (zip_filename, f)}
-                    try:
-                        resp = requests.post(callback_url, files=files, timeout=30)
-                        if resp.status_code == 200:
-                            logging.info(f"Ficheiro ZIP enviado com sucesso para callback_url: {callback_url}")
-                        else:
-                            logging.error(f"Falha ao enviar ZIP para callback_url: {callback_url} | Status: {resp.status_code}")
-                    except Exception as e:
-                        logging.error(f"Erro ao fazer callback para {callback_url}: {e}")
+            logging.info(f"RabbitMQ: ZIP criado com {len(output_files)} ficheiros: {zip_path}")
+
+            # Guarda o ZIP no store de resultados e, com callback, entrega-o através da fila de entrega
+            if os.path.exists(zip_path):
+                zip_filename = os.path.splitext(filename)[0] + ("_outputs.zip" if outputs else ".zip")
+                bytes_out = os.path.getsize(zip_path)
+                with timings.stage("store"):
+                    result_path = store_result(job_id, zip_path, zip_filename)
+                if callback_url:
+                    with timings.stage("enqueue_delivery"):
+                        enqueue_delivery(job_id, result_path, zip_filename, callback_url, trace_headers)
+                outcome = "ok"
 
             # Limpeza
             for f in output_files:
@@ -257,48 +1068,125 @@ def process_text_conversion(data):
             if os.path.exists(zip_path):
                 os.remove(zip_path)
         elif len(output_files) == 1:
-            # --- CALLBACK: envia o ficheiro convertido para o callback_url ---
-            if callback_url and os.path.exists(output_files[0]):
-                with open(output_files[0], "rb") as f:
-                    files = {"file": (os.path.basename(output_files[0]), f)}
-                    try:
-                        resp = requests.post(callback_url, files=files, timeout=30)
-                        if resp.status_code == 200:
-                            logging.info(f"Ficheiro enviado com sucesso para callback_url: {callback_url}")
-                        else:
-                            logging.error(f"Falha ao enviar ficheiro para callback_url: {callback_url} | Status: {resp.status_code}")
-                    except Exception as e:
-                        logging.error(f"Erro ao fazer callback para {callback_url}: {e}")
+            # Guarda o ficheiro no store de resultados e, com callback, entrega-o através da fila de entrega
+            if os.path.exists(output_files[0]):
+                result_filename = os.path.basename(output_files[0])
+                bytes_out = os.path.getsize(output_files[0])
+                with timings.stage("store"):
+                    result_path = store_result(job_id, output_files[0], result_filename)
+                if callback_url:
+                    with timings.stage("enqueue_delivery"):
+                        enqueue_delivery(job_id, result_path, result_filename, callback_url, trace_headers)
+                outcome = "ok"
 
             # Limpeza
             for f in output_files:
                 if os.path.exists(f):
                     os.remove(f)
+        else:
+            update_job(job_id, "failed", error=f"Unsupported conversion or no output: {input_ext} -> {target_format}")
         if os.path.exists(input_path):
             os.remove(input_path)
     except Exception as e:
-        logging.error(f"Erro ao processar pedido RabbitMQ: {e}")
+        if getattr(e, "retry", True) and attempt < TEXT_MAX_ATTEMPTS:
+            outcome = "retry"
+            logging.warning(f"Tentativa {attempt} de {TEXT_MAX_ATTEMPTS} falhou, o pedido vai ser repetido: {e}")
+            update_job(job_id, "retrying", error=str(e), attempt=attempt)
+        else:
+            logging.error(f"Erro ao processar pedido RabbitMQ: {e}")
+            update_job(job_id, "failed", error=str(e), attempt=attempt)
+    finally:
+        # Os checkpoints só ficam para a próxima tentativa (ou para as partes do pedido)
+        if outcome not in ("retry", "sharded"):
+            shutil.rmtree(workspace, ignore_errors=True)
+        JOBS_IN_FLIGHT.dec()
+        job_seconds = time.perf_counter() - job_started
+        record_job_metrics(source, target, outcome, timings.seconds, job_seconds, bytes_in, bytes_out)
+        if data.get("enqueued_at"):
+            enqueued_at = float(data["enqueued_at"])
+            emit_span("queue_wait", trace["trace_id"], new_span_id(), trace["parent_id"], enqueued_at, max(0.0, started_at - enqueued_at), job_id)
+        timings.emit_spans(trace["trace_id"], span_id, job_id)
+        emit_span(f"{SERVICE_NAME}.convert", trace["trace_id"], span_id, trace["parent_id"], started_at, job_seconds, job_id,
+                  source=source, target=target, outcome=outcome, bytes_in=bytes_in, bytes_out=bytes_out, attempt=attempt)
+        set_log_context()
+    return outcome
+
+def retry_delay_ms(retries):
+    return int(min(TEXT_RETRY_BACKOFF_MAX, TEXT_RETRY_BACKOFF_BASE * (2 ** (retries - 1))) * 1000)
+
+def message_job_id(body, properties):
+    """
+    job_id de uma mensagem que não o traz (mensagens antigas): o message_id ou um hash do corpo,
+    estável entre entregas para que a nova tentativa retome dos checkpoints em WORK_DIR/<job_id>.
+    """
+    return getattr(properties, "message_id", None) or hashlib.sha256(body).hexdigest()[:32]
 
 def rabbitmq_consumer():
     """
-    Thread para consumir pedidos RabbitMQ.
+    Thread para consumir pedidos RabbitMQ, das filas dos pares ativos nesta réplica.
+    Até TEXT_JOB_WORKERS pedidos correm em paralelo (cada um espera no governador pela sua memória
+    mínima); o ack só é enviado quando a conversão termina, na thread da ligação.
+    Falhas temporárias seguem para uma fila de atraso que, ao expirar, devolve a mensagem à fila de
+    origem (com o cabeçalho retries); pedidos que falham de vez seguem para TEXT_DEAD_LETTER_QUEUE.
     """
-    def callback(ch, method, properties, body):
+    executor = concurrent.futures.ThreadPoolExecutor(max_workers=TEXT_JOB_WORKERS, thread_name_prefix="text-job")
+
+    def finish(channel, delivery_tag, queue_name, body, properties, outcome):
+        if not channel.is_open:
+            return
+        if outcome == "retry":
+            headers = dict(getattr(properties, "headers", None) or {})
+            headers["retries"] = int(headers.get("retries") or 0) + 1
+            delay_ms = retry_delay_ms(headers["retries"])
+            retry_queue = f"{TEXT_RETRY_QUEUE}.{queue_name}.{delay_ms}"
+            channel.queue_declare(queue=retry_queue, durable=True, arguments={
+                "x-message-ttl": delay_ms,
+                "x-dead-letter-exchange": "",
+                "x-dead-letter-routing-key": queue_name,
+            })
+            channel.basic_publish(exchange='', routing_key=retry_queue, body=body,
+                                  properties=pika.BasicProperties(delivery_mode=2, headers=headers,
+                                                                  message_id=getattr(properties, "message_id", None)))
+        elif outcome == "failed":
+            channel.basic_publish(exchange='', routing_key=TEXT_DEAD_LETTER_QUEUE, body=body, properties=properties)
+        channel.basic_ack(delivery_tag=delivery_tag)
+
+    def run_job(connection, channel, delivery_tag, queue_name, body, properties):
         try:
             data = json.loads(body)
-            process_text_conversion(data)
+            if not data.get("job_id"):
+                data["job_id"] = message_job_id(body, properties)
+            outcome = process_text_conversion(data, trace_context(properties))
         except Exception as e:
             logging.error(f"Erro no callback RabbitMQ: {e}")
-        ch.basic_ack(delivery_tag=method.delivery_tag)
+            outcome = "failed"
+        try:
+            connection.add_callback_threadsafe(functools.partial(finish, channel, delivery_tag, queue_name, body, properties, outcome))
+        except Exception as e:
+            logging.error(f"Não foi possível confirmar a mensagem {delivery_tag}: {e}")
 
     while True:
         try:
             connection = pika.BlockingConnection(pika.ConnectionParameters(host='rabbitmq'))
             channel = connection.channel()
-            channel.queue_declare(queue='text_convert_queue', durable=True)
-            channel.basic_qos(prefetch_count=1)
-            channel.basic_consume(queue='text_convert_queue', on_message_callback=callback)
-            logging.info("A consumir pedidos RabbitMQ em text_convert_queue...")
+
+            def callback(ch, method, properties, body, connection=connection):
+                # Na troca por omissão a routing key é a fila de origem (também ao voltar da fila de atraso)
+                executor.submit(run_job, connection, ch, method.delivery_tag, method.routing_key, body, properties)
+
+            queues = [conversion_queue(pair) for pair in ENABLED_CONVERSIONS]
+            queues += [conversion_queue(f"{src}:multi") for src in multi_output_sources()]
+            if set(ENABLED_CONVERSIONS) == set(CONVERTERS):
+                # Com todos os pares ativos, esvazia também a fila única usada antes das filas por par
+                queues.append(TEXT_CONVERT_QUEUE)
+            # Até TEXT_JOB_WORKERS mensagens por confirmar no canal inteiro, seja qual for a fila
+            channel.basic_qos(prefetch_count=TEXT_JOB_WORKERS, global_qos=True)
+            channel.queue_declare(queue=TEXT_DEAD_LETTER_QUEUE, durable=True)
+            for queue_name in queues:
+                channel.queue_declare(queue=queue_name, durable=True)
+                channel.basic_consume(queue=queue_name, on_message_callback=callback)
+            logging.info(f"A consumir pedidos RabbitMQ em {', '.join(queues)} ({TEXT_JOB_WORKERS} em paralelo, "
+                         f"orçamento de memória {governor.budget // 2**20} MB)...")
             channel.start_consuming()
         except Exception as e:
             logging.error(f"Erro na ligação ao RabbitMQ: {e}")
@@ -319,170 +1207,78 @@ def convert_text():
 
     filename = secure_filename(file.filename)
     input_ext = filename.rsplit('.', 1)[-1].lower()
-    input_path = os.path.join(tempfile.gettempdir(), filename)
-    file.save(input_path)
-    logging.info(f"Ficheiro recebido: {filename} ({input_ext}) guardado em {input_path}")
 
+    outputs = None
     target_format = request.form.get("target_format", "").lower()
     logging.info(f"Formato de destino pedido: {target_format}")
-    if target_format not in ["pdf", "docx", "png"]:
+    if request.form.get("outputs"):
+        try:
+            outputs = parse_outputs(input_ext, request.form["outputs"])
+        except ValueError as e:
+            logging.warning(f"Lista de saídas inválida: {e}")
+            return jsonify({"error": f"Invalid outputs: {e}"}), 400
+    elif target_format not in ["pdf", "docx", "png"]:
         logging.warning("Formato de destino inválido.")
         return jsonify({"error": "Invalid format. Supported formats: pdf, docx, png"}), 400
 
-    output_files = []
-    zip_path = None
+    profile = request.form.get("profile", "").lower() or None
+    if profile and profile not in PNG_ENCODER_PROFILES:
+        logging.warning("Perfil de codificação inválido.")
+        return jsonify({"error": f"Invalid profile. Supported: {', '.join(PNG_ENCODER_PROFILES)}"}), 400
 
-    try:
-        # DOCX para PDF
-        if input_ext == "docx" and target_format == "pdf":
-            output_path = input_path.replace('.docx', '.pdf')
-            logging.info(f"Convertendo DOCX para PDF: {input_path} -> {output_path}")
-            if not convert_docx_to_pdf(input_path, output_path):
-                return jsonify({"error": "Erro ao converter DOCX para PDF (Word e LibreOffice falharam)"}), 500
-            output_files = [output_path]
-
-        # DOCX para PNG (cada página como imagem, threads limitadas a 5)
-        elif input_ext == "docx" and target_format == "png":
-            temp_pdf = input_path.replace('.docx', '_temp.pdf')
-            logging.info(f"Convertendo DOCX para PDF temporário: {input_path} -> {temp_pdf}")
-            if not convert_docx_to_pdf(input_path, temp_pdf):
-                return jsonify({"error": "Erro ao converter DOCX para PDF (Word e LibreOffice falharam)"}), 500
-            try:
-                logging.info(f"Convertendo PDF para PNG(s): {temp_pdf}")
-                images = convert_from_path(temp_pdf)
-                logging.info(f"Total de páginas a processar: {len(images)}")
-                output_files = []
-                
-                def process_page(i_img):
-                    i, img = i_img
-                    img_path = input_path.replace('.docx', f'_page_{i+1:03d}.png')
-                    save_image(img, img_path)
-                    logging.info(f"Página {i+1} processada: {img_path}")
-                    return img_path
-                
-                with concurrent.futures.ThreadPoolExecutor(max_workers=5) as executor:
-                    futures = [executor.submit(process_page, (i, img)) for i, img in enumerate(images)]
-                    for future in concurrent.futures.as_completed(futures):
-                        output_files.append(future.result())
-                
-                # Ordena por número da página
-                output_files.sort(key=lambda x: int(x.split('_page_')[-1].split('.png')[0]))
-                logging.info(f"Todas as {len(output_files)} páginas processadas com sucesso")
-                
-            except Exception as e:
-                logging.error(f"Erro ao converter PDF para PNG: {e}", exc_info=True)
-                return jsonify({"error": f"Erro ao converter PDF para PNG: {e}"}), 500
-            finally:
-                if os.path.exists(temp_pdf):
-                    os.remove(temp_pdf)
-                    logging.info(f"PDF temporário removido: {temp_pdf}")
-
-        # PDF para DOCX
-        elif input_ext == "pdf" and target_format == "docx":
-            output_path = input_path.replace('.pdf', '.docx')
-            logging.info(f"Convertendo PDF para DOCX: {input_path} -> {output_path}")
-            cv = Converter(input_path)
-            cv.convert(output_path, start=0, end=None)
-            cv.close()
-            output_files = [output_path]
-
-        # PDF para PNG (cada página como imagem, threads limitadas a 5)
-        elif input_ext == "pdf" and target_format == "png":
-            logging.info(f"Convertendo PDF para PNG(s): {input_path}")
-            images = convert_from_path(input_path)
-            logging.info(f"Total de páginas a processar: {len(images)}")
-            output_files = []
-            
-            def process_page(i_img):
-                i, img = i_img
-                img_path = input_path.replace('.pdf', f'_page_{i+1:03d}.png')
-                save_image(img, img_path)
-                logging.info(f"Página {i+1} processada: {img_path}")
-                return img_path
-            
-            with concurrent.futures.ThreadPoolExecutor(max_workers=5) as executor:
-                futures = [executor.submit(process_page, (i, img)) for i, img in enumerate(images)]
-                for future in concurrent.futures.as_completed(futures):
-                    output_files.append(future.result())
-            
-            # Ordena por número da página
-            output_files.sort(key=lambda x: int(x.split('_page_')[-1].split('.png')[0]))
-            logging.info(f"Todas as {len(output_files)} páginas processadas com sucesso")
+    convert = None if outputs else get_converter(input_ext, target_format)
+    if convert is None and not outputs:
+        logging.warning("Conversão não suportada para este tipo de ficheiro.")
+        return jsonify({"error": "Conversão não suportada para este tipo de ficheiro."}), 400
 
+    # Pasta própria por pedido (os conversores escrevem as saídas ao lado do ficheiro de entrada):
+    # pedidos em simultâneo com o mesmo nome de ficheiro não se sobrepõem
+    work_dir = tempfile.mkdtemp(prefix="service-text-sync-")
+    input_path = os.path.join(work_dir, filename)
+    file.save(input_path)
+    logging.info(f"Ficheiro recebido: {filename} ({input_ext}) guardado em {input_path}")
+
+    try:
+        if outputs:
+            output_files = run_outputs(input_path, input_ext, outputs)
         else:
-            logging.warning("Conversão não suportada para este tipo de ficheiro.")
-            return jsonify({"error": "Conversão não suportada para este tipo de ficheiro."}), 400
+            output_files = run_converter(convert, input_path, input_ext, target_format, profile)
+        logging.info(f"Conversão concluída: {len(output_files)} ficheiro(s) produzido(s)")
 
-        # Para PNG, cria SEMPRE um ZIP com todas as páginas
-        if target_format == "png":
-            zip_path = input_path + "_pages.zip"
+        @after_this_request
+        def cleanup(response):
+            shutil.rmtree(work_dir, ignore_errors=True)
+            logging.info(f"Removida pasta temporária: {work_dir}")
+            return response
+
+        # Para PNG (e pedidos com várias saídas), cria SEMPRE um ZIP com todos os ficheiros
+        if outputs or target_format == "png":
+            zip_path = input_path + ("_outputs.zip" if outputs else "_pages.zip")
             with zipfile.ZipFile(zip_path, 'w') as zipf:
                 for f in output_files:
                     zipf.write(f, os.path.basename(f))
-            logging.info(f"ZIP criado com {len(output_files)} imagens: {zip_path}")
-            
-            # Define a função de limpeza
-            @after_this_request
-            def cleanup(response):
-                try:
-                    if os.path.exists(input_path):
-                        os.remove(input_path)
-                        logging.info(f"Removido ficheiro temporário: {input_path}")
-                    for f in output_files:
-                        if os.path.exists(f):
-                            os.remove(f)
-                            logging.info(f"Removido ficheiro PNG temporário: {f}")
-                    if zip_path and os.path.exists(zip_path):
-                        os.remove(zip_path)
-                        logging.info(f"Removido ficheiro ZIP temporário: {zip_path}")
-                except Exception as e:
-                    logging.error(f"Erro ao remover ficheiros temporários: {e}")
-                return response
-            
-            zip_filename = os.path.splitext(filename)[0] + ".zip"
+            logging.info(f"ZIP criado com {len(output_files)} ficheiros: {zip_path}")
+            zip_filename = os.path.splitext(filename)[0] + ("_outputs.zip" if outputs else ".zip")
             return send_file(zip_path, as_attachment=True, download_name=zip_filename)
-        
+
         # Para outros formatos (PDF, DOCX)
-        elif len(output_files) == 1:
-            @after_this_request
-            def cleanup(response):
-                try:
-                    if os.path.exists(input_path):
-                        os.remove(input_path)
-                        logging.info(f"Removido ficheiro temporário: {input_path}")
-                    for f in output_files:
-                        if os.path.exists(f):
-                            os.remove(f)
-                            logging.info(f"Removido ficheiro temporário: {f}")
-                except Exception as e:
-                    logging.error(f"Erro ao remover ficheiros temporários: {e}")
-                return response
-            
-            logging.info(f"Envio de ficheiro convertido: {output_files[0]}")
-            return send_file(output_files[0], as_attachment=True)
+        logging.info(f"Envio de ficheiro convertido: {output_files[0]}")
+        return send_file(output_files[0], as_attachment=True)
 
     except Exception as e:
         logging.error(f"Erro ao converter {filename}: {e}", exc_info=True)
         # Limpeza mesmo em caso de erro
-        try:
-            if os.path.exists(input_path):
-                os.remove(input_path)
-                logging.info(f"Removido ficheiro temporário após erro: {input_path}")
-            for f in output_files:
-                if os.path.exists(f):
-                    os.remove(f)
-                    logging.info(f"Removido ficheiro temporário após erro: {f}")
-            if zip_path and os.path.exists(zip_path):
-                os.remove(zip_path)
-                logging.info(f"Removido ficheiro ZIP temporário após erro: {zip_path}")
-        except Exception as err:
-            logging.error(f"Erro ao remover ficheiros temporários após erro: {err}")
+        shutil.rmtree(work_dir, ignore_errors=True)
         return jsonify({"error": str(e)}), 500
 
+@app.route("/metrics", methods=["GET"])
+def metrics():
+    return Response(generate_latest(), mimetype=CONTENT_TYPE_LATEST)
+
 @app.route("/health", methods=["GET"])
 def health():
     logging.info("Health check recebido.")
-    return jsonify({"status": "ok"}), 200
+    return jsonify({"status": "ok", "conversions": ENABLED_CONVERSIONS}), 200
 
 def register_service():
     consul_host = os.getenv("CONSUL_HTTP_ADDR", "localhost:8500").split(":")[0]
@@ -498,7 +1294,7 @@ def register_service():
         service_id=SERVICE_NAME,
         address="service-text",
         port=SERVICE_PORT,
-        tags=["text", "docx", "pdf", "png"],
+        tags=["text", "docx", "pdf", "png"] + ENABLED_CONVERSIONS,
         check=check
     )
     logging.info("Serviço registado no Consul.")
@@ -506,6 +1302,8 @@ def register_service():
 if __name__ == "__main__":
     # Arranca o consumidor RabbitMQ numa thread separada
     threading.Thread(target=rabbitmq_consumer, daemon=True).start()
+    if SHARD_MIN_PAGES and "pdf:png" in ENABLED_CONVERSIONS:
+        threading.Thread(target=merge_lock_sweeper, daemon=True).start()
     register_service()
     cert_path = os.path.join("certs", "server.crt")
     key_path = os.path.join("certs", "server.key")
@@ -0,0 +1 @@
+# Código comum ao dispatcher, aos serviços de conversão e ao delivery (copiado para cada imagem em /opt/shared)
@@ -0,0 +1,31 @@
+import os
+import math
+
+def cgroup_cpu_count():
+    """
+    Número de CPUs que o contentor pode usar: o mínimo entre a afinidade do processo
+    e a quota de CPU do cgroup (v2: cpu.max, v1: cpu.cfs_quota_us / cpu.cfs_period_us).
+    """
+    try:
+        cpus = len(os.sched_getaffinity(0))
+    except AttributeError:
+        cpus = os.cpu_count() or 1
+    quota = None
+    try:
+        with open("/sys/fs/cgroup/cpu.max") as f:
+            limit, period = f.read().split()[:2]
+            if limit != "max":
+                quota = int(limit) / int(period)
+    except (OSError, ValueError):
+        try:
+            with open("/sys/fs/cgroup/cpu/cpu.cfs_quota_us") as f:
+                limit = int(f.read())
+            with open("/sys/fs/cgroup/cpu/cpu.cfs_period_us") as f:
+                period = int(f.read())
+            if limit > 0 and period > 0:
+                quota = limit / period
+        except (OSError, ValueError):
+            pass
+    if quota:
+        cpus = min(cpus, math.ceil(quota))
+    return max(1, cpus)
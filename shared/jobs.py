@@ -0,0 +1,131 @@
+import os
+import logging
+import json
+import time
+import tempfile
+import shutil
+import threading
+import base64
+import contextlib
+
+import pika
+
+try:
+    import fcntl
+except ImportError:  # Windows: sem flock, o lock só vale dentro do processo
+    fcntl = None
+
+# Store de resultados partilhado pelo dispatcher, pelos serviços e pelo delivery
+# (RESULTS_DIR/<job_id>/job.json + resultado)
+RESULTS_DIR = os.getenv("RESULTS_DIR", os.path.join(tempfile.gettempdir(), "conv-results"))
+JOB_FILE = "job.json"
+# Lock de cada pedido (flock), tomado à volta de cada leitura-alteração-escrita do job.json
+JOB_LOCK_FILE = "job.lock"
+# Store de conteúdos do dispatcher (ficheiros de entrada referidos pelo SHA-256 em blob_sha256)
+BLOBS_DIR = os.getenv("BLOBS_DIR", os.path.join(tempfile.gettempdir(), "conv-blobs"))
+# Fila do serviço delivery (envio dos resultados para o callback do cliente)
+DELIVERY_QUEUE = "delivery_queue"
+
+def read_job(job_id):
+    try:
+        with open(os.path.join(RESULTS_DIR, job_id, JOB_FILE), encoding="utf-8") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+process_job_lock = threading.Lock()
+
+@contextlib.contextmanager
+def job_lock(job_dir):
+    """
+    Lock exclusivo de um pedido, partilhado por todos os processos (e contentores) que usam o volume
+    de resultados: flock em RESULTS_DIR/<job_id>/job.lock, libertado ao fechar o ficheiro.
+    """
+    if fcntl is None:
+        with process_job_lock:
+            yield
+        return
+    fd = os.open(os.path.join(job_dir, JOB_LOCK_FILE), os.O_RDWR | os.O_CREAT, 0o644)
+    try:
+        fcntl.flock(fd, fcntl.LOCK_EX)
+        yield
+    finally:
+        os.close(fd)
+
+def update_job(job_id, status=None, **fields):
+    """
+    Atualiza o estado do pedido no store de resultados (RESULTS_DIR/<job_id>/job.json), consultado pelo
+    dispatcher em /jobs/<job_id>. Cada mudança de estado fica registada com o instante em que aconteceu.
+    O dispatcher, os serviços e o delivery atualizam o mesmo pedido: a leitura, a alteração e a escrita
+    são feitas com o lock do pedido, para que nenhuma atualização se perca. O job.json é substituído
+    com os.replace, pelo que read_job (sem lock) lê sempre a versão anterior ou a nova, nunca meia escrita.
+    Devolve o pedido atualizado (None se não foi possível gravá-lo).
+    """
+    job_dir = os.path.join(RESULTS_DIR, job_id)
+    job_path = os.path.join(job_dir, JOB_FILE)
+    try:
+        os.makedirs(job_dir, exist_ok=True)
+        with job_lock(job_dir):
+            job = read_job(job_id) or {"job_id": job_id, "events": []}
+            job.update(fields)
+            if status:
+                job["status"] = status
+                job.setdefault("events", []).append({"status": status, "at": time.time()})
+            tmp_path = f"{job_path}.{os.getpid()}.{threading.get_ident()}.tmp"
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                json.dump(job, f)
+            os.replace(tmp_path, job_path)
+        return job
+    except OSError as e:
+        logging.warning(f"Não foi possível atualizar o estado do pedido {job_id}: {e}")
+        return None
+
+def load_input(data, input_path):
+    """
+    Escreve o ficheiro de entrada do pedido: copiado do store de conteúdos (blob_sha256)
+    ou, em mensagens antigas, descodificado dos bytes base64 (file_bytes).
+    """
+    if data.get("blob_sha256"):
+        shutil.copyfile(os.path.join(BLOBS_DIR, data["blob_sha256"]), input_path)
+    else:
+        with open(input_path, "wb") as f:
+            f.write(base64.b64decode(data["file_bytes"]))
+
+def store_result(job_id, output_path, filename):
+    """
+    Move o resultado para o diretório partilhado de resultados, de onde é servido em /jobs/<job_id>/result
+    até expirar, e marca o pedido como convertido.
+    """
+    job_dir = os.path.join(RESULTS_DIR, job_id)
+    os.makedirs(job_dir, exist_ok=True)
+    result_path = os.path.join(job_dir, filename)
+    shutil.move(output_path, result_path)
+    update_job(job_id, "converted", result=filename, result_size=os.path.getsize(result_path))
+    return result_path
+
+def enqueue_delivery(job_id, result_path, filename, callback_url, trace_headers=None):
+    """
+    Publica um resultado já guardado em RESULTS_DIR na fila de entrega.
+    O envio para o cliente (ligações reutilizadas, retries e dead-letter) é feito pelo serviço delivery,
+    pelo que a conversão nunca fica à espera da rede do cliente.
+    """
+    message = {
+        "job_id": job_id,
+        "path": os.path.relpath(result_path, RESULTS_DIR),
+        "filename": filename,
+        "callback_url": callback_url,
+        "attempt": 0,
+    }
+    connection = pika.BlockingConnection(pika.ConnectionParameters(host='rabbitmq'))
+    try:
+        channel = connection.channel()
+        channel.queue_declare(queue=DELIVERY_QUEUE, durable=True)
+        channel.basic_publish(
+            exchange='',
+            routing_key=DELIVERY_QUEUE,
+            body=json.dumps(message),
+            properties=pika.BasicProperties(delivery_mode=2, headers=trace_headers)
+        )
+    finally:
+        connection.close()
+    logging.info(f"Resultado do pedido {job_id} publicado em {DELIVERY_QUEUE} para {callback_url}")
@@ -0,0 +1,116 @@
+import os
+import logging
+import json
+import time
+import uuid
+import threading
+import socket
+import contextlib
+
+# Contexto do pedido em curso (por thread), acrescentado a cada linha de log
+log_context = threading.local()
+
+class JobContextFilter(logging.Filter):
+    def filter(self, record):
+        record.trace_id = getattr(log_context, "trace_id", None) or "-"
+        record.job_id = getattr(log_context, "job_id", None) or "-"
+        return True
+
+def set_log_context(trace_id=None, job_id=None):
+    log_context.trace_id = trace_id
+    log_context.job_id = job_id
+
+# --- Tracing ---
+# O trace_id de cada pedido é criado no dispatcher (ou recebido no cabeçalho X-Trace-Id do pedido) e segue nos
+# cabeçalhos AMQP (trace_id, parent_id, job_id) até aos serviços e ao delivery, e no cabeçalho X-Trace-Id
+# do callback. Cada etapa gera um span, escrito como uma linha JSON em TRACE_FILE (vazio = desligado) e,
+# se TRACE_COLLECTOR=host:port estiver definido, também enviado por UDP para um coletor local.
+# Cada componente chama init_tracing com o seu nome e o ficheiro por omissão antes de emitir spans.
+SERVICE = None
+TRACE_FILE = ""
+TRACE_COLLECTOR = ""
+trace_socket = None
+
+def init_tracing(service, default_trace_file):
+    global SERVICE, TRACE_FILE, TRACE_COLLECTOR, trace_socket
+    SERVICE = service
+    TRACE_FILE = os.getenv("TRACE_FILE", default_trace_file)
+    TRACE_COLLECTOR = os.getenv("TRACE_COLLECTOR", "")
+    if TRACE_FILE:
+        os.makedirs(os.path.dirname(TRACE_FILE), exist_ok=True)
+    trace_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM) if TRACE_COLLECTOR else None
+
+def new_span_id():
+    return os.urandom(8).hex()
+
+def emit_span(name, trace_id, span_id, parent_id, start, duration, job_id=None, **attrs):
+    """
+    Regista um span (etapa com início em epoch e duração em segundos) como uma linha JSON.
+    Cada linha é escrita com um único write em O_APPEND, pelo que vários processos podem partilhar o ficheiro.
+    """
+    record = {
+        "trace_id": trace_id,
+        "span_id": span_id,
+        "parent_id": parent_id,
+        "service": SERVICE,
+        "name": name,
+        "job_id": job_id,
+        "start": start,
+        "duration": round(duration, 6),
+        "attrs": attrs,
+    }
+    line = (json.dumps(record) + "\n").encode("utf-8")
+    try:
+        if TRACE_FILE:
+            fd = os.open(TRACE_FILE, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+            try:
+                os.write(fd, line)
+            finally:
+                os.close(fd)
+        if trace_socket:
+            host, port = TRACE_COLLECTOR.rsplit(":", 1)
+            trace_socket.sendto(line, (host, int(port)))
+    except OSError as e:
+        logging.warning(f"Não foi possível registar o span {name}: {e}")
+
+def trace_context(properties):
+    """
+    Contexto de tracing recebido nos cabeçalhos AMQP da mensagem (novo trace_id se não vier nenhum).
+    """
+    headers = getattr(properties, "headers", None) or {}
+    headers = {k: v.decode() if isinstance(v, bytes) else v for k, v in headers.items()}
+    return {"trace_id": headers.get("trace_id") or uuid.uuid4().hex, "parent_id": headers.get("parent_id")}
+
+class StageTimings:
+    """
+    Tempo acumulado por etapa de um pedido. Etapas medidas em várias threads (ex: páginas ou
+    saídas processadas em paralelo) somam o tempo de todas as threads.
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.seconds = {}
+        self.spans = []  # (etapa, início em epoch, duração) para o tracing
+
+    def add(self, name, seconds):
+        with self.lock:
+            self.seconds[name] = self.seconds.get(name, 0.0) + seconds
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        started_at, start = time.time(), time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - start
+            self.add(name, elapsed)
+            with self.lock:
+                self.spans.append((name, started_at, elapsed))
+
+    def emit_spans(self, trace_id, parent_id, job_id):
+        for name, started_at, elapsed in list(self.spans):
+            emit_span(name, trace_id, new_span_id(), parent_id, started_at, elapsed, job_id)
+
+    def reset(self):
+        with self.lock:
+            self.seconds = {}
+            self.spans = []
@@ -0,0 +1,69 @@
+"""
+Testes unitários das partes sem estado dos componentes (sem RabbitMQ, Consul nem LibreOffice).
+
+Os componentes são carregados a partir dos ficheiros, com nomes distintos (os dois serviços chamam-se
+service.py), depois de apontar os stores e o tracing para uma pasta temporária. Precisam das
+dependências do requirements.txt: sem elas, os testes desse componente são saltados.
+"""
+import importlib.util
+import os
+import sys
+import tempfile
+
+import pytest
+
+ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), ".."))
+
+# Variáveis lidas pelos módulos no import
+_work_dir = tempfile.mkdtemp(prefix="conv-tests-")
+for name in ("RESULTS_DIR", "BLOBS_DIR", "WORK_DIR"):
+    os.environ.setdefault(name, os.path.join(_work_dir, name.split("_")[0].lower()))
+os.environ["TRACE_FILE"] = ""
+
+COMPONENTS = {
+    "dispatcher": os.path.join("dispatcher", "dispatcher.py"),
+    "delivery": os.path.join("delivery", "delivery.py"),
+    "service_text": os.path.join("services", "service_text", "service.py"),
+    "service_image": os.path.join("services", "service_image", "service.py"),
+}
+
+
+def load_component(name):
+    if name in sys.modules:
+        return sys.modules[name]
+    spec = importlib.util.spec_from_file_location(name, os.path.join(ROOT, COMPONENTS[name]))
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[name] = module
+    try:
+        spec.loader.exec_module(module)
+    except ModuleNotFoundError as e:
+        del sys.modules[name]
+        pytest.skip(f"{name}: dependência em falta ({e.name})")
+    # Os dois serviços registam métricas com os mesmos nomes: retiradas do registo global para que
+    # o componente seguinte possa ser carregado no mesmo processo (continuam a funcionar)
+    from prometheus_client import REGISTRY
+    from prometheus_client.metrics import MetricWrapperBase
+    metrics = {id(value): value for value in vars(module).values() if isinstance(value, MetricWrapperBase)}
+    for metric in metrics.values():
+        REGISTRY.unregister(metric)
+    return module
+
+
+@pytest.fixture(scope="session")
+def dispatcher():
+    return load_component("dispatcher")
+
+
+@pytest.fixture(scope="session")
+def delivery():
+    return load_component("delivery")
+
+
+@pytest.fixture(scope="session")
+def service_text():
+    return load_component("service_text")
+
+
+@pytest.fixture(scope="session")
+def service_image():
+    return load_component("service_image")
@@ -0,0 +1,68 @@
+import email.parser
+import email.policy
+import os
+
+import pytest
+
+
+@pytest.fixture
+def result_file(tmp_path):
+    path = tmp_path / "resultado.zip"
+    path.write_bytes(os.urandom(200 * 1024 + 7))
+    return path
+
+
+def parse_multipart(stream):
+    body = b"".join(stream)
+    message = email.parser.BytesParser(policy=email.policy.default).parsebytes(
+        f"Content-Type: {stream.content_type}\r\n\r\n".encode() + body
+    )
+    return body, list(message.iter_parts())
+
+
+def test_multipart_stream_body(delivery, result_file):
+    stream = delivery.MultipartFileStream(str(result_file), "resultado.zip", block_size=64 * 1024)
+    body, parts = parse_multipart(stream)
+    assert len(body) == len(stream)
+    assert len(parts) == 1
+    assert parts[0].get_param("name", header="content-disposition") == "file"
+    assert parts[0].get_filename() == "resultado.zip"
+    assert parts[0].get_content() == result_file.read_bytes()
+
+
+def test_multipart_stream_is_streamed_in_blocks(delivery, result_file):
+    stream = delivery.MultipartFileStream(str(result_file), "resultado.zip", block_size=64 * 1024)
+    blocks = list(stream)
+    # cabeçalho, 4 blocos do ficheiro (3 x 64 KiB + resto) e fecho
+    assert len(blocks) == 6
+    assert max(len(block) for block in blocks[1:-1]) == 64 * 1024
+
+
+def test_multipart_stream_can_be_read_again(delivery, result_file):
+    # Um envio repetido (ex: nova ligação do requests) volta a ler o ficheiro desde o início
+    stream = delivery.MultipartFileStream(str(result_file), "resultado.zip")
+    assert b"".join(stream) == b"".join(stream)
+
+
+def test_multipart_stream_sanitizes_filename(delivery, result_file):
+    stream = delivery.MultipartFileStream(str(result_file), 'a"b\r\nX-Injected: 1.zip', field="upload")
+    _, parts = parse_multipart(stream)
+    assert parts[0].get_filename() == "abX-Injected: 1.zip"
+    assert parts[0].get_param("name", header="content-disposition") == "upload"
+    assert "X-Injected" not in parts[0]
+
+
+def test_multipart_stream_empty_file(delivery, tmp_path):
+    path = tmp_path / "vazio.txt"
+    path.write_bytes(b"")
+    stream = delivery.MultipartFileStream(str(path), "vazio.txt")
+    body, parts = parse_multipart(stream)
+    assert len(body) == len(stream)
+    assert parts[0].get_content() == b""
+
+
+def test_multipart_boundaries_are_unique(delivery, result_file):
+    first = delivery.MultipartFileStream(str(result_file), "a.zip")
+    second = delivery.MultipartFileStream(str(result_file), "a.zip")
+    assert first.boundary != second.boundary
+    assert first.content_type == f"multipart/form-data; boundary={first.boundary}"
@@ -0,0 +1,219 @@
+import time
+
+import pytest
+
+MB = 1024 * 1024
+QUEUE = "image_convert_queue"
+
+
+def make_job(job_id, tenant, size=MB, queue=QUEUE):
+    return {"job_id": job_id, "tenant": tenant, "queue": queue, "size": size}
+
+
+def drain(scheduler, queue=QUEUE):
+    picked = []
+    while (job := scheduler.pick(queue)) is not None:
+        picked.append(job["job_id"])
+    return picked
+
+
+# --- TokenBucket ---
+
+def test_token_bucket_allows_burst_then_waits(dispatcher):
+    bucket = dispatcher.TokenBucket(rate=2, burst=3)
+    assert [bucket.take() for _ in range(3)] == [0, 0, 0]
+    assert bucket.take() == pytest.approx(0.5, abs=0.01)
+
+
+def test_token_bucket_refills_at_rate(dispatcher):
+    bucket = dispatcher.TokenBucket(rate=2, burst=3)
+    for _ in range(3):
+        bucket.take()
+    bucket.updated -= 1  # um segundo depois: 2 pedidos
+    assert [bucket.take() for _ in range(2)] == [0, 0]
+    assert bucket.take() > 0
+
+
+def test_token_bucket_never_exceeds_burst(dispatcher):
+    bucket = dispatcher.TokenBucket(rate=5, burst=2)
+    bucket.updated -= 100
+    assert [bucket.take() for _ in range(2)] == [0, 0]
+    assert bucket.take() > 0
+
+
+def test_token_bucket_minimum_burst_is_one(dispatcher):
+    bucket = dispatcher.TokenBucket(rate=1, burst=0)
+    assert bucket.take() == 0
+    assert bucket.take() > 0
+
+
+# --- TenantScheduler ---
+
+@pytest.fixture
+def scheduler(dispatcher, monkeypatch):
+    monkeypatch.setattr(dispatcher, "SCHEDULER_QUANTUM_MB", 1)
+    return dispatcher.TenantScheduler()
+
+
+def test_scheduler_single_tenant_keeps_order(scheduler):
+    for i in range(3):
+        scheduler.submit(make_job(f"a{i}", "a"))
+    assert drain(scheduler) == ["a0", "a1", "a2"]
+
+
+def test_scheduler_interleaves_tenants_with_equal_weight(scheduler):
+    for i in range(3):
+        scheduler.submit(make_job(f"a{i}", "a"))
+    for i in range(3):
+        scheduler.submit(make_job(f"b{i}", "b"))
+    assert drain(scheduler) == ["a0", "b0", "a1", "b1", "a2", "b2"]
+
+
+def test_scheduler_weight_sets_share(dispatcher, scheduler, monkeypatch):
+    monkeypatch.setitem(dispatcher.TENANTS, "heavy", {**dispatcher.TENANT_DEFAULTS, "weight": 2})
+    for i in range(4):
+        scheduler.submit(make_job(f"h{i}", "heavy"))
+    for i in range(2):
+        scheduler.submit(make_job(f"l{i}", "light"))
+    assert drain(scheduler) == ["h0", "h1", "l0", "h2", "h3", "l1"]
+
+
+def test_scheduler_large_job_waits_for_accumulated_credit(scheduler):
+    scheduler.submit(make_job("big", "a", size=3 * MB))
+    for i in range(3):
+        scheduler.submit(make_job(f"b{i}", "b"))
+    # O tenant a só tem crédito para o pedido de 3 MB à terceira ronda
+    assert drain(scheduler) == ["b0", "b1", "big", "b2"]
+
+
+def test_scheduler_skips_tenant_at_max_in_flight(dispatcher, scheduler, monkeypatch):
+    monkeypatch.setitem(dispatcher.TENANTS, "limited", {**dispatcher.TENANT_DEFAULTS, "max_in_flight": 1})
+    scheduler.released["running"] = {"tenant": "limited", "queue": QUEUE, "waiting": False}
+    scheduler.submit(make_job("l0", "limited"))
+    scheduler.submit(make_job("o0", "other"))
+    assert drain(scheduler) == ["o0"]
+    del scheduler.released["running"]
+    assert drain(scheduler) == ["l0"]
+
+
+def test_scheduler_queues_are_independent(scheduler):
+    scheduler.submit(make_job("t0", "a", queue="text_convert_queue.pdf.png"))
+    scheduler.submit(make_job("i0", "a"))
+    assert drain(scheduler, "text_convert_queue.pdf.png") == ["t0"]
+    assert drain(scheduler) == ["i0"]
+    assert scheduler.pick("unknown_queue") is None
+
+
+def test_scheduler_requeue_puts_job_back_first(scheduler):
+    for i in range(2):
+        scheduler.submit(make_job(f"a{i}", "a"))
+    job = scheduler.pick(QUEUE)
+    scheduler.requeue(job)
+    assert drain(scheduler) == ["a0", "a1"]
+
+
+def test_scheduler_backlog_counts_pending_jobs(scheduler):
+    scheduler.submit(make_job("a0", "a", size=2 * MB))
+    scheduler.submit(make_job("b0", "b", size=3 * MB))
+    assert scheduler.backlog(QUEUE) == (2, 5 * MB)
+    assert scheduler.pending_count("a") == 1
+    assert scheduler.backlog("unknown_queue") == (0, 0)
+
+
+# --- QueueAdmission ---
+
+LIMITS = {"max_messages": 1000, "max_bytes": 1024 * MB, "max_wait_seconds": 120}
+
+
+@pytest.fixture
+def admission(dispatcher, monkeypatch):
+    monkeypatch.setitem(dispatcher.ADMISSION_LIMITS, QUEUE, dict(LIMITS))
+    return dispatcher.QueueAdmission()
+
+
+def sample(admission, messages, consumers=2, drain_rate=None, avg_bytes=0.0):
+    admission.queues.pop(QUEUE, None)  # primeira amostra: sem o intervalo mínimo entre amostras
+    admission.update(QUEUE, messages, consumers)
+    admission.queues[QUEUE].update(drain_rate=drain_rate, avg_bytes=avg_bytes)
+
+
+def test_admission_drain_rate_counts_published_messages(admission):
+    admission.update(QUEUE, 100, 2)
+    admission.queues[QUEUE]["sampled_at"] -= 10
+    for _ in range(10):
+        admission.published(QUEUE, MB)
+    admission.update(QUEUE, 50, 2)
+    # (100 + 10 publicadas - 50) mensagens em 10 segundos
+    assert admission.queues[QUEUE]["drain_rate"] == pytest.approx(6, rel=0.01)
+    assert admission.queues[QUEUE]["published"] == 0
+
+
+def test_admission_drain_rate_is_smoothed(admission):
+    admission.update(QUEUE, 100, 2)
+    admission.queues[QUEUE].update(sampled_at=time.monotonic() - 10, drain_rate=10.0)
+    admission.update(QUEUE, 100, 2)
+    assert admission.queues[QUEUE]["drain_rate"] == pytest.approx(0.7 * 10, rel=0.01)
+
+
+def test_admission_ignores_samples_too_close(admission):
+    admission.update(QUEUE, 100, 2)
+    admission.update(QUEUE, 0, 2)
+    assert admission.queues[QUEUE]["messages"] == 100
+    assert admission.queues[QUEUE]["drain_rate"] is None
+
+
+def test_admission_average_size(admission):
+    admission.published(QUEUE, 100)
+    admission.published(QUEUE, 200)
+    assert admission.queues[QUEUE]["avg_bytes"] == pytest.approx(110)
+
+
+def test_admission_accepts_without_sample(admission):
+    assert admission.check(QUEUE, MB) is None
+
+
+def test_admission_accepts_with_stale_sample(dispatcher, admission):
+    sample(admission, 5000, drain_rate=1)
+    admission.queues[QUEUE]["sampled_at"] -= dispatcher.ADMISSION_SAMPLE_INTERVAL * 6
+    assert admission.check(QUEUE, MB) is None
+
+
+def test_admission_accepts_below_limits(admission):
+    sample(admission, 10, drain_rate=5, avg_bytes=MB)
+    assert admission.check(QUEUE, MB) is None
+
+
+def test_admission_rejects_too_many_messages(admission):
+    sample(admission, 2000, drain_rate=10)
+    # Excesso de 1001 mensagens a 10 mensagens/segundo
+    assert admission.check(QUEUE, MB) == (429, "messages", 101)
+
+
+def test_admission_rejects_too_many_bytes(admission):
+    sample(admission, 500, drain_rate=100, avg_bytes=4 * MB)
+    # 500 x 4 MB + 4 MB pendentes: excesso de 980 MB, 245 pedidos médios
+    assert admission.check(QUEUE, 4 * MB) == (429, "bytes", 3)
+
+
+def test_admission_rejects_long_wait(admission):
+    sample(admission, 500, drain_rate=2)
+    # 250 s de espera: 130 s acima do limite, 260 mensagens a 2 por segundo
+    assert admission.check(QUEUE, MB) == (429, "wait", 130)
+
+
+def test_admission_without_consumers_is_503(admission):
+    sample(admission, 2000, consumers=0, drain_rate=10)
+    assert admission.check(QUEUE, MB)[0] == 503
+
+
+def test_admission_retry_after_default_and_cap(dispatcher, admission):
+    sample(admission, 2000)
+    assert admission.check(QUEUE, MB) == (429, "messages", dispatcher.ADMISSION_RETRY_AFTER_DEFAULT)
+    sample(admission, 100000, drain_rate=1)
+    assert admission.check(QUEUE, MB)[2] == dispatcher.ADMISSION_RETRY_AFTER_MAX
+
+
+def test_admission_counts_scheduler_backlog(dispatcher, admission, monkeypatch):
+    monkeypatch.setattr(dispatcher.scheduler, "backlog", lambda queue_name: (1000, 0))
+    sample(admission, 0, drain_rate=1000)
+    assert admission.check(QUEUE, MB)[1] == "messages"
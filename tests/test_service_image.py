@@ -0,0 +1,56 @@
+import json
+
+import pytest
+
+
+def test_parse_outputs_defaults_and_normalization(service_image):
+    outputs = service_image.parse_outputs([
+        {"format": "JPG", "max_width": 200, "max_height": 200, "profile": "small", "name": "thumb"},
+        {"format": "png"},
+    ])
+    assert outputs == [
+        {"format": "jpg", "max_width": 200, "max_height": 200, "profile": "small", "name": "thumb"},
+        {"format": "png", "name": "2"},
+    ]
+
+
+def test_parse_outputs_accepts_json_string(service_image):
+    outputs = service_image.parse_outputs(json.dumps([{"format": "gif", "colors": 64}]))
+    assert outputs == [{"format": "gif", "colors": 64, "name": "1"}]
+
+
+def test_parse_outputs_drops_unknown_fields(service_image):
+    outputs = service_image.parse_outputs([{"format": "png", "callback_url": "http://x", "name": "a"}])
+    assert outputs == [{"format": "png", "name": "a"}]
+
+
+def test_parse_outputs_keeps_null_options_for_inheritance(service_image):
+    # null herda o valor do pedido em render_output
+    outputs = service_image.parse_outputs([{"format": "png", "profile": None}])
+    assert outputs[0]["profile"] is None
+
+
+def test_parse_outputs_sanitizes_names(service_image):
+    outputs = service_image.parse_outputs([{"format": "png", "name": "../../etc/passwd"}])
+    assert outputs[0]["name"] == "etc_passwd"
+
+
+@pytest.mark.parametrize("outputs, message", [
+    ([], "lista não vazia"),
+    ({"format": "png"}, "lista não vazia"),
+    ([{"name": "a"}], "falta o campo format"),
+    (["png"], "falta o campo format"),
+    ([{"format": "bmp"}], "Formato de saída inválido"),
+    ([{"format": "png", "profile": "turbo"}], "Perfil de codificação inválido"),
+    ([{"format": "png", "name": "a"}, {"format": "jpg", "name": "a"}], "repetido"),
+    ([{"format": "png", "name": "..."}], "repetido"),
+])
+def test_parse_outputs_rejects_invalid(service_image, outputs, message):
+    with pytest.raises(ValueError, match=message):
+        service_image.parse_outputs(outputs)
+
+
+def test_parse_outputs_limits_count(service_image, monkeypatch):
+    monkeypatch.setattr(service_image, "MAX_OUTPUTS", 2)
+    with pytest.raises(ValueError, match="Máximo de 2 saídas"):
+        service_image.parse_outputs([{"format": "png"}] * 3)
@@ -0,0 +1,51 @@
+import pytest
+
+
+@pytest.mark.parametrize("pages, ranges", [
+    (1, [(1, 1)]),
+    (20, [(1, 20)]),
+    (21, [(1, 20), (21, 21)]),
+    (45, [(1, 20), (21, 40), (41, 45)]),
+    (60, [(1, 20), (21, 40), (41, 60)]),
+])
+def test_shard_ranges(service_text, monkeypatch, pages, ranges):
+    monkeypatch.setattr(service_text, "SHARD_PAGES", 20)
+    assert service_text.shard_ranges(pages) == ranges
+
+
+@pytest.mark.parametrize("pages", [1, 7, 99, 100, 101, 997])
+@pytest.mark.parametrize("shard_pages", [1, 3, 20])
+def test_shard_ranges_cover_every_page_once(service_text, monkeypatch, pages, shard_pages):
+    monkeypatch.setattr(service_text, "SHARD_PAGES", shard_pages)
+    ranges = service_text.shard_ranges(pages)
+    covered = [page for first, last in ranges for page in range(first, last + 1)]
+    assert covered == list(range(1, pages + 1))
+    assert all(last - first + 1 <= shard_pages for first, last in ranges)
+
+
+def test_shard_ranges_empty_document(service_text):
+    assert service_text.shard_ranges(0) == []
+
+
+def test_parse_outputs(service_text):
+    outputs = service_text.parse_outputs("docx", '[{"format": "PDF"}, {"format": "png", "profile": "Small"}]')
+    assert outputs == [{"format": "pdf", "profile": None}, {"format": "png", "profile": "small"}]
+
+
+@pytest.mark.parametrize("outputs, message", [
+    ([], "lista não vazia"),
+    ([{"profile": "fast"}], "falta o campo format"),
+    ([{"format": "docx"}], "Conversão não suportada"),
+    ([{"format": "png", "profile": "turbo"}], "Perfil de codificação inválido"),
+    ([{"format": "png"}, {"format": "PNG"}], "repetido"),
+])
+def test_parse_outputs_rejects_invalid(service_text, outputs, message):
+    with pytest.raises(ValueError, match=message):
+        service_text.parse_outputs("docx", outputs)
+
+
+def test_parse_outputs_only_enabled_conversions(service_text, monkeypatch):
+    monkeypatch.setattr(service_text, "ENABLED_CONVERSIONS", ["docx:pdf"])
+    assert service_text.parse_outputs("docx", [{"format": "pdf"}]) == [{"format": "pdf", "profile": None}]
+    with pytest.raises(ValueError, match="Conversão não suportada"):
+        service_text.parse_outputs("docx", [{"format": "png"}])